@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the transform and validation tooling.
+
+Each benchmark runs on the real inputs in the repo and on synthetic copies scaled 10x (and 100x
+with --scales 1 10 100): the source YAML repeated with renumbered phvs, the *-ingest tree copied,
+or the report's source rows multiplied. Best-of-N wall time and peak traced memory are
+appended to a JSON history, one entry per run, tagged with the git commit.
+
+Benchmarks:
+    parse_source_yaml       LinkMLTransformer.parse_source_yaml on ATTIC/asthma.yaml, future/AHI_to_sort.yaml
+    transform_file          LinkMLTransformer.transform_file on ATTIC/asthma.yaml
+    clean_linkml_map        clean_linkml_map_for_yaml on ATTIC/asthma.yaml
+    fhs_transform_yaml_file YAMLTransformer.transform_yaml_file on ATTIC/asthma.yaml
+    validate_ingest         validate_ingest_yamls.validate_files over the *-ingest tree
+    parse_spec_tree         spec_parser.parse_tree over the whole priority_variables_transform tree
+    generate_report         preharmonized_qaqc_report.generate_report on synthetic sheet rows
+
+Usage:
+    python benchmarks/run_benchmarks.py run [--scales 1 10 100] [--only parse_source_yaml] [--repeat 3]
+    python benchmarks/run_benchmarks.py compare [BASE_COMMIT [HEAD_COMMIT]] [--threshold 0.15]
+    python benchmarks/run_benchmarks.py list
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+TRANSFORM_DIR = REPO_ROOT / 'priority_variables_transform'
+BATCH_DIR = TRANSFORM_DIR / 'batch_converting'
+FHS_CONDITIONS_DIR = BATCH_DIR / 'fhs_conditions'
+
+for path in (REPO_ROOT, BATCH_DIR, FHS_CONDITIONS_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+DEFAULT_HISTORY = Path(__file__).resolve().parent / 'history.json'
+SOURCE_INPUTS = [TRANSFORM_DIR / 'ATTIC' / 'asthma.yaml', TRANSFORM_DIR / 'future' / 'AHI_to_sort.yaml']
+LOOKUP_CSV = FHS_CONDITIONS_DIR / 'BDCHMVariableMappingContextualVariablesV2.csv'
+
+PHV_NUMBER_RE = re.compile(r'phv(\d+)')
+
+
+def scaled_text(text: str, scale: int) -> str:
+    """`scale` copies of a spec, with the phvs of each extra copy renumbered so they stay distinct"""
+    copies = [text]
+    for copy in range(1, scale):
+        copies.append(PHV_NUMBER_RE.sub(lambda m, c=copy: f"phv{c}{m.group(1)}", text))
+    return '\n'.join(copies)
+
+
+def write_scaled(source: Path, scale: int, workdir: Path) -> Path:
+    if scale == 1:
+        return source
+    target = workdir / f"{source.stem}_x{scale}{source.suffix}"
+    target.write_text(scaled_text(source.read_text(), scale))
+    return target
+
+
+# Each setup takes (scale, workdir) and returns the callable to time
+
+
+def setup_parse_source_yaml(source: Path):
+    def setup(scale: int, workdir: Path) -> Callable[[], Any]:
+        from linkml_transform_script import LinkMLTransformer
+        content = write_scaled(source, scale, workdir).read_text()
+        return lambda: LinkMLTransformer().parse_source_yaml(content)
+    return setup
+
+
+def setup_transform_file(scale: int, workdir: Path) -> Callable[[], Any]:
+    from linkml_transform_script import LinkMLTransformer
+    content = write_scaled(SOURCE_INPUTS[0], scale, workdir).read_text()
+    return lambda: LinkMLTransformer().transform_file(content)
+
+
+def setup_clean_linkml_map(scale: int, workdir: Path) -> Callable[[], Any]:
+    from fhs_conditions_transformer import clean_linkml_map_for_yaml
+    source = write_scaled(SOURCE_INPUTS[0], scale, workdir)
+    return lambda: clean_linkml_map_for_yaml(str(source))
+
+
+def setup_fhs_transform_yaml_file(scale: int, workdir: Path) -> Callable[[], Any]:
+    from fhs_conditions_transformer import YAMLTransformer
+    source = write_scaled(SOURCE_INPUTS[0], scale, workdir)
+    transformer = YAMLTransformer(str(LOOKUP_CSV))
+    output = workdir / f"fhs_transformed_x{scale}.yaml"
+    return lambda: transformer.transform_yaml_file(str(source), str(output))
+
+
+def setup_validate_ingest(scale: int, workdir: Path) -> Callable[[], Any]:
+    from validate_ingest_yamls import find_ingest_files, validate_files
+    if scale == 1:
+        files = find_ingest_files(TRANSFORM_DIR)
+    else:
+        tree = workdir / f"ingest_x{scale}"
+        for copy in range(scale):
+            for ingest_dir in sorted(TRANSFORM_DIR.glob('*-ingest')):
+                shutil.copytree(ingest_dir, tree / f"copy{copy}" / ingest_dir.name)
+        files = find_ingest_files(tree)
+    return lambda: validate_files(files, jobs=1)
+
+
+def setup_parse_spec_tree(scale: int, workdir: Path) -> Callable[[], Any]:
+    import spec_parser
+    if scale == 1:
+        tree = TRANSFORM_DIR
+    else:
+        tree = workdir / f"specs_x{scale}"
+        for copy in range(scale):
+            shutil.copytree(TRANSFORM_DIR, tree / f"copy{copy}")
+    return lambda: list(spec_parser.parse_tree(tree))
+
+
+def synthetic_sheet(scale: int):
+    """Rows shaped like load_source_data()'s: every valid phv of every cohort, plus rows not on the lists"""
+    import pandas as pd
+    from transform_assessment.preharmonized_qaqc_report import load_valid_phvs
+    with contextlib.redirect_stdout(io.StringIO()):
+        valid_phvs = load_valid_phvs()
+    labels = sorted(path.stem for path in (TRANSFORM_DIR / 'FHS-ingest').glob('*.yaml'))
+    rows = []
+    for copy in range(scale):
+        for cohort, phvs in sorted(valid_phvs.items()):
+            for i, phv in enumerate(sorted(phvs)):
+                label = f"{labels[i % len(labels)]}_{copy}" if copy else labels[i % len(labels)]
+                rows.append((label, phv, cohort, (i * 37) % 5000))
+                if i % 10 == 0:
+                    rows.append((label, f"phv9{i:07d}", cohort, 1))
+        for i in range(200):
+            rows.append((f"{labels[i % len(labels)]}_{copy}", f"phv8{i:07d}", 'ARIC', i))
+    return pd.DataFrame(rows, columns=['bdchm_label', 'phv', 'cohort', 'n_stats'])
+
+
+def setup_generate_report(scale: int, workdir: Path) -> Callable[[], Any]:
+    from transform_assessment.preharmonized_qaqc_report import generate_report
+    sheet = synthetic_sheet(scale)
+    output = workdir / f"report_x{scale}.csv"
+    return lambda: generate_report(sheet, output)
+
+
+BENCHMARKS: Dict[str, List[Tuple[str, Callable[[int, Path], Callable[[], Any]]]]] = {
+    'parse_source_yaml': [(source.name, setup_parse_source_yaml(source)) for source in SOURCE_INPUTS],
+    'transform_file': [('asthma.yaml', setup_transform_file)],
+    'clean_linkml_map': [('asthma.yaml', setup_clean_linkml_map)],
+    'fhs_transform_yaml_file': [('asthma.yaml', setup_fhs_transform_yaml_file)],
+    'validate_ingest': [('*-ingest', setup_validate_ingest)],
+    'parse_spec_tree': [('priority_variables_transform', setup_parse_spec_tree)],
+    'generate_report': [('synthetic sheet', setup_generate_report)],
+}
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Peak traced memory from one run, then the best wall time of `repeat` untraced runs"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_mb': peak / 2 ** 20}
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_history(history_file: Path) -> List[Dict[str, Any]]:
+    if not history_file.exists():
+        return []
+    with open(history_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_history(history_file: Path, history: List[Dict[str, Any]]):
+    tmp_file = history_file.with_name(history_file.name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=1)
+    tmp_file.replace(history_file)
+
+
+def run(args) -> int:
+    selected = args.only or list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmark(s): {', '.join(unknown)}; see 'list'")
+        return 2
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmarks-') as tmp:
+        workdir = Path(tmp)
+        for name in selected:
+            for input_name, setup in BENCHMARKS[name]:
+                for scale in args.scales:
+                    key = f"{name}[{input_name} x{scale}]"
+                    try:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            fn = setup(scale, workdir)
+                        # big scales are slow enough that one timed run is representative
+                        result = measure(fn, args.repeat if scale < 100 else 1)
+                    except Exception as e:
+                        print(f"{key:<55} failed: {e}")
+                        continue
+                    results[key] = result
+                    print(f"{key:<55} {result['seconds']:9.3f}s  peak {result['peak_mb']:8.1f} MiB")
+
+    entry = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'results': results,
+    }
+    history = load_history(args.history)
+    history.append(entry)
+    save_history(args.history, history)
+    print(f"Recorded {len(results)} result(s) for {entry['commit']} in {args.history}")
+    return 0
+
+
+def find_entry(history: List[Dict[str, Any]], commit: Optional[str], default: int) -> Optional[Dict[str, Any]]:
+    """Latest history entry for a commit (prefix match), or history[default] if no commit is given"""
+    if commit is None:
+        return history[default] if len(history) >= abs(default) else None
+    for entry in reversed(history):
+        if entry['commit'].startswith(commit):
+            return entry
+    return None
+
+
+def compare(args) -> int:
+    history = load_history(args.history)
+    base = find_entry(history, args.base, -2)
+    head = find_entry(history, args.head, -1)
+    if base is None or head is None:
+        print('Need two recorded runs to compare (run the benchmarks on both commits first)')
+        return 2
+
+    print(f"Comparing {base['commit']} ({base['timestamp']}) -> {head['commit']} ({head['timestamp']})")
+    slower = []
+    for key in sorted(set(base['results']) & set(head['results'])):
+        before, after = base['results'][key], head['results'][key]
+        ratio = after['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        memory_ratio = after['peak_mb'] / before['peak_mb'] if before['peak_mb'] else 1.0
+        flag = ''
+        # millisecond benchmarks jitter by more than the threshold; require a real difference too
+        changed = abs(after['seconds'] - before['seconds']) >= args.min_difference
+        if ratio > 1 + args.threshold and changed:
+            flag = '  SLOWER'
+            slower.append(key)
+        elif ratio < 1 - args.threshold and changed:
+            flag = '  faster'
+        if memory_ratio > 1 + args.threshold:
+            flag += '  MORE MEMORY'
+        print(f"{key:<55} {before['seconds']:9.3f}s -> {after['seconds']:9.3f}s  ({ratio:5.2f}x)"
+              f"  peak {before['peak_mb']:7.1f} -> {after['peak_mb']:7.1f} MiB{flag}")
+    only = sorted(set(base['results']) ^ set(head['results']))
+    if only:
+        print(f"Not in both runs: {', '.join(only)}")
+    if slower:
+        print(f"\n{len(slower)} benchmark(s) slower by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transform and validation tooling')
+    parser.add_argument('--history', type=Path, default=DEFAULT_HISTORY,
+                        help=f'JSON history file (default: {DEFAULT_HISTORY.relative_to(REPO_ROOT)})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks and append the results to the history')
+    run_parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                            help='Input scale factors (default: 1 10; add 100 for the largest inputs)')
+    run_parser.add_argument('--only', nargs='+', default=None, help='Benchmarks to run (default: all)')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark; the best counts')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two recorded runs and flag slowdowns')
+    compare_parser.add_argument('base', nargs='?', default=None, help='Base commit (default: second-latest run)')
+    compare_parser.add_argument('head', nargs='?', default=None, help='Head commit (default: latest run)')
+    compare_parser.add_argument('--threshold', type=float, default=0.15,
+                                help='Relative change to flag (default: 0.15)')
+    compare_parser.add_argument('--min-difference', type=float, default=0.005,
+                                help='Ignore changes smaller than this many seconds (default: 0.005)')
+
+    subparsers.add_parser('list', help='List the benchmarks')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    for name, cases in BENCHMARKS.items():
+        print(f"{name}: {', '.join(input_name for input_name, _ in cases)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
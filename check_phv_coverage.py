@@ -0,0 +1,118 @@
+"""
+Check the phvs referenced by the `*-ingest` specs against transform_assessment/valid-phvs.
+
+For every cohort with a valid-phvs list (`valid-phvs/<cohort>-ingest.tsv`), reports:
+- valid but unmapped: phvs on the list that no spec references
+- mapped but not valid: phvs the specs reference that are not on the list
+
+References are every `populated_from: phv...` and every `{phv...}` inside an expr (quoted
+literals in expr are ignored), anywhere in the file (spec_parser.referenced_phvs). The
+participant and visit columns read by associated_participant and associated_visit are context
+columns, which the lists leave out, so they are not counted. Spec files are parsed in parallel.
+
+Usage:
+    python check_phv_coverage.py
+    python check_phv_coverage.py --jobs 0 --output phv_coverage.tsv
+    python check_phv_coverage.py --strict   # exit 1 if any spec references a phv not on its list
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from spec_parser import load_yaml, referenced_phvs
+from validate_ingest_yamls import cohort_of, find_ingest_files, ingest_dir, load_valid_phvs, valid_phvs_dir
+
+
+def spec_phvs(path: str) -> Tuple[str, Set[str], str]:
+    """Read one spec file and return (path, referenced phvs, error). Runs in worker processes."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = load_yaml(f.read(), path)
+    except Exception as e:
+        return path, set(), str(e).splitlines()[0]
+    return path, referenced_phvs(data), ''
+
+
+def collect_phvs(spec_files: List[Path], jobs: int = 1) -> Tuple[Dict[str, Dict[str, List[str]]], Dict[str, str]]:
+    """
+    Referenced phvs for all spec files in one pass.
+    Returns ({cohort: {phv: [files referencing it]}}, {file: error} for files that did not parse).
+    """
+    paths = [f.as_posix() for f in spec_files]
+    if jobs != 1 and len(paths) > 1:
+        workers = jobs if jobs > 0 else (os.cpu_count() or 1)
+        chunksize = max(1, len(paths) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(spec_phvs, paths, chunksize=chunksize))
+    else:
+        results = [spec_phvs(path) for path in paths]
+
+    mapped = {}
+    errors = {}
+    for path, phvs, error in results:
+        if error:
+            errors[path] = error
+        cohort_phvs = mapped.setdefault(cohort_of(Path(path)), {})
+        for phv in phvs:
+            cohort_phvs.setdefault(phv, []).append(path)
+    return mapped, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check *-ingest spec phvs against transform_assessment/valid-phvs")
+    parser.add_argument('--dir', default=ingest_dir, help=f'Directory to search (default: {ingest_dir})')
+    parser.add_argument('--valid-dir', default=valid_phvs_dir,
+                        help=f'Directory of <cohort>-ingest.tsv lists (default: {valid_phvs_dir})')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Worker processes to parse with (0 = one per CPU, default: 1)')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='Write every mismatch (cohort, phv, status, files) to this TSV file')
+    parser.add_argument('--verbose', '-v', action='store_true', help='List the mismatched phvs')
+    parser.add_argument('--strict', action='store_true',
+                        help='Exit with status 1 if any spec references a phv that is not on its valid list')
+    args = parser.parse_args()
+
+    valid = load_valid_phvs(Path(args.valid_dir))
+    spec_files = find_ingest_files(Path(args.dir))
+    mapped, errors = collect_phvs(spec_files, args.jobs)
+    for path, error in sorted(errors.items()):
+        print(f"Warning: cannot parse {path}: {error}")
+
+    rows = []
+    print(f"{'cohort':<10} {'valid':>6} {'mapped':>7} {'covered':>8} {'valid, unmapped':>16} {'mapped, not valid':>18}")
+    for cohort in sorted(set(valid) | set(mapped)):
+        cohort_mapped = mapped.get(cohort, {})
+        if cohort not in valid:
+            print(f"{cohort:<10} {'-':>6} {len(cohort_mapped):>7}   (no valid-phvs list)")
+            continue
+        unmapped = sorted(valid[cohort] - cohort_mapped.keys())
+        not_valid = sorted(cohort_mapped.keys() - valid[cohort])
+        covered = len(valid[cohort]) - len(unmapped)
+        print(f"{cohort:<10} {len(valid[cohort]):>6} {len(cohort_mapped):>7} {covered:>8} "
+              f"{len(unmapped):>16} {len(not_valid):>18}")
+        rows.extend((cohort, phv, 'valid_unmapped', '') for phv in unmapped)
+        rows.extend((cohort, phv, 'mapped_not_valid', ' '.join(sorted(cohort_mapped[phv]))) for phv in not_valid)
+        if args.verbose:
+            if unmapped:
+                print(f"  valid but unmapped: {' '.join(unmapped)}")
+            for phv in not_valid:
+                print(f"  mapped but not valid: {phv} ({', '.join(sorted(cohort_mapped[phv]))})")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write('cohort\tphv\tstatus\tfiles\n')
+            for row in rows:
+                f.write('\t'.join(row) + '\n')
+        print(f"Mismatches written to {args.output}")
+
+    if args.strict and any(status == 'mapped_not_valid' for _, _, status, _ in rows):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
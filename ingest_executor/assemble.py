@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Assembles nested documents, one per participant, from a LinkML-Map spec such as
+`priority_variables_transform/copdgene-linkml-map/person.yaml` (a Person holding its Participant,
+whose Conditions, DrugExposures, MeasurementObservations... come from object_derivations).
+
+Every table row becomes part of some participant's document, and the parts can come from any
+number of tables, so building documents by joining whole tables in memory does not scale.
+Instead the spec is split into pieces: each derivation on its own, minus the list-valued object
+slots beneath it. Then:
+
+1. Scatter: each table is read once (in chunks with --chunk-size), its pieces are evaluated
+   column-wise, and every record is appended to one of --partitions spill files on disk,
+   chosen by a hash of the participant key.
+2. Merge: one spill file at a time is sorted by (participant, piece, row) and each participant's
+   records are put together into its document, which is written out straight away.
+
+Memory is bounded by the chunk size and the size of one partition, not by the cohort. The key
+is the column the root's `identity` (or `associated_participant`) is read from, e.g.
+dbGaP_Subject_ID, which every dbGaP table carries; --key overrides it.
+
+An object slot holds a list when BDCHM makes it multivalued (MULTIVALUED_SLOTS) or the spec gives
+it several object_derivations, and one object when BDCHM makes it single-valued
+(SINGLE_VALUED_SLOTS); any other slot is an error. Single objects without lists below them
+(`demography`, `value_quantity`) stay part of their parent's piece.
+
+Usage:
+    python -m ingest_executor.assemble priority_variables_transform/copdgene-linkml-map/person.yaml \\
+        --tables DIR --output persons.jsonl [--format parquet] [--chunk-size 100000] [--partitions 64]
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from ingest_executor.executor import Derivation, TableStore, evaluate_derivation, iter_records, load_spec
+from ingest_executor.sinks import entity_schema, output_columns
+
+DEFAULT_PARTITIONS = 64
+# Object slots BDCHM makes multivalued, and the single-valued ones, as the specs use them
+MULTIVALUED_SLOTS = frozenset([
+    'participants', 'conditions', 'exposures', 'measurements', 'observations', 'procedures', 'sdoh_observations',
+])
+SINGLE_VALUED_SLOTS = frozenset(['cause_of_death', 'demography', 'range_high', 'range_low', 'value_quantity'])
+# Documents per Parquet row group
+DOCUMENT_GROUP_SIZE = 10_000
+
+
+class Piece:
+    """One derivation of a document, evaluated on its own, and where its records attach"""
+
+    def __init__(self, index: int, derivation: Derivation, parent: Optional[int], slot: Optional[str], many: bool):
+        self.index = index
+        self.derivation = derivation
+        self.parent = parent
+        self.slot = slot
+        self.many = many
+
+    def __repr__(self):
+        return f"<Piece {self.index} {self.derivation.class_name} from {self.derivation.table} -> {self.parent}.{self.slot}>"
+
+
+def is_list_slot(slot) -> bool:
+    """Whether an object slot holds a list; ValueError if neither BDCHM nor the spec says"""
+    if slot.name in MULTIVALUED_SLOTS:
+        return True
+    if slot.name in SINGLE_VALUED_SLOTS:
+        if len(slot.objects) > 1:
+            raise ValueError(f"{slot.name} holds one object, but has {len(slot.objects)} object_derivations")
+        return False
+    if len(slot.objects) > 1:
+        return True
+    raise ValueError(f"cannot tell whether {slot.name} holds a list; "
+                     f"add it to MULTIVALUED_SLOTS or SINGLE_VALUED_SLOTS")
+
+
+def _splits(slot) -> bool:
+    """Whether an object slot's derivations become pieces of their own"""
+    return bool(slot.objects) and (is_list_slot(slot) or any(_has_split(nested) for nested in slot.objects))
+
+
+def _has_split(derivation: Derivation) -> bool:
+    return any(_splits(slot) for slot in derivation.slots)
+
+
+def split_document(root: Derivation) -> List[Piece]:
+    """The pieces of a document derivation, parents before children"""
+    pieces = []
+
+    def visit(derivation: Derivation, parent: Optional[int], slot_name: Optional[str], many: bool, table: str):
+        table = derivation.table or table
+        own = [slot for slot in derivation.slots if not _splits(slot)]
+        piece = Piece(len(pieces), Derivation(derivation.class_name, table, own, root.source), parent, slot_name, many)
+        pieces.append(piece)
+        for slot in derivation.slots:
+            if _splits(slot):
+                for nested in slot.objects:
+                    visit(nested, piece.index, slot.name, is_list_slot(slot), table)
+
+    visit(root, None, None, False, root.table)
+    return pieces
+
+
+def document_key(root: Derivation) -> Optional[str]:
+    """The column participants are keyed by: where the root's identity or associated_participant comes from"""
+    for name in ('identity', 'associated_participant'):
+        for slot in root.slots:
+            if slot.name == name and isinstance(slot.populated_from, str):
+                return slot.populated_from
+    return None
+
+
+def scatter(pieces: List[Piece], store: TableStore, key_column: str, spill_dir: Path, partitions: int,
+            chunk_size: int = 0) -> Dict[str, int]:
+    """Evaluate every piece and spill its records to hash partitions by key; returns {table: records}"""
+    tables: Dict[str, List[Piece]] = {}
+    for piece in pieces:
+        tables.setdefault(piece.derivation.table, []).append(piece)
+    files = [open(spill_dir / f"part-{i:04d}.tsv", 'w', encoding='utf-8') for i in range(partitions)]
+    counts = {}
+    row = 0
+    try:
+        for table, table_pieces in tables.items():
+            if store.table_file(table) is None:
+                print(f"Warning: no table for {table}; skipping {len(table_pieces)} piece(s)")
+                continue
+            if key_column not in store.read_header(table):
+                print(f"Warning: {table} has no {key_column} column; skipping {len(table_pieces)} piece(s)")
+                continue
+            columns = {key_column}
+            for piece in table_pieces:
+                columns.update(piece.derivation.phvs())
+            if chunk_size:
+                chunks = store.iter_chunks(table, columns, chunk_size)
+            else:
+                chunks = [store.load(table, columns)]
+            counts[table] = 0
+            for chunk in chunks:
+                keys = chunk[key_column]
+                for piece in table_pieces:
+                    frame = evaluate_derivation(piece.derivation, chunk, reset_index=False)
+                    frame_keys = keys.loc[frame.index]
+                    frame = frame[frame_keys.notna().to_numpy()]
+                    frame_keys = frame_keys[frame_keys.notna()].astype(str)
+                    buckets = (pd.util.hash_array(frame_keys.to_numpy(dtype=object)) % partitions).tolist()
+                    records = iter_records(piece.derivation.class_name, frame.reset_index(drop=True))
+                    for key, bucket, record in zip(frame_keys.tolist(), buckets, records):
+                        files[bucket].write(f"{key}\t{piece.index}\t{row}\t{json.dumps(record)}\n")
+                        row += 1
+                    counts[table] += len(frame)
+            chunks = chunk = None
+            store.release(table)
+    finally:
+        for f in files:
+            f.close()
+    return counts
+
+
+def assemble(rows: List[List[str]], pieces: List[Piece]) -> Dict[str, Any]:
+    """One participant's document from its spilled (key, piece, row, record) rows, sorted by piece then row"""
+    objects: Dict[int, List[Dict[str, Any]]] = {}
+
+    def place(index: int, record: Dict[str, Any]):
+        objects.setdefault(index, []).append(record)
+        piece = pieces[index]
+        if piece.parent is None:
+            return
+        if piece.parent not in objects:
+            # records below a parent that produced nothing for this participant still get a parent
+            place(piece.parent, {'type': pieces[piece.parent].derivation.class_name})
+        parent = objects[piece.parent][0]
+        if piece.many:
+            parent.setdefault(piece.slot, []).append(record)
+        else:
+            parent.setdefault(piece.slot, record)
+
+    for _, index, _, text in rows:
+        index = int(index)
+        if index == 0 and 0 in objects:
+            # one document per participant: the first root row wins
+            continue
+        place(index, json.loads(text))
+    return objects[0][0]
+
+
+def merge(spill_dir: Path, pieces: List[Piece]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """(key, document) for every participant, one spill partition at a time"""
+    for path in sorted(spill_dir.glob('part-*.tsv')):
+        with open(path, 'r', encoding='utf-8') as f:
+            rows = [line.rstrip('\n').split('\t', 3) for line in f]
+        rows.sort(key=lambda r: (r[0], int(r[1]), int(r[2])))
+        for key, group in groupby(rows, key=itemgetter(0)):
+            yield key, assemble(list(group), pieces)
+        rows = None
+
+
+def _merge_types(first, second):
+    """Union of two struct types (same-named slots from different derivations of one list)"""
+    if not (pa.types.is_struct(first) and pa.types.is_struct(second)):
+        return first
+    fields = {field.name: field.type for field in first}
+    for field in second:
+        fields[field.name] = _merge_types(fields[field.name], field.type) if field.name in fields else field.type
+    return pa.struct([pa.field(name, field_type) for name, field_type in fields.items()])
+
+
+def document_schema(pieces: List[Piece]) -> 'pa.Schema':
+    """Arrow schema of the documents: structs for objects, lists of structs for list slots"""
+    if pa is None:
+        raise ImportError('pyarrow is required to write Parquet output (poetry install --extras parquet)')
+
+    def piece_type(index: int):
+        fields = {field.name: field.type for field in entity_schema(output_columns(pieces[index].derivation),
+                                                                    dictionary=False)}
+        fields['type'] = pa.string()
+        for child in pieces:
+            if child.parent != index:
+                continue
+            child_type = piece_type(child.index)
+            if child.many:
+                child_type = pa.list_(child_type)
+            if child.slot in fields:
+                existing = fields[child.slot]
+                if child.many and pa.types.is_list(existing):
+                    child_type = pa.list_(_merge_types(existing.value_type, child_type.value_type))
+                else:
+                    child_type = _merge_types(existing, child_type)
+            fields[child.slot] = child_type
+        return pa.struct([pa.field(name, field_type) for name, field_type in fields.items()])
+
+    return pa.schema(list(piece_type(0)))
+
+
+def conform(value: Any, field_type) -> Any:
+    """A record value in the shape of its Arrow type (numbers from expr slots become text in text slots)"""
+    if value is None:
+        return None
+    if pa.types.is_struct(field_type):
+        return {field.name: conform(value.get(field.name), field.type) for field in field_type}
+    if pa.types.is_list(field_type):
+        return [conform(item, field_type.value_type) for item in value]
+    if pa.types.is_floating(field_type):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return value if isinstance(value, str) else str(value)
+
+
+class DocumentJsonlSink:
+    def __init__(self, output_file: Path):
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        self.out = open(output_file, 'w', encoding='utf-8')
+
+    def write(self, document: Dict[str, Any]):
+        self.out.write(json.dumps(document) + '\n')
+
+    def close(self):
+        self.out.close()
+
+
+class DocumentParquetSink:
+    """Writes documents as nested Parquet rows, DOCUMENT_GROUP_SIZE per row group"""
+
+    def __init__(self, output_file: Path, schema: 'pa.Schema', group_size: int = DOCUMENT_GROUP_SIZE):
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        self.schema = schema
+        self.struct = pa.struct(list(schema))
+        self.group_size = group_size
+        self.buffer: List[Dict[str, Any]] = []
+        self.writer = pq.ParquetWriter(output_file, schema, compression='zstd')
+
+    def write(self, document: Dict[str, Any]):
+        self.buffer.append(conform(document, self.struct))
+        if len(self.buffer) >= self.group_size:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.writer.write_table(pa.Table.from_pylist(self.buffer, schema=self.schema))
+            self.buffer = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble one nested document per participant from a LinkML-Map spec')
+    parser.add_argument('spec', type=Path, help='Spec with one root class derivation (e.g. copdgene-linkml-map/person.yaml)')
+    parser.add_argument('--tables', type=Path, required=True, help='Directory of source tables')
+    parser.add_argument('--output', '-o', type=Path, required=True, help='Output file (.jsonl or .parquet)')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl', help='Output format (default: jsonl)')
+    parser.add_argument('--key', default=None,
+                        help="Participant key column (default: the column the root's identity is read from)")
+    parser.add_argument('--partitions', type=int, default=DEFAULT_PARTITIONS,
+                        help=f'Spill partitions; more means less memory per merge (default: {DEFAULT_PARTITIONS})')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='Read tables this many rows at a time (default: 0, whole tables)')
+    parser.add_argument('--spill-dir', type=Path, default=None,
+                        help='Directory for the spill files (default: the system temporary directory)')
+    args = parser.parse_args()
+
+    roots = load_spec(args.spec)
+    if not roots:
+        parser.error(f"no class derivations in {args.spec}")
+    if len(roots) > 1:
+        print(f"Warning: {args.spec} has {len(roots)} root derivations; assembling the first ({roots[0].class_name})")
+    try:
+        pieces = split_document(roots[0])
+    except ValueError as e:
+        parser.error(str(e))
+    key_column = args.key or document_key(roots[0])
+    if key_column is None:
+        parser.error('cannot tell which column identifies participants; give --key')
+
+    if args.format == 'parquet':
+        try:
+            sink = DocumentParquetSink(args.output, document_schema(pieces))
+        except ImportError as e:
+            parser.error(str(e))
+    else:
+        sink = DocumentJsonlSink(args.output)
+
+    start = time.perf_counter()
+    documents = 0
+    try:
+        with tempfile.TemporaryDirectory(prefix='assemble-', dir=args.spill_dir) as spill_dir:
+            counts = scatter(pieces, TableStore(args.tables), key_column, Path(spill_dir), args.partitions,
+                             args.chunk_size)
+            for table, records in counts.items():
+                print(f"{table}: {records} records spilled")
+            scattered = time.perf_counter()
+            for _, document in merge(Path(spill_dir), pieces):
+                sink.write(document)
+                documents += 1
+    finally:
+        sink.close()
+    print(f"Assembled {documents} {roots[0].class_name} document(s) from {len(pieces)} piece(s) keyed by "
+          f"{key_column}: scatter {scattered - start:.2f}s, merge {time.perf_counter() - scattered:.2f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
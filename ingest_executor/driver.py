@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Runs every cohort's *-ingest specs against that cohort's local tables in parallel.
+
+Work is split into one task per (cohort, source table) from each cohort's plan, so FHS's ~150
+tables spread over all cores rather than one cohort per core. Tasks run largest first, each in its
+own worker process, at most --jobs at a time. A task that raises, or whose process dies (killed for
+memory, say), is reported as failed and the rest carry on. So is a cohort whose specs cannot be
+planned (e.g. a nested derivation that cannot be joined without --allow-drop); the run exits 1 at
+the end if anything failed.
+
+A cohort's tasks come from its <cohort>-ingest directory only. temporal/<cohort>, where that exists,
+is read just for its Visit derivations (see ingest_executor.temporal): they build the cohort's visit
+ages once, and the <cohort>-ingest derivations that name a visit get an age slot filled from them.
+Its other specs restate <cohort>-ingest ones, so running them too would write those records twice.
+Tables are read from one subdirectory per cohort under --tables (e.g. TABLES/FHS, TABLES/ARIC).
+Output goes to one file per task: `OUTPUT/<cohort>/<table>.jsonl`, or with --format parquet the
+dataset `OUTPUT/cohort=<cohort>/entity=<class>/<table>.parquet`.
+
+Usage:
+    python -m ingest_executor.driver --tables TABLES --output OUTPUT [--cohorts FHS ARIC] [--jobs 8]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from ingest_executor.executor import TableStore
+from ingest_executor.planner import TablePlan, execute_plan, find_specs, plan_specs
+from ingest_executor.sinks import JsonlSink, ParquetSink, entity_schemas
+from ingest_executor.temporal import VisitAgeIndex, visit_index_for, with_age_slots
+
+SPECS_ROOT = Path(__file__).resolve().parent.parent / 'priority_variables_transform'
+# Table name of the result recorded for a cohort whose specs could not be planned
+PLAN_TABLE = '(plan)'
+
+
+def temporal_spec_dir(ingest_dir: Path) -> Optional[Path]:
+    """temporal/<cohort> next to a <cohort>-ingest directory, if there is one"""
+    temporal = ingest_dir.parent / 'temporal' / ingest_dir.name[:-len('-ingest')]
+    return temporal if temporal.is_dir() else None
+
+
+def cohort_spec_dirs(ingest_dir: Path) -> List[Path]:
+    """A cohort's spec directories: its <cohort>-ingest directory, then temporal/<cohort> next to it if any"""
+    temporal = temporal_spec_dir(ingest_dir)
+    return [ingest_dir] if temporal is None else [ingest_dir, temporal]
+
+
+def find_cohorts(specs_root: Path, cohorts: Optional[List[str]] = None) -> Dict[str, Path]:
+    """Cohort name -> its *-ingest directory under specs_root"""
+    found = {}
+    for path in sorted(specs_root.glob('*-ingest')):
+        if path.is_dir():
+            found[path.name[:-len('-ingest')]] = path
+    if cohorts:
+        unknown = [cohort for cohort in cohorts if cohort not in found]
+        if unknown:
+            print(f"Warning: no spec directory for cohort(s) {', '.join(unknown)}")
+        found = {cohort: path for cohort, path in found.items() if cohort in cohorts}
+    return found
+
+
+def run_task(cohort: str, plan: TablePlan, tables_dir: Path, output_dir: Optional[Path], output_format: str,
+             schemas: Optional[Dict[str, Any]], chunk_size: int,
+             visit_index: Optional[VisitAgeIndex] = None, allow_drop: bool = False) -> Dict[str, Any]:
+    """Execute one table's plan in a worker; never raises, failures come back in the result"""
+    result = {'cohort': cohort, 'table': plan.table, 'derivations': len(plan.derivations),
+              'status': 'ok', 'error': None, 'records': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0, 'by_source': {},
+              'started': time.time()}
+    start = time.perf_counter()
+    sink = None
+    stats = []
+    try:
+        if output_dir is not None:
+            if output_format == 'parquet':
+                sink = ParquetSink(output_dir, schemas, part_name=plan.table)
+            else:
+                sink = JsonlSink(output_dir / cohort / f"{plan.table}.jsonl")
+        store = TableStore(tables_dir)
+        for derivation, frame in execute_plan([plan], store, chunk_size, stats, visit_index, allow_drop):
+            if sink is not None:
+                sink.write(derivation, frame)
+        if not stats:
+            result['status'] = 'skipped'
+            result['error'] = f"no table for {plan.table} in {tables_dir}"
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    finally:
+        if sink is not None:
+            try:
+                sink.close()
+            except Exception:
+                if result['status'] == 'ok':
+                    result['status'] = 'failed'
+                    result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    result['finished'] = time.time()
+    for table_stats in stats:
+        result['records'] += table_stats.records
+        result['peak_rss_mb'] = max(result['peak_rss_mb'], table_stats.peak_rss_mb)
+        result['by_source'] = table_stats.by_source
+    return result
+
+
+def failed_result(cohort: str, table: str, derivations: int, error: str) -> Dict[str, Any]:
+    """The result of a task that failed without reporting one itself"""
+    now = time.time()
+    return {'cohort': cohort, 'table': table, 'derivations': derivations, 'status': 'failed', 'error': error,
+            'records': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0, 'by_source': {}, 'started': now, 'finished': now}
+
+
+def _task_process(conn, task_args: tuple):
+    conn.send(run_task(*task_args))
+    conn.close()
+
+
+def run_tasks(tasks: List[tuple], workers: int) -> Iterator[Tuple[int, Optional[Dict[str, Any]], int]]:
+    """
+    Run run_task(*args) for each entry of tasks, each in a fresh process, at most `workers` at once.
+    Yields (task index, result, exit code) as tasks finish; the result is None if the process died
+    before sending one. A dead process only costs its own task, unlike a shared pool, which breaks
+    and fails every task still queued on it.
+    """
+    context = multiprocessing.get_context()
+    pending = list(enumerate(tasks))
+    pending.reverse()
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            index, task_args = pending.pop()
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_task_process, args=(sender, task_args), daemon=True)
+            process.start()
+            # only the child holds the sending end now, so its exit shows up as EOF here
+            sender.close()
+            running[receiver] = (index, process)
+        for receiver in wait(list(running)):
+            index, process = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+            receiver.close()
+            process.join()
+            yield index, result, process.exitcode
+
+
+def summarize(results: List[Dict[str, Any]]) -> List[str]:
+    """Per-cohort lines: tasks, failures, records, task time and wall time"""
+    lines = []
+    for cohort in sorted({result['cohort'] for result in results}):
+        cohort_results = [result for result in results if result['cohort'] == cohort]
+        failed = sum(result['status'] == 'failed' for result in cohort_results)
+        skipped = sum(result['status'] == 'skipped' for result in cohort_results)
+        records = sum(result['records'] for result in cohort_results)
+        busy = sum(result['seconds'] for result in cohort_results)
+        wall = max(r['finished'] for r in cohort_results) - min(r['started'] for r in cohort_results)
+        lines.append(f"{cohort}: {len(cohort_results)} table(s), {failed} failed, {skipped} skipped, "
+                     f"{records} records, {busy:.1f}s of task time, {wall:.1f}s wall")
+    return lines
+
+
+def file_timings(results: List[Dict[str, Any]]) -> List[List[Any]]:
+    """[cohort, spec file, seconds, records] per spec file, slowest first"""
+    totals = {}
+    for result in results:
+        for source, (seconds, records) in result['by_source'].items():
+            total = totals.setdefault((result['cohort'], source), [0.0, 0])
+            total[0] += seconds
+            total[1] += records
+    rows = [[cohort, source, seconds, records] for (cohort, source), (seconds, records) in totals.items()]
+    return sorted(rows, key=lambda row: -row[2])
+
+
+def write_timings(rows: List[List[Any]], timings_file: Path):
+    with open(timings_file, 'w', encoding='utf-8') as f:
+        f.write('cohort\tspec_file\tseconds\trecords\n')
+        for cohort, source, seconds, records in rows:
+            f.write(f"{cohort}\t{source}\t{seconds:.3f}\t{records}\n")
+    print(f"Per-file timings written to {timings_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run all cohorts\' *-ingest specs in parallel')
+    parser.add_argument('--tables', type=Path, required=True,
+                        help='Directory with one subdirectory of pht tables per cohort (e.g. TABLES/FHS)')
+    parser.add_argument('--output', '-o', type=Path, default=None,
+                        help='Output directory (default: print a summary only)')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl',
+                        help='Output format (default: jsonl)')
+    parser.add_argument('--cohorts', nargs='+', default=None, help='Cohorts to run (default: all)')
+    parser.add_argument('--specs-root', type=Path, default=SPECS_ROOT,
+                        help='Directory holding the <cohort>-ingest and temporal/<cohort> spec directories')
+    parser.add_argument('--jobs', '-j', type=int, default=0,
+                        help='Worker processes (default: 0, one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='Stream tables this many rows at a time (default: 0, read whole tables)')
+    parser.add_argument('--timings', type=Path, default=None, help='Write per-spec-file timings to this TSV file')
+    parser.add_argument('--allow-drop', action='store_true',
+                        help='Leave out nested objects read from another table that cannot be joined, '
+                             'instead of failing')
+    args = parser.parse_args()
+
+    tasks = []
+    visit_indexes = {}
+    # cohorts whose specs can't be planned fail on their own; the others still run
+    results = []
+    for cohort, ingest_dir in find_cohorts(args.specs_root, args.cohorts).items():
+        tables_dir = args.tables / cohort
+        if not tables_dir.is_dir():
+            print(f"Warning: no tables directory {tables_dir}; skipping {cohort}")
+            continue
+        temporal = temporal_spec_dir(ingest_dir)
+        try:
+            plans = plan_specs(find_specs([ingest_dir]), args.allow_drop)
+            temporal_plans = plan_specs(find_specs([temporal]), args.allow_drop) if temporal else []
+        except ValueError as e:
+            print(f"{cohort}: cannot plan specs; skipping ({e})")
+            results.append(failed_result(cohort, PLAN_TABLE, 0, str(e)))
+            continue
+        # built once here and shipped to each of the cohort's tasks
+        visit_indexes[cohort] = visit_index_for([d for plan in temporal_plans for d in plan.derivations],
+                                                TableStore(tables_dir))
+        if visit_indexes[cohort] is not None:
+            print(f"{cohort}: visit ages for {len(visit_indexes[cohort])} (participant, visit) pair(s)")
+            for plan in plans:
+                plan.derivations = with_age_slots(plan.derivations)
+        for plan in plans:
+            tasks.append((cohort, plan, tables_dir))
+    if not tasks and not results:
+        print('Nothing to run')
+        return 1
+
+    schemas = None
+    if args.output is not None and args.format == 'parquet':
+        try:
+            schemas = entity_schemas(d for _, plan, _ in tasks for d in plan.derivations)
+        except ImportError as e:
+            parser.error(str(e))
+
+    # biggest tables first, so the long tasks don't start last
+    tasks.sort(key=lambda task: -len(task[1].columns))
+    workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    print(f"Running {len(tasks)} table task(s) across {len({t[0] for t in tasks})} cohort(s) with {workers} worker(s)")
+
+    start = time.perf_counter()
+    task_args = [(cohort, plan, tables_dir, args.output, args.format, schemas, args.chunk_size,
+                  visit_indexes[cohort], args.allow_drop) for cohort, plan, tables_dir in tasks]
+    done = 0
+    for index, result, exitcode in run_tasks(task_args, workers):
+        cohort, plan, _ = tasks[index]
+        if result is None:
+            # the worker process died (e.g. killed for memory); only this task is lost
+            result = failed_result(cohort, plan.table, len(plan.derivations),
+                                   f"worker process exited with code {exitcode}")
+        results.append(result)
+        done += 1
+        print(f"[{done}/{len(tasks)}] {cohort} {plan.table}: {result['status']}, "
+              f"{result['records']} records, {result['seconds']:.2f}s, peak RSS {result['peak_rss_mb']:.0f} MiB")
+        if result['status'] == 'failed':
+            print(result['error'])
+
+    elapsed = time.perf_counter() - start
+    print()
+    for line in summarize(results):
+        print(line)
+    timings = file_timings(results)
+    print('Slowest spec files:')
+    for cohort, source, seconds, records in timings[:10]:
+        print(f"  {seconds:8.2f}s  {records:>10} records  {source}")
+    if args.timings:
+        write_timings(timings, args.timings)
+    failed = sum(result['status'] == 'failed' for result in results)
+    print(f"Ran {len(results)} task(s) in {elapsed:.2f}s, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
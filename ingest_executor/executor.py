@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Vectorized local executor for the class_derivations specs in priority_variables_transform/*-ingest.
+
+Runs a spec against local dbGaP-style phenotype tables instead of LinkML-Map: each derivation is
+evaluated a whole column at a time with pandas, producing one record per table row.
+
+Tables are looked up by pht in a directory: any file named `<pht>.tsv`, `<pht>.csv`, `<pht>.txt`
+or `<pht>.<anything>.txt` (as dbGaP names them), with one column per phv. Leading `#` comment
+lines are skipped. Tables not named by a pht (COPDGene's specs read from `COPDGene`) are matched
+the same way, by the file name up to its first dot.
+
+ingest_executor.run is the command-line entry point.
+"""
+
+import json
+import math
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ingest_executor.expressions import ExprError, compile_expr
+from ingest_executor.units import default_engine
+
+# The spec model and loader are shared with the other spec tools (spec_parser.py, at the repository root)
+from spec_parser import CONTEXT_SLOTS, PHV_REF_RE, Derivation, SlotDerivation, load_spec  # noqa: F401
+
+# Slots whose values are numbers; everything else is kept as text
+NUMERIC_SLOTS = {
+    'value_decimal', 'value_integer', 'range_low', 'range_high',
+    'age_at_observation', 'age_at_condition_start', 'age_at_condition_end', 'age_at_visit_start',
+}
+# Slot whose labels are held as a pandas Categorical rather than one string per row
+VISIT_SLOT = 'associated_visit'
+
+
+class TableStore:
+    """Finds and reads phenotype tables by pht, caching the columns read so far"""
+
+    def __init__(self, tables_dir: Path):
+        self.tables_dir = Path(tables_dir)
+        self.tables = {}
+        # columns requested but absent from each table, so they are only reported once
+        self.missing = {}
+        self._files = None
+
+    def table_file(self, pht: str) -> Optional[Path]:
+        if self._files is None:
+            self._files = {}
+            for path in sorted(self.tables_dir.iterdir()):
+                if path.suffix in ('.tsv', '.csv', '.txt'):
+                    self._files.setdefault(path.name.split('.')[0], path)
+        return self._files.get(pht)
+
+    def read_header(self, pht: str) -> List[str]:
+        """Column names of a table, without reading its rows"""
+        path = self.table_file(pht)
+        return list(pd.read_csv(path, **self._read_options(path), nrows=0).columns)
+
+    def _read_options(self, path: Path) -> Dict[str, Any]:
+        # dbGaP files start with '#' comment lines before the header
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            skip = 0
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                skip += 1
+        return {
+            'sep': ',' if path.suffix == '.csv' else '\t',
+            'skiprows': skip,
+            'dtype': str,
+            'keep_default_na': False,
+            'na_values': [''],
+        }
+
+    def load(self, pht: str, columns: Set[str]) -> Optional[pd.DataFrame]:
+        """Read (at least) the given columns of a table; columns the table lacks are reported and skipped"""
+        path = self.table_file(pht)
+        if path is None:
+            return None
+        cached = self.tables.get(pht)
+        known_missing = self.missing.setdefault(pht, set())
+        if cached is not None and set(columns) - known_missing <= set(cached.columns):
+            return cached
+        wanted = set(columns) | (set(cached.columns) if cached is not None else set())
+        df = pd.read_csv(path, **self._read_options(path), usecols=self._present_columns(pht, wanted))
+        self.tables[pht] = df
+        return df
+
+    def iter_chunks(self, pht: str, columns: Set[str], chunk_size: int) -> Optional[Iterator[pd.DataFrame]]:
+        """Read the given columns of a table in chunks of chunk_size rows, without caching them"""
+        path = self.table_file(pht)
+        if path is None:
+            return None
+        self.missing.setdefault(pht, set())
+        return pd.read_csv(path, **self._read_options(path), usecols=self._present_columns(pht, set(columns)),
+                           chunksize=chunk_size)
+
+    def _present_columns(self, pht: str, wanted: Set[str]) -> List[str]:
+        # report requested columns the table lacks (once), and read the rest in file order
+        header = self.read_header(pht)
+        known_missing = self.missing[pht]
+        missing = wanted - set(header) - known_missing
+        if missing:
+            print(f"Warning: {self.table_file(pht).name} has no column(s) {', '.join(sorted(missing))}")
+            known_missing.update(missing)
+        return [column for column in header if column in wanted]
+
+    def release(self, pht: str):
+        """Drop a table from the cache once nothing else will read it"""
+        self.tables.pop(pht, None)
+
+
+def coerce_numeric(values: pd.Series) -> pd.Series:
+    # always float64: to_numeric alone gives int64 for a chunk of whole numbers, written as 3 not 3.0
+    return pd.to_numeric(values, errors='coerce').astype('float64')
+
+
+def constant_column(value: Any, index: pd.Index) -> pd.Series:
+    return pd.Series([value] * len(index), index=index, dtype=object)
+
+
+@lru_cache(maxsize=None)
+def categorical_mapping(mapping_key: Tuple[Tuple[str, Any], ...]) -> Tuple[pd.Index, np.ndarray, pd.CategoricalDtype]:
+    """
+    (codes, category of each code, dtype) for a value mapping given as sorted (code, label) pairs.
+    Derivations with the same mapping share one dtype, so their columns concatenate as categoricals.
+    """
+    labels = sorted({label for _, label in mapping_key if label is not None}, key=str)
+    dtype = pd.CategoricalDtype(labels)
+    positions = dtype.categories.get_indexer([label for _, label in mapping_key])
+    return pd.Index([code for code, _ in mapping_key]), positions, dtype
+
+
+@lru_cache(maxsize=None)
+def constant_dtype(value: Any) -> pd.CategoricalDtype:
+    return pd.CategoricalDtype([value])
+
+
+def categorical_map(values: pd.Series, mapping_key: Tuple[Tuple[str, Any], ...]) -> pd.Series:
+    """values.map(mapping) as a Categorical: one small code per row instead of a label string"""
+    codes, positions, dtype = categorical_mapping(mapping_key)
+    found = codes.get_indexer(values)
+    category_codes = np.where(found >= 0, positions[found], -1)
+    return pd.Series(pd.Categorical.from_codes(category_codes, dtype=dtype), index=values.index)
+
+
+def categorical_constant(value: Any, index: pd.Index) -> pd.Series:
+    return pd.Series(pd.Categorical.from_codes(np.zeros(len(index), dtype=np.int8), dtype=constant_dtype(value)),
+                     index=index)
+
+
+class TableJoin:
+    """
+    The values of a nested object derivation that reads another table than its parent, one row
+    per participant, for looking up by the parent rows' participant column
+    """
+
+    def __init__(self, key_column: str, values: pd.DataFrame):
+        self.key_column = key_column
+        self.values = values
+
+    @staticmethod
+    def keyed_values(derivation: Derivation, table: pd.DataFrame, table_key: str) -> pd.DataFrame:
+        """
+        Evaluate derivation over (a chunk of) its own table, indexed by that table's participant
+        column table_key; rows without a participant are dropped
+        """
+        values = pd.DataFrame(evaluate_slots(derivation, table), index=table.index)
+        keys = table[table_key]
+        values = values[keys.notna().to_numpy()]
+        values.index = pd.Index(keys.dropna().to_numpy(), name=table_key)
+        return values
+
+    def lookup(self, table: pd.DataFrame) -> Dict[str, pd.Series]:
+        """{nested slot: values} for the rows of the parent's table"""
+        if self.key_column in table.columns:
+            keys = table[self.key_column].to_numpy()
+        else:
+            keys = np.full(len(table), None, dtype=object)
+        found = self.values.reindex(keys)
+        found.index = table.index
+        return {name: found[name] for name in found.columns}
+
+
+def evaluate_slot(slot: SlotDerivation, table: pd.DataFrame,
+                  joins: Optional[Dict[Derivation, Optional[TableJoin]]] = None) -> Dict[str, pd.Series]:
+    """
+    Evaluate one slot over all rows of its table. Returns {output column: values}; nested
+    object derivations contribute one column per nested slot, named '<slot>.<nested slot>'.
+    Nested derivations in joins are looked up from their own table instead, or left out if
+    their join is None.
+    """
+    index = table.index
+    if slot.objects:
+        columns = {}
+        for derivation in slot.objects:
+            if joins and derivation in joins:
+                join = joins[derivation]
+                if join is None:
+                    continue
+                nested = join.lookup(table)
+            else:
+                nested = evaluate_slots(derivation, table, joins)
+            for name, values in nested.items():
+                columns[f"{slot.name}.{name}"] = values
+        return columns
+
+    if slot.expr is not None:
+        try:
+            values = compile_expr(str(slot.expr)).evaluate(table)
+        except ExprError as e:
+            print(f"Warning: cannot compile expr for {slot.name}; left empty ({e})")
+            values = constant_column(None, index)
+    elif slot.populated_from is not None:
+        if slot.populated_from not in table.columns:
+            values = constant_column(None, index)
+        else:
+            values = table[slot.populated_from]
+        if slot.value_mappings is not None:
+            if slot.name == VISIT_SLOT:
+                values = categorical_map(values, slot.mapping_key)
+            else:
+                values = values.map(slot.value_mappings)
+    elif slot.has_value:
+        if slot.name == VISIT_SLOT and slot.value is not None:
+            values = categorical_constant(slot.value, index)
+        else:
+            values = constant_column(slot.value, index)
+    else:
+        values = constant_column(None, index)
+
+    if slot.unit_conversion is not None:
+        engine = default_engine()
+        conversion = engine.conversion(*slot.unit_conversion)
+        if conversion is None:
+            print(f"Warning: cannot convert {slot.name}: {engine.why_not(*slot.unit_conversion)}")
+            values = constant_column(np.nan, index)
+        else:
+            values = conversion.apply(coerce_numeric(values))
+    elif slot.name in NUMERIC_SLOTS:
+        values = coerce_numeric(values)
+
+    return {slot.name: values}
+
+
+def evaluate_slots(derivation: Derivation, table: pd.DataFrame,
+                   joins: Optional[Dict[Derivation, Optional[TableJoin]]] = None) -> Dict[str, pd.Series]:
+    columns = {}
+    for slot in derivation.slots:
+        columns.update(evaluate_slot(slot, table, joins))
+    return columns
+
+
+def row_dependent_columns(derivation: Derivation, prefix: str = '') -> List[str]:
+    """Output columns whose values vary by row (read from the table), excluding context slots"""
+    columns = []
+    for slot in derivation.slots:
+        if not prefix and slot.name in CONTEXT_SLOTS:
+            continue
+        if slot.objects:
+            for nested in slot.objects:
+                columns.extend(row_dependent_columns(nested, f"{prefix}{slot.name}."))
+        elif slot.populated_from is not None or (slot.expr is not None and PHV_REF_RE.search(str(slot.expr))):
+            columns.append(prefix + slot.name)
+    return columns
+
+
+def evaluate_derivation(derivation: Derivation, table: pd.DataFrame, reset_index: bool = True,
+                        joins: Optional[Dict[Derivation, Optional[TableJoin]]] = None) -> pd.DataFrame:
+    """
+    Evaluate a derivation against its table, returning one flattened record per row.
+    Rows with no participant, and rows where every slot that reads the table is empty
+    (e.g. a code with no value mapping), produce no record. With reset_index=False the
+    records keep the index of the table rows they came from. joins gives the values of nested
+    derivations that read other tables (see ingest_executor.planner.join_nested).
+    """
+    frame = pd.DataFrame(evaluate_slots(derivation, table, joins), index=table.index)
+
+    keep = pd.Series(True, index=table.index)
+    if 'associated_participant' in frame.columns:
+        keep &= frame['associated_participant'].notna()
+    # nested objects left out of joins have no columns
+    data_columns = [column for column in row_dependent_columns(derivation) if column in frame.columns]
+    if data_columns:
+        keep &= frame[data_columns].notna().any(axis=1)
+    frame = frame[keep]
+    return frame.reset_index(drop=True) if reset_index else frame
+
+
+def iter_records(class_name: str, frame: pd.DataFrame) -> Iterator[Dict[str, Any]]:
+    """
+    Nested record dicts for a frame produced by evaluate_derivation: 'value_quantity.unit'
+    columns become {'value_quantity': {'unit': ...}} and empty values are left out.
+    """
+    paths = [column.split('.') for column in frame.columns]
+    # tolist() hands back plain Python values, column by column
+    columns = [frame[column].tolist() for column in frame.columns]
+    for row in zip(*columns):
+        record = {}
+        for path, value in zip(paths, row):
+            # value != value catches NaN
+            if value is None or value is pd.NA or value != value:
+                continue
+            if len(path) == 1:
+                record[path[0]] = value
+            else:
+                target = record
+                for parent in path[:-1]:
+                    target = target.setdefault(parent, {})
+                target[path[-1]] = value
+        record['type'] = class_name
+        yield record
+
+
+def _json_values(values: List[Any]) -> List[str]:
+    """json.dumps of each value, using the encoder's own string and number formatting for whole lists at once"""
+    kinds = set(map(type, values))
+    if kinds == {str}:
+        return list(map(encode_basestring_ascii, values))
+    if kinds == {float} and all(map(math.isfinite, values)):
+        return list(map(float.__repr__, values))
+    if kinds == {int}:
+        return list(map(int.__repr__, values))
+    return [json.dumps(value) for value in values]
+
+
+def _json_fragments(key: str, values: pd.Series) -> List[str]:
+    """`"key": value` per row as JSON text, '' where the value is empty; each distinct value is encoded once"""
+    prefix = json.dumps(key) + ': '
+    try:
+        codes, uniques = pd.factorize(values)
+    except TypeError:
+        # unhashable values (e.g. a `value: {ratio}` slot, which YAML reads as a dict) are encoded row by row
+        return ['' if value is None or value is pd.NA or value != value else prefix + json.dumps(value)
+                for value in values.tolist()]
+    # code -1 (empty) picks the trailing ''
+    fragments = np.asarray([prefix + text for text in _json_values(uniques.tolist())] + [''], dtype=object)
+    return fragments[codes].tolist()
+
+
+def _object_members(paths: List[Tuple[List[str], pd.Series]]) -> List[List[str]]:
+    """
+    Member fragments of one JSON object per row, a list per key in first-seen order, from
+    (path, column) pairs relative to the object
+    """
+    groups: Dict[str, List[Tuple[List[str], pd.Series]]] = {}
+    for path, values in paths:
+        groups.setdefault(path[0], []).append((path[1:], values))
+    parts = []
+    for key, members in groups.items():
+        if len(members) == 1 and not members[0][0]:
+            parts.append(_json_fragments(key, members[0][1]))
+            continue
+        prefix = json.dumps(key) + ': {'
+        inner = _object_members([(path, values) for path, values in members if path])
+        bodies = (', '.join(filter(None, row)) for row in zip(*inner))
+        parts.append([prefix + body + '}' if body else '' for body in bodies])
+    return parts
+
+
+def json_lines(class_name: str, frame: pd.DataFrame) -> List[str]:
+    """
+    The records of iter_records as JSON text, one line each, built a column at a time rather than
+    through a dict per row. Gives the same text as json.dumps(record).
+    """
+    if frame.empty:
+        return []
+    parts = _object_members([(column.split('.'), frame[column]) for column in frame.columns])
+    parts.append(['"type": ' + json.dumps(class_name)] * len(frame))
+    return ['{' + ', '.join(filter(None, row)) + '}' for row in zip(*parts)]
+
+
+def run_derivations(derivations: List[Derivation], store: TableStore) -> Iterator[Tuple[Derivation, pd.DataFrame]]:
+    """Evaluate derivations in order, yielding (derivation, records frame); missing tables are skipped"""
+    for derivation in derivations:
+        table = store.load(derivation.table, derivation.phvs())
+        if table is None:
+            print(f"Warning: no table for {derivation.table}; skipping {derivation}")
+            continue
+        yield derivation, evaluate_derivation(derivation, table)
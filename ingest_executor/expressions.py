@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+Compiler for the `expr:` strings in the *-ingest specs.
+
+Each expression is parsed once and compiled into a function that evaluates it over whole
+columns with NumPy, instead of once per row. Supported syntax is the subset the specs use:
+
+- `{phv00012345}` column references
+- numbers, quoted strings ('...', "...", '''...'''), True, False, None/NULL
+- arithmetic (+ - * /), comparisons (== != < <= > >=), and/or/not, `a if cond else b`
+- `case((cond, value), ...)`, compiled to a select over the conditions; no match gives None
+- `str(x)`
+
+Bare names such as `Y` or `ABSENT` are read as the text they spell, which is how the specs use
+them (`{phv00400917} == N`). An expression wrapped as `{expr: ...}` is unwrapped.
+
+Following LinkML-Map, an expression is None for any row where one of its referenced variables is
+empty. Ordered comparisons and arithmetic read the referenced columns as numbers; `==`/`!=` compare
+as numbers when the other side is a number and as text otherwise.
+
+Compiled expressions are cached by source text. Compilation works on a template in which the
+references are numbered by first appearance, so `case(({phv00226329} == 1, 'RxCUI:1191'))` and the
+same pattern over a different phv share one compiled program.
+"""
+
+import operator
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class ExprError(ValueError):
+    """An expr string that cannot be parsed or compiled"""
+
+
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>'''.*?'''|"[^"]*"|'[^']*')
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<ref>\{[A-Za-z_]\w*\})
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op>==|!=|<=|>=|[<>+\-*/(),])
+""", re.VERBOSE | re.DOTALL)
+
+WRAPPED_EXPR_RE = re.compile(r'^\s*\{\s*expr\s*:(.*)\}\s*$', re.DOTALL)
+
+CONSTANT_NAMES = {'True': True, 'False': False, 'None': None, 'NULL': None}
+KEYWORDS = {'and', 'or', 'not', 'if', 'else'}
+
+COMPARISONS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+# Result kinds of compiled nodes
+REF = 'ref'        # a referenced column, as read from the table (text)
+NUMBER = 'number'
+TEXT = 'text'
+BOOL = 'bool'
+ANY = 'any'        # mixed or unknown, held in object arrays
+
+
+def tokenize(source: str) -> List[Tuple[str, str]]:
+    """Split an expression into (kind, text) tokens"""
+    match = WRAPPED_EXPR_RE.match(source)
+    if match:
+        source = match.group(1)
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = TOKEN_RE.match(source, position)
+        if match is None:
+            raise ExprError(f"unexpected {source[position:position + 20]!r} in {source!r}")
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        text = match.group()
+        if kind == 'name' and text in KEYWORDS:
+            kind = 'op'
+        tokens.append((kind, text))
+    return tokens
+
+
+class ColumnEnv:
+    """The referenced columns of one table, converted to arrays on first use"""
+
+    def __init__(self, table: pd.DataFrame, refs: Tuple[str, ...]):
+        self.table = table
+        self.refs = refs
+        self.size = len(table)
+        self._text = {}
+        self._number = {}
+
+    def text(self, i: int) -> np.ndarray:
+        if i not in self._text:
+            name = self.refs[i]
+            if name in self.table.columns:
+                self._text[i] = self.table[name].to_numpy(dtype=object)
+            else:
+                self._text[i] = np.full(self.size, None, dtype=object)
+        return self._text[i]
+
+    def number(self, i: int) -> np.ndarray:
+        if i not in self._number:
+            values = pd.to_numeric(pd.Series(self.text(i)), errors='coerce')
+            self._number[i] = values.to_numpy(dtype=float, na_value=np.nan)
+        return self._number[i]
+
+    def isna(self, i: int) -> np.ndarray:
+        return pd.isna(self.text(i))
+
+
+class Node:
+    """
+    A compiled subexpression: `fn(env)` computes it over a ColumnEnv. Nodes that reference no
+    columns are folded to `value` at compile time.
+    """
+
+    def __init__(self, kind: str, fn: Optional[Callable[[ColumnEnv], Any]] = None,
+                 refs: frozenset = frozenset(), value: Any = None):
+        self.kind = kind
+        self.refs = refs
+        if fn is not None and not refs:
+            value = _scalar(fn(None))
+            fn = None
+        self.fn = fn
+        self.value = value
+
+    @property
+    def is_constant(self) -> bool:
+        return self.fn is None
+
+    def __call__(self, env: ColumnEnv) -> Any:
+        return self.value if self.fn is None else self.fn(env)
+
+
+def _scalar(value: Any) -> Any:
+    # numpy scalars from folded operations back to plain Python values
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def constant(value: Any) -> Node:
+    if value is None:
+        kind = ANY
+    elif isinstance(value, bool):
+        kind = BOOL
+    elif isinstance(value, (int, float)):
+        kind = NUMBER
+    else:
+        kind = TEXT
+    return Node(kind, value=value)
+
+
+def as_number(node: Node) -> Callable[[ColumnEnv], Any]:
+    """Evaluator for a node read as numbers"""
+    if node.kind == REF:
+        (index,) = node.refs
+        return lambda env: env.number(index)
+    if node.is_constant:
+        value = node.value
+        if value is None or isinstance(value, (int, float)):
+            value = np.nan if value is None else value
+        else:
+            value = pd.to_numeric(value, errors='coerce')
+        return lambda env: value
+    if node.kind in (TEXT, ANY):
+        return lambda env: pd.to_numeric(pd.Series(node(env), dtype=object), errors='coerce').to_numpy(dtype=float)
+    return node
+
+
+def as_text(node: Node) -> Callable[[ColumnEnv], Any]:
+    """Evaluator for a node read as text"""
+    if node.is_constant:
+        value = None if node.value is None else str(node.value)
+        return lambda env: value
+    if node.kind in (REF, TEXT):
+        return node
+    return lambda env: pd.Series(node(env)).map(str, na_action='ignore').to_numpy(dtype=object)
+
+
+def compile_comparison(op: str, left: Node, right: Node) -> Node:
+    refs = left.refs | right.refs
+    compare = COMPARISONS[op]
+    if op in ('==', '!=') and (_is_none(left) or _is_none(right)):
+        other = right if _is_none(left) else left
+        if other.is_constant:
+            return constant(compare(other.value, None))
+        missing = lambda env: pd.isna(other(env))
+        return Node(BOOL, missing if op == '==' else (lambda env: ~missing(env)), refs)
+    if op in ('==', '!=') and NUMBER not in (left.kind, right.kind):
+        lhs, rhs = as_text(left), as_text(right)
+    else:
+        lhs, rhs = as_number(left), as_number(right)
+    return Node(BOOL, lambda env: compare(lhs(env), rhs(env)), refs)
+
+
+def _is_none(node: Node) -> bool:
+    return node.is_constant and node.value is None
+
+
+def _divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.true_divide(numerator, denominator)
+    # division by zero is an error in LinkML-Map; leave the value empty
+    return np.where(np.isinf(result), np.nan, result)
+
+
+def _concat(left, right):
+    if np.ndim(left) == 0 and np.ndim(right) == 0:
+        return None if left is None or right is None else left + right
+    # object Series addition leaves rows with a missing side empty
+    lhs = left if np.ndim(left) == 0 else pd.Series(left, dtype=object)
+    rhs = right if np.ndim(right) == 0 else pd.Series(right, dtype=object)
+    return np.asarray(lhs + rhs, dtype=object)
+
+
+def compile_arithmetic(op: str, left: Node, right: Node) -> Node:
+    refs = left.refs | right.refs
+    if op == '+' and TEXT in (left.kind, right.kind):
+        lhs, rhs = as_text(left), as_text(right)
+        return Node(TEXT, lambda env: _concat(lhs(env), rhs(env)), refs)
+    lhs, rhs = as_number(left), as_number(right)
+    if op == '/':
+        return Node(NUMBER, lambda env: _divide(lhs(env), rhs(env)), refs)
+    function = {'+': operator.add, '-': operator.sub, '*': operator.mul}[op]
+    return Node(NUMBER, lambda env: function(lhs(env), rhs(env)), refs)
+
+
+def compile_logical(op: str, left: Node, right: Node) -> Node:
+    function = operator.and_ if op == 'and' else operator.or_
+    return Node(BOOL, lambda env: function(_truth(left, env), _truth(right, env)), left.refs | right.refs)
+
+
+def _truth(node: Node, env: ColumnEnv):
+    value = node(env)
+    if node.kind == BOOL:
+        return value
+    if np.ndim(value) == 0:
+        return bool(value) and value == value
+    return pd.Series(value).fillna(False).astype(bool).to_numpy()
+
+
+def compile_select(branches: List[Tuple[Node, Node]]) -> Node:
+    """case((cond, value), ...) and `a if cond else b`: the first true condition picks the value"""
+    # conditions known to be false at compile time drop out; one known to be true ends the list
+    live = []
+    for condition, choice in branches:
+        if condition.is_constant:
+            if not condition.value:
+                continue
+            if not live:
+                return choice
+            live.append((None, choice))
+            break
+        live.append((condition, choice))
+    if not live:
+        return constant(None)
+
+    default = constant(None)
+    if live[-1][0] is None:
+        default = live.pop()[1]
+    choices = [choice for _, choice in live] + [default]
+    # a choice that passes a column through (`({phv} > 0, {phv})`) is read as a number alongside numbers
+    numeric = (any(choice.kind == NUMBER for choice in choices)
+               and all(choice.kind in (NUMBER, REF) or _is_none(choice) for choice in choices))
+    refs = frozenset().union(*(c.refs for c, _ in live), *(c.refs for c in choices))
+
+    if numeric:
+        evaluators = [as_number(choice) for choice in choices]
+        dtype = float
+    else:
+        evaluators = [_as_object(choice) for choice in choices]
+        dtype = object
+    conditions = [condition for condition, _ in live]
+
+    def select(env: ColumnEnv) -> np.ndarray:
+        condlist = [np.broadcast_to(_truth(condition, env), env.size) for condition in conditions]
+        values = [np.broadcast_to(np.asarray(evaluate(env), dtype=dtype), env.size) for evaluate in evaluators]
+        return np.select(condlist, values[:-1], default=values[-1])
+
+    return Node(NUMBER if numeric else ANY, select, refs)
+
+
+def _as_object(node: Node) -> Callable[[ColumnEnv], Any]:
+    if node.is_constant:
+        value = np.empty((), dtype=object)
+        value[()] = node.value
+        return lambda env: value
+    if node.kind == NUMBER:
+        return lambda env: _number_objects(node(env))
+    return node
+
+
+def _number_objects(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=object)
+    values[pd.isna(values)] = None
+    return values
+
+
+class Parser:
+    """Recursive-descent parser over a token template, building compiled Nodes"""
+
+    def __init__(self, tokens: Tuple[Tuple[str, str], ...]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][1]
+        return None
+
+    def take(self, expected: Optional[str] = None) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise ExprError('unexpected end of expression')
+        token = self.tokens[self.position]
+        if expected is not None and token[1] != expected:
+            raise ExprError(f"expected {expected!r}, found {token[1]!r}")
+        self.position += 1
+        return token
+
+    def parse(self) -> Node:
+        node = self.expression()
+        if self.position != len(self.tokens):
+            raise ExprError(f"unexpected {self.tokens[self.position][1]!r}")
+        return node
+
+    def expression(self) -> Node:
+        node = self.disjunction()
+        if self.peek() == 'if':
+            self.take()
+            condition = self.disjunction()
+            self.take('else')
+            otherwise = self.expression()
+            node = compile_select([(condition, node), (constant(True), otherwise)])
+        return node
+
+    def disjunction(self) -> Node:
+        node = self.conjunction()
+        while self.peek() == 'or':
+            self.take()
+            node = compile_logical('or', node, self.conjunction())
+        return node
+
+    def conjunction(self) -> Node:
+        node = self.negation()
+        while self.peek() == 'and':
+            self.take()
+            node = compile_logical('and', node, self.negation())
+        return node
+
+    def negation(self) -> Node:
+        if self.peek() == 'not':
+            self.take()
+            operand = self.negation()
+            return Node(BOOL, lambda env: ~np.asarray(_truth(operand, env), dtype=bool), operand.refs)
+        return self.comparison()
+
+    def comparison(self) -> Node:
+        node = self.sum()
+        while self.peek() in COMPARISONS:
+            op = self.take()[1]
+            node = compile_comparison(op, node, self.sum())
+        return node
+
+    def sum(self) -> Node:
+        node = self.product()
+        while self.peek() in ('+', '-'):
+            op = self.take()[1]
+            node = compile_arithmetic(op, node, self.product())
+        return node
+
+    def product(self) -> Node:
+        node = self.unary()
+        while self.peek() in ('*', '/'):
+            op = self.take()[1]
+            node = compile_arithmetic(op, node, self.unary())
+        return node
+
+    def unary(self) -> Node:
+        if self.peek() == '-':
+            self.take()
+            operand = self.unary()
+            number = as_number(operand)
+            return Node(NUMBER, lambda env: -number(env), operand.refs)
+        return self.atom()
+
+    def atom(self) -> Node:
+        kind, text = self.take()
+        if kind == 'number':
+            return constant(int(text) if text.isdigit() else float(text))
+        if kind == 'string':
+            quote = 3 if text.startswith(("'''", '"""')) else 1
+            return constant(text[quote:-quote])
+        if kind == 'ref':
+            return Node(REF, lambda env, index=int(text[1:-1]): env.text(index), frozenset([int(text[1:-1])]))
+        if kind == 'name':
+            if self.peek() == '(':
+                return self.call(text)
+            if text in CONSTANT_NAMES:
+                return constant(CONSTANT_NAMES[text])
+            return constant(text)
+        if text == '(':
+            node = self.expression()
+            self.take(')')
+            return node
+        raise ExprError(f"unexpected {text!r}")
+
+    def call(self, name: str) -> Node:
+        self.take('(')
+        if name == 'case':
+            branches = []
+            while True:
+                self.take('(')
+                condition = self.expression()
+                self.take(',')
+                value = self.expression()
+                self.take(')')
+                branches.append((condition, value))
+                if self.peek() == ',':
+                    self.take()
+                    if self.peek() == ')':
+                        break
+                    continue
+                break
+            self.take(')')
+            return compile_select(branches)
+        if name == 'str':
+            argument = self.expression()
+            self.take(')')
+            return Node(TEXT, as_text(argument), argument.refs)
+        raise ExprError(f"unsupported function {name}()")
+
+
+class CompiledExpr:
+    """A compiled expression bound to its referenced variables"""
+
+    def __init__(self, source: str, refs: Tuple[str, ...], program: Node):
+        self.source = source
+        self.refs = refs
+        self.program = program
+
+    def evaluate(self, table: pd.DataFrame) -> pd.Series:
+        """Evaluate over every row of a table; rows with an empty referenced variable give None"""
+        index = table.index
+        if self.program.is_constant:
+            return pd.Series([self.program.value] * len(index), index=index, dtype=object)
+        env = ColumnEnv(table, self.refs)
+        values = self.program(env)
+        if self.program.kind == REF:
+            values = np.array(values, dtype=object)
+        values = np.broadcast_to(values, env.size)
+        if self.refs:
+            missing = np.zeros(env.size, dtype=bool)
+            for i in range(len(self.refs)):
+                missing |= env.isna(i)
+            if missing.any():
+                values = np.where(missing, np.nan if values.dtype == float else None, values)
+        if values.dtype == bool:
+            values = values.astype(object)
+        return pd.Series(values, index=index)
+
+
+@lru_cache(maxsize=None)
+def _compile_template(template: Tuple[Tuple[str, str], ...]) -> Node:
+    return Parser(template).parse()
+
+
+@lru_cache(maxsize=None)
+def compile_expr(source: str) -> CompiledExpr:
+    """Compile an expr string (cached by source text); raises ExprError if it is not supported"""
+    refs = []
+    template = []
+    for kind, text in tokenize(str(source)):
+        if kind == 'ref':
+            name = text[1:-1]
+            if name not in refs:
+                refs.append(name)
+            text = '{%d}' % refs.index(name)
+        template.append((kind, text))
+    return CompiledExpr(str(source), tuple(refs), _compile_template(tuple(template)))
+
+
+def expr_cache_info() -> Dict[str, Any]:
+    """Hit/miss counts of the source and template caches"""
+    return {'sources': compile_expr.cache_info(), 'templates': _compile_template.cache_info()}
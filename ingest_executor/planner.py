@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Plans a cohort run so each source table is read once.
+
+The *-ingest specs are one file per variable, and many of them read the same pht (every FHS
+`bdy_wgt.yaml` block reads pht000031 or pht006026, and so do dozens of other files). The planner
+collects the derivations of all the specs, groups them by their `populated_from` table, and
+works out the union of phv columns each table needs. Executing the plan reads each table once,
+only those columns, evaluates every derivation that uses it, and then drops it.
+
+With a chunk size, each table is instead streamed through its derivations that many rows at a
+time, so memory is bounded by the chunk rather than the table. Either way, the rows read, time
+taken and peak resident memory are recorded per table.
+
+A nested object derivation may read another table than its parent (a Quantity whose value is in
+another exam table). Its values are joined by participant: that table is read first (streamed in
+chunks too, with a chunk size), only the columns it needs, and looked up by the participant of
+each of the parent's rows. A joined table is read once per plan that joins it, on top of its own
+plan's read; TableStats reports those rows separately.
+"""
+
+import copy
+import csv
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from ingest_executor.executor import Derivation, TableJoin, TableStore, evaluate_derivation, load_spec
+from ingest_executor.sinks import cohort_of
+from ingest_executor.temporal import VisitAgeIndex
+
+# cohort -> table of each pht's participant ID phv, as curated for the BDCHM mapping (only FHS has one)
+CONTEXTUAL_VARIABLES = {
+    'FHS': (Path(__file__).resolve().parent.parent / 'priority_variables_transform' / 'batch_converting'
+            / 'fhs_conditions' / 'BDCHMVariableMappingContextualVariablesV2.csv'),
+}
+
+
+class NestedJoin:
+    """A nested object derivation that reads another table than its parent, looked up by participant"""
+
+    def __init__(self, parent: Derivation, slot: str, derivation: Derivation, key_column: str,
+                 table_keys: List[str]):
+        self.parent = parent
+        self.slot = slot
+        self.derivation = derivation
+        self.table = derivation.table
+        # the parent's participant column, and the candidates for the other table's (most used first)
+        self.key_column = key_column
+        self.table_keys = table_keys
+
+    @property
+    def columns(self) -> Set[str]:
+        """Columns to read from the other table"""
+        return set(self.table_keys) | self.derivation.phvs()
+
+    def __repr__(self):
+        return f"<NestedJoin {self.slot} of {self.parent} from {self.table}>"
+
+
+class TablePlan:
+    """One source table, the columns it must provide and the derivations computed from it"""
+
+    def __init__(self, table: str):
+        self.table = table
+        self.columns: Set[str] = set()
+        self.derivations: List[Derivation] = []
+        self.joins: List[NestedJoin] = []
+
+    def add(self, derivation: Derivation, joins: Iterable[NestedJoin] = ()):
+        self.derivations.append(derivation)
+        joins = list(joins)
+        self.joins.extend(joins)
+        self.columns.update(_phvs(derivation, {join.derivation for join in joins}))
+
+    @property
+    def sources(self) -> List[str]:
+        return sorted({derivation.source for derivation in self.derivations if derivation.source})
+
+
+def _phvs(derivation: Derivation, joined: Set[Derivation]) -> Set[str]:
+    """Columns a derivation reads from its own table: all of them but those of joined nested derivations"""
+    phvs = set()
+    for slot in derivation.slots:
+        if not slot.objects:
+            phvs.update(slot.phvs())
+        for nested in slot.objects:
+            if nested not in joined:
+                phvs.update(_phvs(nested, joined))
+    return phvs
+
+
+def find_specs(paths: Iterable[Path]) -> List[Path]:
+    """Spec files from a mix of files and directories (e.g. priority_variables_transform/FHS-ingest)"""
+    specs = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            specs.extend(sorted(path.rglob('*.yaml')))
+        else:
+            specs.append(path)
+    return specs
+
+
+def contextual_participant_columns(csv_file: Path) -> Dict[str, str]:
+    """{pht: participant ID phv} from the contextual variables table (first row per pht)"""
+    columns = {}
+    try:
+        with open(csv_file, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                pht = (row.get('data table pht') or '').strip()
+                phv = (row.get('participant ID phv') or '').strip()
+                if pht and phv:
+                    columns.setdefault(pht, phv)
+    except OSError as e:
+        print(f"Warning: cannot read {csv_file}: {e}")
+    return columns
+
+
+def participant_columns(derivations: Iterable[Derivation],
+                        contextual: Optional[Dict[str, Path]] = None) -> Dict[str, List[str]]:
+    """
+    {table: candidates for its participant column}: those its derivations read
+    associated_participant from, most used first, led by the column from the contextual variables
+    table of the derivations' cohort (CONTEXTUAL_VARIABLES by default) where it has one. A cohort's
+    contextual table only applies to the tables its own derivations read. Some specs disagree on a
+    table's participant column, so all of them are candidates.
+    """
+    if contextual is None:
+        contextual = CONTEXTUAL_VARIABLES
+    counts: Dict[str, Dict[str, int]] = {}
+    cohort_tables: Dict[str, Set[str]] = {}
+    for derivation in derivations:
+        cohort_tables.setdefault(cohort_of(derivation), set()).update(derivation.phts())
+        for slot in derivation.slots:
+            if slot.name == 'associated_participant' and isinstance(slot.populated_from, str):
+                table_counts = counts.setdefault(derivation.table, {})
+                table_counts[slot.populated_from] = table_counts.get(slot.populated_from, 0) + 1
+    columns = {table: sorted(table_counts, key=lambda column: (-table_counts[column], column))
+               for table, table_counts in counts.items()}
+    for cohort, tables in cohort_tables.items():
+        if cohort not in contextual:
+            continue
+        for table, column in contextual_participant_columns(contextual[cohort]).items():
+            if table in tables:
+                columns[table] = [column] + [other for other in columns.get(table, []) if other != column]
+    return columns
+
+
+def _participant_column(derivation: Derivation) -> Optional[str]:
+    for slot in derivation.slots:
+        if slot.name == 'associated_participant' and isinstance(slot.populated_from, str):
+            return slot.populated_from
+    return None
+
+
+def join_nested(derivation: Derivation, table_keys: Dict[str, List[str]],
+                allow_drop: bool = False) -> Tuple[Derivation, List[NestedJoin]]:
+    """
+    The derivation and the joins for its nested object derivations that read another table than
+    its own. Such a derivation can't be evaluated against the parent's rows, which belong to
+    other participants or visits, so its values are looked up by participant instead (as
+    ingest_executor.assemble joins its pieces). A join needs the parent's associated_participant
+    and a participant column for the other table (see participant_columns); without them a
+    ValueError names the derivation, or with allow_drop the nested object is reported and left out.
+    """
+    key_column = _participant_column(derivation)
+    joins = []
+    problems = []
+
+    def resolve(node: Derivation) -> Derivation:
+        slots = []
+        for slot in node.slots:
+            objects = []
+            for nested in slot.objects:
+                if not nested.table or nested.table == derivation.table:
+                    objects.append(resolve(nested))
+                    continue
+                if key_column is None:
+                    problem = 'the parent has no associated_participant column to join on'
+                elif nested.table not in table_keys:
+                    cohort = cohort_of(derivation)
+                    if cohort in CONTEXTUAL_VARIABLES:
+                        problem = f"neither the specs nor {CONTEXTUAL_VARIABLES[cohort].name} give its participant column"
+                    else:
+                        problem = (f"the specs don't give its participant column, and {cohort} has no contextual "
+                                   f"variables table")
+                elif nested.phts() != {nested.table}:
+                    problem = f"it reads {', '.join(sorted(nested.phts() - {nested.table}))} as well"
+                else:
+                    joins.append(NestedJoin(derivation, slot.name, nested, key_column, table_keys[nested.table]))
+                    objects.append(nested)
+                    continue
+                message = f"{slot.name} of {derivation} reads {nested.table}, not {derivation.table}, and {problem}"
+                if not allow_drop:
+                    problems.append(message)
+                    objects.append(nested)
+                    continue
+                print(f"Warning: {message}; skipping its {nested.class_name}")
+            if slot.objects and not objects:
+                continue
+            if objects != slot.objects:
+                slot = copy.copy(slot)
+                slot.objects = objects
+            slots.append(slot)
+        if slots == node.slots:
+            return node
+        return Derivation(node.class_name, node.table, slots, node.source, node.position)
+
+    resolved = resolve(derivation)
+    if problems:
+        raise ValueError('; '.join(problems))
+    return resolved, joins
+
+
+def plan_derivations(derivations: Iterable[Derivation], allow_drop: bool = False) -> List[TablePlan]:
+    """
+    Group derivations by source table, in order of each table's first use. Nested object
+    derivations reading another table are joined by participant (see join_nested); a ValueError
+    lists those that can't be, unless allow_drop.
+    """
+    derivations = list(derivations)
+    table_keys = participant_columns(derivations)
+    plans = {}
+    problems = []
+    for derivation in derivations:
+        try:
+            derivation, joins = join_nested(derivation, table_keys, allow_drop)
+        except ValueError as e:
+            problems.append(str(e))
+            continue
+        plan = plans.get(derivation.table)
+        if plan is None:
+            plan = plans[derivation.table] = TablePlan(derivation.table)
+        plan.add(derivation, joins)
+    if problems:
+        raise ValueError(f"{len(problems)} nested object derivation(s) read another table and can't be joined "
+                         f"(--allow-drop leaves them out):\n  " + '\n  '.join(problems))
+    return list(plans.values())
+
+
+def plan_specs(spec_files: Iterable[Path], allow_drop: bool = False) -> List[TablePlan]:
+    """Plan every derivation of the given spec files; files that fail to load are reported and skipped"""
+    derivations = []
+    for spec_file in spec_files:
+        try:
+            derivations.extend(load_spec(spec_file))
+        except Exception as e:
+            print(f"Warning: cannot load {spec_file}: {e}")
+    return plan_derivations(derivations, allow_drop)
+
+
+def describe_plan(plans: List[TablePlan]) -> str:
+    """One line per table: derivation, spec file and column counts"""
+    lines = []
+    for plan in plans:
+        joined = sorted({join.table for join in plan.joins})
+        lines.append(f"{plan.table}: {len(plan.derivations)} derivation(s) from "
+                     f"{len(plan.sources)} spec file(s), {len(plan.columns)} column(s)"
+                     + (f", joins {', '.join(joined)}" if joined else ''))
+    total = sum(len(plan.derivations) for plan in plans)
+    lines.append(f"{len(plans)} table(s), {total} derivation(s)")
+    return '\n'.join(lines)
+
+
+def current_rss_mb() -> float:
+    """Resident memory of this process in MiB (the peak so far where the current value isn't available)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class TableStats:
+    """What executing one table's plan cost"""
+
+    def __init__(self, table: str):
+        self.table = table
+        self.rows = 0
+        self.chunks = 0
+        # rows read from the tables its nested derivations join (see join_tables)
+        self.join_rows = 0
+        self.records = 0
+        self.seconds = 0.0
+        self.peak_rss_mb = 0.0
+        # spec file -> [seconds evaluating its derivations, records]
+        self.by_source: Dict[str, List[float]] = {}
+
+    def sample_memory(self):
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+
+    def __str__(self):
+        joined = f" (+{self.join_rows} joined)" if self.join_rows else ''
+        return (f"{self.table}: {self.rows} rows{joined} in {self.chunks} chunk(s), {self.records} records, "
+                f"{self.seconds:.2f}s, peak RSS {self.peak_rss_mb:.0f} MiB")
+
+
+def join_tables(plan: TablePlan, store: TableStore, allow_drop: bool = False, chunk_size: Optional[int] = None,
+                table_stats: Optional[TableStats] = None) -> Dict[Derivation, Optional[TableJoin]]:
+    """
+    Read the other tables a plan's nested derivations join (only the columns they need) and
+    evaluate those derivations, keeping the first row of each participant. With chunk_size a
+    table is streamed that many rows at a time, so only the joined values (one row per
+    participant) are held, not the table. Each table is read once for all of the plan's joins
+    with it, but again for every other plan that joins it and for its own plan; table_stats
+    counts those rows as join_rows. A ValueError if a table or its participant column is
+    missing, unless allow_drop, when the nested objects are reported and left out (None).
+    """
+    joins = {}
+    for table in sorted({join.table for join in plan.joins}):
+        exists = store.table_file(table) is not None
+        header = set(store.read_header(table)) if exists else set()
+        # join -> the joined table's participant column
+        keyed = {}
+        for join in plan.joins:
+            if join.table != table:
+                continue
+            table_key = next((column for column in join.table_keys if column in header), None)
+            if table_key is None:
+                problem = (f"it has no participant column ({', '.join(join.table_keys)})" if exists
+                           else 'there is no such table')
+                message = f"cannot join {join.slot} of {join.parent} to {table}: {problem}"
+                if not allow_drop:
+                    raise ValueError(message)
+                print(f"Warning: {message}; skipping its {join.derivation.class_name}")
+                joins[join.derivation] = None
+                continue
+            keyed[join] = table_key
+        if not keyed:
+            continue
+
+        columns = set().union(*(join.columns for join in keyed))
+        if chunk_size:
+            chunks = store.iter_chunks(table, columns, chunk_size)
+        else:
+            chunks = [store.load(table, columns)]
+        pieces = {join: [] for join in keyed}
+        seen = {join: pd.Index([]) for join in keyed}
+        repeated = dict.fromkeys(keyed, 0)
+        for chunk in chunks:
+            if table_stats is not None:
+                table_stats.join_rows += len(chunk)
+                table_stats.sample_memory()
+            for join, table_key in keyed.items():
+                values = TableJoin.keyed_values(join.derivation, chunk, table_key)
+                # participants seen in this chunk or an earlier one keep their first row
+                first = ~values.index.duplicated() & ~values.index.isin(seen[join])
+                repeated[join] += int((~first).sum())
+                values = values[first]
+                seen[join] = seen[join].append(values.index)
+                pieces[join].append(values)
+        chunks = chunk = None
+        for join in keyed:
+            values = pd.concat(pieces[join]) if pieces[join] else pd.DataFrame()
+            joins[join.derivation] = TableJoin(join.key_column, values)
+            if repeated[join]:
+                print(f"Warning: {table} has {repeated[join]} repeated participant row(s); "
+                      f"{join.slot} of {join.parent} uses the first")
+        pieces = seen = None
+        store.release(table)
+    return joins
+
+
+def execute_plan(plans: List[TablePlan], store: TableStore, chunk_size: Optional[int] = None,
+                 stats: Optional[List[TableStats]] = None,
+                 visit_index: Optional[VisitAgeIndex] = None,
+                 allow_drop: bool = False) -> Iterator[Tuple[Derivation, pd.DataFrame]]:
+    """
+    Read each planned table once and yield (derivation, records frame) for all its derivations.
+    With chunk_size, tables are read and yielded chunk_size rows at a time, so a derivation can
+    yield several frames. Per-table TableStats are appended to stats if given. With a
+    visit_index, empty age slots are filled from the cohort's visit ages. Tables joined by
+    nested derivations are read before their parent's (see join_tables).
+    """
+    for plan in plans:
+        table_stats = TableStats(plan.table)
+        start = time.perf_counter()
+        joins = join_tables(plan, store, allow_drop, chunk_size, table_stats) if plan.joins else None
+        if chunk_size:
+            chunks = store.iter_chunks(plan.table, plan.columns, chunk_size)
+        else:
+            table = store.load(plan.table, plan.columns)
+            chunks = None if table is None else [table]
+            table = None
+        if chunks is None:
+            print(f"Warning: no table for {plan.table}; skipping {len(plan.derivations)} derivation(s)")
+            continue
+
+        for chunk in chunks:
+            table_stats.rows += len(chunk)
+            table_stats.chunks += 1
+            table_stats.sample_memory()
+            for derivation in plan.derivations:
+                derivation_start = time.perf_counter()
+                frame = evaluate_derivation(derivation, chunk, joins=joins)
+                if visit_index is not None:
+                    frame = visit_index.fill(derivation, frame)
+                source = table_stats.by_source.setdefault(derivation.source, [0.0, 0])
+                source[0] += time.perf_counter() - derivation_start
+                source[1] += len(frame)
+                table_stats.records += len(frame)
+                table_stats.sample_memory()
+                yield derivation, frame
+            # includes whatever the consumer held on to while writing the chunk's records
+            table_stats.sample_memory()
+        # drop the last chunk before the next table is read
+        chunks = chunk = joins = None
+        store.release(plan.table)
+        table_stats.seconds = time.perf_counter() - start
+        if stats is not None:
+            stats.append(table_stats)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Output sinks for harmonized records.
+
+JsonlSink writes one JSON record per line. ParquetSink writes a Parquet dataset partitioned by
+cohort and entity:
+
+    OUTPUT/cohort=FHS/entity=MeasurementObservation/part-0.parquet
+
+Each entity's schema comes from the plan, the union of the slots its derivations produce, so
+every file for an entity has the same columns. Nested objects such as `value_quantity` (Quantity)
+are struct columns. Concept, visit, unit and other code-like columns are dictionary-encoded and
+read back as categoricals. ParquetSink needs pyarrow.
+"""
+
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from ingest_executor.executor import NUMERIC_SLOTS, Derivation, json_lines
+
+# Slots holding codes from a small vocabulary: concepts, visits, units, enums, statuses
+DICTIONARY_SLOT_RE = re.compile(r'(concept|type|visit|unit|enum|status|provenance|category|sex|race|ethnicity|species'
+                                r'|relationship_to_participant)$')
+
+# Rows buffered per partition before they are written as a row group
+ROW_GROUP_SIZE = 250_000
+
+
+def cohort_of(derivation: Derivation) -> str:
+    """Cohort of a derivation, from its spec directory (priority_variables_transform/FHS-ingest -> FHS)"""
+    if not derivation.source:
+        return 'unknown'
+    name = Path(derivation.source).parent.name
+    return name[:-len('-ingest')] if name.endswith('-ingest') else name
+
+
+def output_columns(derivation: Derivation, prefix: str = '') -> List[str]:
+    """The flattened columns evaluate_derivation produces, with nested slots as 'slot.nested'"""
+    columns = []
+    for slot in derivation.slots:
+        if slot.objects:
+            for nested in slot.objects:
+                columns.extend(output_columns(nested, f"{prefix}{slot.name}."))
+        else:
+            columns.append(prefix + slot.name)
+    return columns
+
+
+class JsonlSink:
+    """Writes records as JSON Lines"""
+
+    def __init__(self, output_file: Path):
+        self.output_file = Path(output_file)
+        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        self.out = open(self.output_file, 'w', encoding='utf-8')
+
+    def write(self, derivation: Derivation, frame: pd.DataFrame):
+        lines = json_lines(derivation.class_name, frame)
+        if lines:
+            self.out.write('\n'.join(lines) + '\n')
+
+    def close(self):
+        self.out.close()
+
+
+def _field_type(column: str, dictionary: bool = True):
+    leaf = column.rsplit('.', 1)[-1]
+    if leaf in NUMERIC_SLOTS:
+        return pa.float64()
+    if dictionary and DICTIONARY_SLOT_RE.search(leaf):
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def _fields(columns: Iterable[str], dictionary: bool) -> List['pa.Field']:
+    # name -> None for a plain column, or the dotted remainders of its nested columns
+    nested = {}
+    for column in columns:
+        name, dot, rest = column.partition('.')
+        if dot:
+            if nested.get(name) is None:
+                nested[name] = []
+            nested[name].append(rest)
+        elif name not in nested:
+            nested[name] = None
+    return [pa.field(name, _field_type(name, dictionary) if children is None
+                     else pa.struct(_fields(children, dictionary)))
+            for name, children in nested.items()]
+
+
+def entity_schema(columns: Iterable[str], dictionary: bool = True) -> 'pa.Schema':
+    """
+    Arrow schema for flattened columns; 'a.b' columns become fields of a struct column 'a', and
+    'a.b.c' fields of a struct 'b' inside it. A slot that is a plain column for one derivation and
+    an object for another is the struct. With dictionary=False code-like columns are plain
+    strings rather than dictionary-encoded.
+    """
+    return pa.schema(_fields(columns, dictionary))
+
+
+def _column_array(values: pd.Series, field_type) -> 'pa.Array':
+    if pa.types.is_dictionary(field_type) and isinstance(values.dtype, pd.CategoricalDtype) \
+            and all(isinstance(label, str) for label in values.cat.categories):
+        # categorical columns (visit labels) already are a dictionary: reuse their codes
+        codes = values.cat.codes.to_numpy()
+        return pa.DictionaryArray.from_arrays(pa.array(codes, type=pa.int32(), mask=codes < 0),
+                                              pa.array(values.cat.categories.to_numpy(dtype=object), type=pa.string()))
+    if pa.types.is_floating(field_type):
+        return pa.array(pd.to_numeric(values, errors='coerce').to_numpy(dtype=float), type=field_type,
+                        from_pandas=True)
+    # expr slots can produce numbers in text slots; store their text
+    text = values.map(lambda value: value if isinstance(value, str) else str(value), na_action='ignore')
+    array = pa.array(text.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+    if pa.types.is_dictionary(field_type):
+        array = array.dictionary_encode()
+    return array
+
+
+def frame_to_table(frame: pd.DataFrame, schema: 'pa.Schema') -> 'pa.Table':
+    """Convert an evaluate_derivation frame to an Arrow table with the entity's schema"""
+    size = len(frame)
+
+    def column(name, field_type):
+        if pa.types.is_struct(field_type):
+            children = [column(f"{name}.{child.name}", child.type) for child in field_type]
+            # the object itself is missing where all of its slots are
+            missing = np.ones(size, dtype=bool)
+            for child in children:
+                missing &= child.is_null().to_numpy(zero_copy_only=False)
+            return pa.StructArray.from_arrays(children, fields=list(field_type), mask=pa.array(missing))
+        if name in frame.columns:
+            return _column_array(frame[name], field_type)
+        return pa.nulls(size, type=field_type)
+
+    return pa.Table.from_arrays([column(field.name, field.type) for field in schema], schema=schema)
+
+
+def entity_schemas(derivations: Iterable[Derivation]) -> Dict[str, 'pa.Schema']:
+    """One schema per entity (class), covering the slots of all its derivations"""
+    if pa is None:
+        raise ImportError('pyarrow is required to write Parquet output (poetry install --extras parquet)')
+    columns = {}
+    for derivation in derivations:
+        entity_columns = columns.setdefault(derivation.class_name, {})
+        entity_columns.update(dict.fromkeys(output_columns(derivation)))
+    return {entity: entity_schema(entity_columns) for entity, entity_columns in columns.items()}
+
+
+class ParquetSink:
+    """
+    Writes records to a Parquet dataset partitioned by cohort and entity. Writers running side by
+    side into the same dataset need different part names.
+    """
+
+    def __init__(self, output_dir: Path, schemas: Dict[str, 'pa.Schema'], part_name: str = 'part-0',
+                 row_group_size: int = ROW_GROUP_SIZE):
+        if pa is None:
+            raise ImportError('pyarrow is required to write Parquet output (poetry install --extras parquet)')
+        self.output_dir = Path(output_dir)
+        self.schemas = schemas
+        self.part_name = part_name
+        self.row_group_size = row_group_size
+        self.buffers: Dict[Tuple[str, str], List['pa.Table']] = {}
+        self.buffered_rows: Dict[Tuple[str, str], int] = {}
+        self.writers: Dict[Tuple[str, str], 'pq.ParquetWriter'] = {}
+
+    def write(self, derivation: Derivation, frame: pd.DataFrame):
+        if frame.empty:
+            return
+        key = (cohort_of(derivation), derivation.class_name)
+        self.buffers.setdefault(key, []).append(frame_to_table(frame, self.schemas[derivation.class_name]))
+        self.buffered_rows[key] = self.buffered_rows.get(key, 0) + len(frame)
+        if self.buffered_rows[key] >= self.row_group_size:
+            self._flush(key)
+
+    def _flush(self, key: Tuple[str, str]):
+        tables = self.buffers.pop(key, None)
+        self.buffered_rows.pop(key, None)
+        if not tables:
+            return
+        writer = self.writers.get(key)
+        if writer is None:
+            cohort, entity = key
+            partition = self.output_dir / f"cohort={cohort}" / f"entity={entity}"
+            partition.mkdir(parents=True, exist_ok=True)
+            writer = pq.ParquetWriter(partition / f"{self.part_name}.parquet", self.schemas[entity], compression='zstd')
+            self.writers[key] = writer
+        # unify_dictionaries lets each row group share one dictionary per column
+        writer.write_table(pa.concat_tables(tables).unify_dictionaries(), row_group_size=self.row_group_size)
+
+    def close(self):
+        for key in list(self.buffers):
+            self._flush(key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Generates synthetic dbGaP-style phenotype tables for the *-ingest specs, for load testing
+without controlled-access data.
+
+The specs are planned as for a run (see ingest_executor.planner); a <cohort>-ingest directory
+brings in its temporal/<cohort> specs, which ingest_executor.driver builds visit ages from, so the
+tables they read (e.g. the visit and age columns of the FHS visit index) are generated too. Each referenced table gets one
+file with a column per variable its derivations read, and the values of each variable come from
+what the specs say about it:
+
+- the participant slot (`associated_participant`, or a Person's `identity`): participant IDs
+- `value_mappings` keys, and literals it is compared to with ==/!= in an expr: those codes
+- numeric slots, `unit_conversion`, arithmetic and ordered comparisons in an expr: numbers in a
+  plausible range for the unit (the `unit` slot next to it, or the conversion's source unit),
+  widened to cover any thresholds it is compared to
+- anything else: short text codes
+
+Participants are numbered 1..N across the whole cohort. Each table holds a row for a random
+`--coverage` share of them, so tables join the way real ones do, and each non-ID column is empty
+for a `--missing` share of its rows. Values are drawn per (table, column, block of participants)
+from the seed, so output is the same for the same arguments whatever the block order or job count,
+and adding a spec does not change the values of other columns.
+
+Usage:
+    python -m ingest_executor.synthetic priority_variables_transform/FHS-ingest --output TABLES/FHS
+    python -m ingest_executor.synthetic priority_variables_transform/FHS-ingest --output TABLES/FHS \\
+        --participants 1000000 --seed 7 --jobs 0
+"""
+
+import argparse
+import os
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ingest_executor.driver import cohort_spec_dirs
+from ingest_executor.executor import NUMERIC_SLOTS, Derivation, SlotDerivation
+from ingest_executor.expressions import COMPARISONS, CONSTANT_NAMES, ExprError, tokenize
+from ingest_executor.planner import TablePlan, find_specs, plan_specs
+
+# Participants generated per block; each block draws its values from its own seeded generator
+BLOCK_SIZE = 100_000
+
+# Column holding the dbGaP subject ID in every table (COPDGene's specs read it directly)
+SUBJECT_ID_COLUMN = 'dbGaP_Subject_ID'
+
+# Plausible (low, high) values for the units the specs use, keyed by lower-case unit
+UNIT_RANGES = {
+    'kg': (45, 130), '[lb_av]': (100, 290), 'cm': (145, 200), '[in_us]': (57, 79), 'mm': (1, 60),
+    'kg/m2': (17, 45), 'mg/dl': (40, 250), 'mg/ml': (0.4, 2.5), 'ug/dl': (40, 250), 'mg/l': (0.2, 20),
+    'g/dl': (10, 17), 'mmol/l': (3, 10), 'pmol/l': (5, 150), 'pg/ml': (1, 200), 'ng/ml': (0.5, 50),
+    'ug/ml': (0.5, 20), '[iu]/l': (5, 60), '[iu]/ml': (0.5, 20), '10*3/ul': (3, 12), '10*6/ul': (3.8, 6),
+    'fl': (78, 100), '{beats}/min': (45, 110), 'mm[hg]': (55, 180), 'mmhg': (55, 180), 'ms': (80, 450),
+    '%': (0, 100), '%{normal}': (50, 120), 'l': (1, 6), 'h': (0, 12), '/h': (1, 40), 'mg/d': (0, 500),
+    'ml/min/{1.73_m2}': (30, 120), 'cel': (35.5, 38), '{score}': (0, 10), '{#}/wk': (0, 21),
+    '{ratio}': (0.5, 3), 'usd': (0, 100000),
+}
+AGE_RANGE = (18, 90)
+# Added to codes known only from expr comparisons, so a `case` also sees rows that match no branch
+UNMATCHED_CODE = '99'
+DEFAULT_RANGE = (0, 100)
+# Widest numeric range formatted through a lookup table of labels; wider ones are formatted value by value
+MAX_LABELS = 1_000_000
+
+
+class Domain:
+    """What the specs say about one variable's values"""
+
+    def __init__(self):
+        self.participant = False
+        self.numeric = False
+        self.integer = False
+        self.mapped = False
+        self.codes: Dict[str, None] = {}
+        self.low: Optional[float] = None
+        self.high: Optional[float] = None
+        self.thresholds: List[float] = []
+
+    def add_range(self, low: float, high: float):
+        self.numeric = True
+        self.low = low if self.low is None else min(self.low, low)
+        self.high = high if self.high is None else max(self.high, high)
+
+    def finish(self) -> Tuple[float, float]:
+        """(low, high) for a numeric domain: its unit range, else around its thresholds, covering both"""
+        low, high = self.low, self.high
+        if low is None:
+            if self.thresholds:
+                low, high = min(0.0, min(self.thresholds)), max(self.thresholds) * 2 or 10.0
+            else:
+                low, high = DEFAULT_RANGE
+        for threshold in self.thresholds:
+            low, high = min(low, threshold), max(high, threshold)
+        # numeric codes (`{phv} == 1`) on a numeric variable fall inside its range
+        for code in self.codes:
+            try:
+                value = float(code)
+            except ValueError:
+                continue
+            low, high = min(low, value), max(high, value)
+        return low, high
+
+    def describe(self) -> str:
+        if self.participant:
+            return 'participant ID'
+        if self.numeric:
+            low, high = self.finish()
+            return f"{'integer' if self.integer else 'decimal'} {low:g}..{high:g}"
+        if self.codes:
+            return f"codes {', '.join(list(self.codes)[:8])}{' ...' if len(self.codes) > 8 else ''}"
+        return 'text'
+
+
+def _literal(token: Tuple[str, str]) -> Optional[str]:
+    """Text of a number, string or bare-name token, as the table would hold it"""
+    kind, text = token
+    if kind == 'number' or (kind == 'name' and text not in CONSTANT_NAMES):
+        return text
+    if kind == 'string':
+        quote = 3 if text.startswith("'''") else 1
+        return text[quote:-quote]
+    return None
+
+
+def expr_hints(source: str) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """
+    (phv, hint, literal) for the variables of an expr: 'code' for ==/!= against a literal,
+    'threshold' for an ordered comparison with a number, 'numeric' for arithmetic (with the factor
+    when the whole expr is `{phv} * number`, e.g. an inch-to-cm conversion)
+    """
+    tokens = tokenize(source)
+    for i, (kind, text) in enumerate(tokens):
+        if kind != 'ref':
+            continue
+        phv = text[1:-1]
+        previous = tokens[i - 1] if i >= 1 else ('', '')
+        following = tokens[i + 1] if i + 1 < len(tokens) else ('', '')
+        for op, other in ((following, tokens[i + 2] if i + 2 < len(tokens) else None),
+                          (previous, tokens[i - 2] if i >= 2 else None)):
+            if op[0] != 'op' or other is None:
+                continue
+            literal = _literal(other)
+            if op[1] in ('==', '!=') and literal is not None:
+                yield phv, 'code', literal
+            elif op[1] in COMPARISONS and other[0] == 'number':
+                yield phv, 'threshold', literal
+            elif op[1] in ('+', '-', '*', '/') and other[0] in ('number', 'ref', 'op'):
+                factor = None
+                if len(tokens) == 3 and op is following and op[1] == '*' and other[0] == 'number':
+                    factor = literal
+                yield phv, 'numeric', factor
+
+
+def _constant_text(slot: SlotDerivation) -> Optional[str]:
+    """The text of a slot that is a constant: `value: kg` or `expr: '''kg'''`"""
+    if slot.has_value and slot.value is not None:
+        return str(slot.value)
+    if slot.expr is not None:
+        try:
+            tokens = tokenize(str(slot.expr))
+        except ExprError:
+            return None
+        if len(tokens) == 1 and tokens[0][0] == 'string':
+            return _literal(tokens[0])
+    return None
+
+
+def _unit_range(unit: Optional[str]) -> Optional[Tuple[float, float]]:
+    return UNIT_RANGES.get(unit.strip().lower()) if unit else None
+
+
+def add_derivation_domains(derivation: Derivation, domains: Dict[str, Domain]):
+    """Record what each slot of a derivation (and its nested objects) implies about the variables it reads"""
+    units = [_constant_text(slot) for slot in derivation.slots if slot.name == 'unit']
+    unit = units[0] if units else None
+    for slot in derivation.slots:
+        for nested in slot.objects:
+            add_derivation_domains(nested, domains)
+        is_participant = slot.name == 'associated_participant' or (
+            slot.name == 'identity' and derivation.class_name == 'Person')
+        numeric_slot = slot.name in NUMERIC_SLOTS
+        integer_slot = slot.name.startswith('age_') or slot.name == 'value_integer'
+        source_range = AGE_RANGE if slot.name.startswith('age_') else _unit_range(unit)
+        if slot.unit_conversion is not None:
+            source_range = _unit_range(slot.unit_conversion[0]) or source_range
+
+        if isinstance(slot.populated_from, str):
+            domain = domains.setdefault(slot.populated_from, Domain())
+            if is_participant:
+                domain.participant = True
+            elif slot.value_mappings is not None:
+                domain.mapped = True
+                domain.codes.update(dict.fromkeys(slot.value_mappings))
+            elif numeric_slot or slot.unit_conversion is not None:
+                domain.add_range(*(source_range or DEFAULT_RANGE))
+                domain.integer = domain.integer or integer_slot
+
+        if slot.expr is None:
+            continue
+        try:
+            hints = list(expr_hints(str(slot.expr)))
+        except ExprError:
+            continue
+        for phv, hint, literal in hints:
+            domain = domains.setdefault(phv, Domain())
+            if hint == 'code':
+                domain.codes[literal] = None
+            elif hint == 'threshold':
+                domain.numeric = True
+                domain.thresholds.append(float(literal))
+            else:
+                low, high = source_range or DEFAULT_RANGE
+                if literal is not None and float(literal) > 0:
+                    # `{phv} * 2.54` in cm: the column holds inches
+                    low, high = low / float(literal), high / float(literal)
+                domain.add_range(low, high)
+                domain.integer = domain.integer or integer_slot
+
+
+def infer_domains(plans: List[TablePlan]) -> Dict[str, Dict[str, Domain]]:
+    """{table: {column: Domain}} for every column the plans read, including from joined tables"""
+    tables = {}
+    joined = []
+    for plan in plans:
+        domains = {}
+        for derivation in plan.derivations:
+            add_derivation_domains(derivation, domains)
+        # columns read in ways add_derivation_domains doesn't classify (e.g. `str({phv})`) are text
+        tables[plan.table] = {column: domains.get(column, Domain()) for column in sorted(plan.columns)}
+        for join in plan.joins:
+            for column in sorted(join.derivation.phvs()):
+                joined.append((join.table, column, domains.get(column, Domain())))
+            # the joined table's own derivations may not read its participant column
+            key = Domain()
+            key.participant = True
+            joined.append((join.table, join.table_keys[0], key))
+    # a joined table's own derivations say more about its columns than the nested derivations do
+    for table, column, domain in joined:
+        tables.setdefault(table, {}).setdefault(column, domain)
+    return tables
+
+
+def _seed(*parts) -> List[int]:
+    return [part if isinstance(part, int) else zlib.crc32(str(part).encode('utf-8')) for part in parts]
+
+
+@lru_cache(maxsize=256)
+def number_labels(first: int, last: int, decimals: int) -> np.ndarray:
+    """Text of every value first..last in steps of 10**-decimals, so columns are formatted by indexing"""
+    scale = 10 ** decimals
+    return np.asarray([f"{step / scale:.{decimals}f}" for step in range(first, last + 1)], dtype=object)
+
+
+def generate_column(column: str, domain: Domain, ids: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Values for one column, as text (object array)"""
+    size = len(ids)
+    if domain.participant:
+        return ids.astype(str).astype(object)
+    if domain.numeric:
+        low, high = domain.finish()
+        decimals = 0 if domain.integer else 1
+        scale = 10 ** decimals
+        # whole steps (units or tenths), formatted by looking them up rather than one by one
+        first, last = int(np.ceil(low * scale)), int(np.floor(high * scale))
+        if last < first:
+            first = last = int(round(low * scale))
+        steps = np.round(rng.normal((low + high) / 2, (high - low) / 6 or 1.0, size) * scale)
+        steps = steps.clip(first, last).astype(np.int64)
+        if last - first < MAX_LABELS:
+            return number_labels(first, last, decimals)[steps - first]
+        return np.asarray([f"{step / scale:.{decimals}f}" for step in steps.tolist()], dtype=object)
+    codes = list(domain.codes) or [f"{column[-3:]}{i}" for i in range(10)]
+    if domain.codes and not domain.mapped and UNMATCHED_CODE not in domain.codes:
+        codes.append(UNMATCHED_CODE)
+    return np.asarray(codes, dtype=object)[rng.integers(0, len(codes), size)]
+
+
+def generate_block(table: str, columns: Dict[str, Domain], block: int, participants: int, seed: int,
+                   coverage: float, missing: float) -> pd.DataFrame:
+    """
+    The rows of one table for participants block*BLOCK_SIZE+1 .. (block+1)*BLOCK_SIZE, as text;
+    missing values are empty strings, as in a dbGaP file
+    """
+    first = block * BLOCK_SIZE + 1
+    ids = np.arange(first, min(first + BLOCK_SIZE, participants + 1), dtype=np.int64)
+    rng = np.random.default_rng(_seed(seed, table, block))
+    ids = ids[rng.random(len(ids)) < coverage]
+    data = {SUBJECT_ID_COLUMN: ids.astype(str)}
+    for column, domain in columns.items():
+        if column == SUBJECT_ID_COLUMN:
+            continue
+        column_rng = np.random.default_rng(_seed(seed, table, column, block))
+        values = generate_column(column, domain, ids, column_rng)
+        if not domain.participant and missing > 0:
+            values[column_rng.random(len(values)) < missing] = ''
+        data[column] = values
+    return pd.DataFrame(data)
+
+
+def write_table(table: str, columns: Dict[str, Domain], output_dir: Path, participants: int, seed: int,
+                coverage: float, missing: float) -> Tuple[str, int, float]:
+    """Write `<table>.tsv` block by block; returns (table, rows, seconds). Runs in worker processes."""
+    start = time.perf_counter()
+    path = Path(output_dir) / f"{table}.tsv"
+    rows = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(f"# Synthetic data for {table} generated by ingest_executor.synthetic (seed {seed}); not real participants\n")
+        for block in range((participants + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            frame = generate_block(table, columns, block, participants, seed, coverage, missing)
+            if block == 0:
+                f.write('\t'.join(frame.columns) + '\n')
+            if len(frame):
+                # joining the text directly is about twice as fast as DataFrame.to_csv
+                f.write('\n'.join(map('\t'.join, zip(*(frame[column].tolist() for column in frame.columns)))) + '\n')
+            rows += len(frame)
+    return table, rows, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic pht tables for *-ingest specs')
+    parser.add_argument('specs', nargs='+', type=Path, help='Spec YAML file(s) or cohort directories')
+    parser.add_argument('--output', '-o', type=Path, default=None, help='Directory to write <table>.tsv files to')
+    parser.add_argument('--participants', '-n', type=int, default=10_000, help='Participants in the cohort (default: 10000)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--coverage', type=float, default=0.9,
+                        help='Share of participants with a row in each table (default: 0.9)')
+    parser.add_argument('--missing', type=float, default=0.05,
+                        help='Share of empty values in each column (default: 0.05)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Worker processes, one table each (0 = one per CPU, default: 1)')
+    parser.add_argument('--domains', action='store_true',
+                        help='Print the inferred domain of every column, then exit')
+    args = parser.parse_args()
+
+    # nested objects that can't be joined are reported; their columns aren't generated
+    specs = [spec_dir for path in args.specs
+             for spec_dir in (cohort_spec_dirs(path) if path.is_dir() and path.name.endswith('-ingest') else [path])]
+    tables = infer_domains(plan_specs(find_specs(specs), allow_drop=True))
+    if args.domains:
+        for table, columns in tables.items():
+            print(f"{table}:")
+            for column, domain in columns.items():
+                print(f"  {column}: {domain.describe()}")
+        return 0
+    if args.output is None:
+        parser.error('--output is required unless --domains is given')
+    if not tables:
+        print('No tables referenced by the given specs')
+        return 1
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    jobs = [(table, columns, args.output, args.participants, args.seed, args.coverage, args.missing)
+            for table, columns in tables.items()]
+    if args.jobs != 1 and len(jobs) > 1:
+        workers = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(write_table, *zip(*jobs)))
+    else:
+        results = [write_table(*job) for job in jobs]
+    for table, rows, seconds in results:
+        print(f"{table}: {rows} rows, {len(tables[table])} column(s), {seconds:.2f}s")
+    print(f"Wrote {len(results)} table(s) for {args.participants} participants to {args.output} "
+          f"in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
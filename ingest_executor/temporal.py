@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Fills participant ages on records from the cohort's Visit records.
+
+Visit derivations (`priority_variables_transform/temporal/FHS/visit.yaml`) give each participant's
+age at each visit: `age_at_visit_start` read from the visit table. The Visit records don't carry
+the label observation specs use in `associated_visit` ("FHS OFFSPRING EXAM 2"), so VISIT_LABELS
+gives it for each Visit derivation, by the variable its age is read from. A derivation whose
+`age_at_observation` or `age_at_condition_start` is left empty, like `temporal/FHS/bdy_wgt.yaml`'s,
+gets it from there. The *-ingest specs have no age slots, so with_age_slots gives their derivations
+an empty one to fill; the driver reads temporal/<cohort> only for its Visit derivations, and runs
+the <cohort>-ingest derivations with age slots added.
+
+The Visit records are evaluated once per cohort into a VisitAgeIndex: participant IDs and visit
+labels become integer positions, and each (participant, visit) pair one int64 key, so filling a
+frame is a hash join over whole columns rather than a lookup per record.
+"""
+
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from ingest_executor.executor import Derivation, SlotDerivation, TableStore, evaluate_derivation
+
+# Slots filled from the visit ages where a derivation leaves them empty
+AGE_SLOTS = ('age_at_observation', 'age_at_condition_start')
+# The age slot added to each class's derivations that name a visit but have no age slot (see with_age_slots)
+AGE_SLOT_BY_CLASS = {
+    'MeasurementObservation': 'age_at_observation',
+    'Observation': 'age_at_observation',
+    'Condition': 'age_at_condition_start',
+}
+# The associated_visit label of the visit each Visit derivation's age_at_visit_start variable is for
+VISIT_LABELS = {
+    # temporal/FHS/visit.yaml, ages at Offspring exams 1-3 in pht003099
+    'phv00177930': 'FHS OFFSPRING EXAM 1',
+    'phv00177932': 'FHS OFFSPRING EXAM 2',
+    'phv00177934': 'FHS OFFSPRING EXAM 3',
+}
+
+
+def visit_age_column(derivation: Derivation) -> Optional[str]:
+    """The variable a Visit derivation reads age_at_visit_start from, if it also reads associated_participant"""
+    if derivation.class_name != 'Visit':
+        return None
+    columns = {slot.name: slot.populated_from for slot in derivation.slots if isinstance(slot.populated_from, str)}
+    if 'associated_participant' not in columns:
+        return None
+    return columns.get('age_at_visit_start')
+
+
+def is_visit_age_derivation(derivation: Derivation) -> bool:
+    return visit_age_column(derivation) is not None
+
+
+class VisitAgeIndex:
+    """Age at (participant, visit), for joining onto records by associated_participant and associated_visit"""
+
+    def __init__(self, participants, visits, ages):
+        frame = pd.DataFrame({'participant': participants, 'visit': visits,
+                              'age': pd.to_numeric(pd.Series(ages), errors='coerce').to_numpy()})
+        # the first Visit record for a pair wins
+        frame = frame.dropna().drop_duplicates(['participant', 'visit'])
+        self.participants = pd.Index(frame['participant'].unique())
+        self.visits = pd.Index(frame['visit'].unique())
+        self.keys = pd.Index(self._keys(self.participants.get_indexer(frame['participant']),
+                                        self.visits.get_indexer(frame['visit'])))
+        self.ages = frame['age'].to_numpy(dtype=float)
+
+    def _keys(self, participant_positions: np.ndarray, visit_positions: np.ndarray) -> np.ndarray:
+        keys = participant_positions.astype(np.int64) * len(self.visits) + visit_positions
+        keys[(participant_positions < 0) | (visit_positions < 0)] = -1
+        return keys
+
+    def __len__(self):
+        return len(self.ages)
+
+    @classmethod
+    def build(cls, derivations: Iterable[Derivation], store: TableStore) -> 'VisitAgeIndex':
+        """Evaluate the Visit derivations (see is_visit_age_derivation) against their tables"""
+        frames = []
+        for derivation in derivations:
+            if not is_visit_age_derivation(derivation):
+                continue
+            label = VISIT_LABELS.get(visit_age_column(derivation))
+            if label is None:
+                print(f"Warning: no visit label for {visit_age_column(derivation)} (see VISIT_LABELS); "
+                      f"no visit ages from {derivation}")
+                continue
+            table = store.load(derivation.table, derivation.phvs())
+            if table is None:
+                print(f"Warning: no table for {derivation.table}; no visit ages from {derivation}")
+                continue
+            frame = evaluate_derivation(derivation, table)[['associated_participant', 'age_at_visit_start']]
+            frames.append(frame.assign(visit=label))
+        for table in {derivation.table for derivation in derivations}:
+            store.release(table)
+        if not frames:
+            return cls([], [], [])
+        visits = pd.concat(frames, ignore_index=True)
+        return cls(visits['associated_participant'], visits['visit'], visits['age_at_visit_start'])
+
+    def _visit_positions(self, visits) -> np.ndarray:
+        if isinstance(getattr(visits, 'dtype', None), pd.CategoricalDtype):
+            # categorical visit labels: look up each category once, then index by code
+            categories = np.append(self.visits.get_indexer(visits.cat.categories), -1)
+            return categories[visits.cat.codes.to_numpy()]
+        return self.visits.get_indexer(visits)
+
+    def lookup(self, participants, visits) -> np.ndarray:
+        """Ages for parallel columns of participants and visit labels; NaN where there is no Visit"""
+        keys = self._keys(self.participants.get_indexer(participants), self._visit_positions(visits))
+        positions = self.keys.get_indexer(keys)
+        ages = np.full(len(positions), np.nan)
+        found = positions >= 0
+        ages[found] = self.ages[positions[found]]
+        return ages
+
+    def fill(self, derivation: Derivation, frame: pd.DataFrame) -> pd.DataFrame:
+        """Fill the empty age slots of a derivation's records (in place) from the visit ages"""
+        slots = [slot.name for slot in derivation.slots if slot.name in AGE_SLOTS and slot.name in frame.columns]
+        if not slots or not len(self) or not {'associated_participant', 'associated_visit'} <= set(frame.columns):
+            return frame
+        ages = None
+        for name in slots:
+            missing = frame[name].isna().to_numpy()
+            if not missing.any():
+                continue
+            if ages is None:
+                ages = self.lookup(frame['associated_participant'], frame['associated_visit'])
+            frame[name] = np.where(missing, ages, pd.to_numeric(frame[name], errors='coerce'))
+        return frame
+
+
+def visit_index_for(derivations: List[Derivation], store: TableStore) -> Optional[VisitAgeIndex]:
+    """The VisitAgeIndex for a cohort's derivations, or None if none of them are Visit ages"""
+    visit_derivations = [derivation for derivation in derivations if is_visit_age_derivation(derivation)]
+    if not visit_derivations:
+        return None
+    return VisitAgeIndex.build(visit_derivations, store)
+
+
+def with_age_slots(derivations: Iterable[Derivation]) -> List[Derivation]:
+    """
+    The derivations, each of AGE_SLOT_BY_CLASS's classes that names a visit but has no age slot
+    given an empty one first, as in temporal/FHS/bdy_wgt.yaml, for VisitAgeIndex.fill
+    """
+    result = []
+    for derivation in derivations:
+        names = {slot.name for slot in derivation.slots}
+        age_slot = AGE_SLOT_BY_CLASS.get(derivation.class_name)
+        if age_slot is not None and 'associated_visit' in names and not names & set(AGE_SLOTS):
+            derivation = Derivation(derivation.class_name, derivation.table,
+                                    [SlotDerivation(age_slot, None)] + derivation.slots,
+                                    derivation.source, derivation.position)
+        result.append(derivation)
+    return result
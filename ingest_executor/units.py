@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Unit normalization and conversion, from the tables the Stata pipeline uses.
+
+- `stata_gen_yaml/Programs/units.txt`: the alias rules that turn free-text units from the data
+  dictionaries into UCUM codes (`pounds` -> `[lb_av]`, `mg/100ml` -> `mg/dL`, ...)
+- `stata_gen_yaml/Documentation/ucum.dta`: the valid UCUM codes
+- `stata_gen_yaml/Documentation/conversions.dta`: conversion rules (`* 0.453592`, `/ 10`)
+- `stata_gen_yaml/Documentation/equivalencies.dta`: units that are the same quantity (`mg/L`, `ug/mL`)
+
+The tables are read once into a (source, target) -> factor/offset table that also covers inverses
+and chains of conversions (`[ft_us]` -> `cm` -> `[in_us]`). Conversions that need a formula
+(`meq/L`, molar mass) are known but not applied. Lookups by the unit text as written in a spec
+are cached per pair, so converting a column is one multiply however many rows it has.
+
+Usage:
+    python -m ingest_executor.units pounds kg
+    python -m ingest_executor.units --check priority_variables_transform/*-ingest
+"""
+
+import argparse
+import re
+import sys
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+STATA_DIR = REPO_ROOT / 'stata_gen_yaml'
+UNITS_FILE = STATA_DIR / 'Programs' / 'units.txt'
+CONVERSIONS_FILE = STATA_DIR / 'Documentation' / 'conversions.dta'
+UCUM_FILE = STATA_DIR / 'Documentation' / 'ucum.dta'
+EQUIVALENCIES_FILE = STATA_DIR / 'Documentation' / 'equivalencies.dta'
+
+# replace `x'=""[lb_av]"" if inlist(`x',""pounds"",""lbs"")  (units.txt holds the quoted Stata lines)
+ALIAS_RULE_RE = re.compile(r'replace `x\'=""(?P<target>.*?)"" if inlist\(`x\',(?P<aliases>.*)\)')
+ALIAS_RE = re.compile(r'""(.*?)""')
+# conversion_rule values: "* 0.453592", "/ 1000", "/10"
+RULE_RE = re.compile(r'^\s*([*/])\s*([0-9.eE+-]+)\s*$')
+
+# units.txt maps units such as "n/a" and "codes" to this, meaning the variable has no unit
+NO_UNIT = 'none'
+
+# Conversions with an offset, which conversions.dta (factors only) cannot express
+OFFSET_CONVERSIONS = {
+    ('[degF]', 'Cel'): (5 / 9, -160 / 9),
+}
+
+
+class Conversion:
+    """value * factor + offset, from one unit to another"""
+
+    def __init__(self, source: str, target: str, factor: float, offset: float = 0.0, via: Tuple[str, ...] = ()):
+        self.source = source
+        self.target = target
+        self.factor = factor
+        self.offset = offset
+        # units passed through when the conversion is a chain of table rules
+        self.via = via
+
+    def then(self, other: 'Conversion') -> 'Conversion':
+        return Conversion(self.source, other.target, self.factor * other.factor,
+                          self.offset * other.factor + other.offset, self.via + (self.target,) + other.via)
+
+    def inverse(self) -> 'Conversion':
+        return Conversion(self.target, self.source, 1 / self.factor, -self.offset / self.factor, self.via[::-1])
+
+    def apply(self, values):
+        """Convert a number, NumPy array or pandas Series"""
+        if self.offset:
+            return values * self.factor + self.offset
+        if self.factor == 1:
+            return values
+        return values * self.factor
+
+    def __repr__(self):
+        offset = f" {'-' if self.offset < 0 else '+'} {abs(self.offset):g}" if self.offset else ''
+        via = f" via {', '.join(self.via)}" if self.via else ''
+        return f"<Conversion {self.source} -> {self.target}: x * {self.factor:g}{offset}{via}>"
+
+
+def load_alias_rules(units_file: Path) -> List[Tuple[str, Set[str]]]:
+    """(UCUM code, aliases) in file order; the rules are applied one after another, as in Stata"""
+    rules = []
+    with open(units_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            match = ALIAS_RULE_RE.search(line)
+            if match:
+                rules.append((match.group('target'), set(ALIAS_RE.findall(match.group('aliases')))))
+    return rules
+
+
+def parse_rule(rule: str) -> Optional[float]:
+    """Factor of a conversion_rule such as '* 0.453592' or '/ 10'; None if it is not a plain factor"""
+    match = RULE_RE.match(rule or '')
+    if match is None:
+        return None
+    number = float(match.group(2))
+    return number if match.group(1) == '*' else 1 / number
+
+
+def split_merge_key(key: str, units: Set[str]) -> Optional[Tuple[str, str]]:
+    """Split an equivalencies.dta key 'mg/L_ug/mL' into its two units (units can contain '_' too)"""
+    candidates = [(key[:i], key[i + 1:]) for i, char in enumerate(key) if char == '_']
+    for source, target in candidates:
+        if source in units and target in units:
+            return source, target
+    for source, target in candidates:
+        if source in units or target in units:
+            return source, target
+    return candidates[0] if candidates else None
+
+
+class UnitEngine:
+    """Normalizes unit text to UCUM and converts values between units"""
+
+    def __init__(self, alias_rules: List[Tuple[str, Set[str]]], codes: Iterable[str],
+                 rules: Dict[Tuple[str, str], Tuple[float, float]], formulas: Optional[Dict[Tuple[str, str], str]] = None):
+        self.alias_rules = alias_rules
+        self.codes = set(codes)
+        self.codes_by_lower = {code.lower(): code for code in sorted(self.codes)}
+        self.formulas = formulas or {}
+        self._normalized: Dict[str, Optional[str]] = {}
+        self._pairs: Dict[Tuple[str, str], Optional[Conversion]] = {}
+        self.table = self._closure(rules)
+
+    @classmethod
+    def from_files(cls, units_file: Path = UNITS_FILE, conversions_file: Path = CONVERSIONS_FILE,
+                   ucum_file: Path = UCUM_FILE, equivalencies_file: Path = EQUIVALENCIES_FILE) -> 'UnitEngine':
+        alias_rules = load_alias_rules(units_file)
+        codes = set(pd.read_stata(ucum_file)['ucum_code'].dropna())
+        rules = {}
+        formulas = {}
+        for row in pd.read_stata(conversions_file).itertuples(index=False):
+            factor = parse_rule(row.conversion_rule)
+            if factor is not None:
+                rules[(row.source_unit, row.target_unit)] = (factor, 0.0)
+            else:
+                formulas[(row.source_unit, row.target_unit)] = row.conversion_formula or 'no rule given'
+        known = codes | {unit for pair in rules for unit in pair}
+        for key in pd.read_stata(equivalencies_file)['unit_merge_key'].dropna():
+            pair = split_merge_key(key, known)
+            if pair is not None:
+                rules.setdefault(pair, (1.0, 0.0))
+        for pair, (factor, offset) in OFFSET_CONVERSIONS.items():
+            rules.setdefault(pair, (factor, offset))
+        return cls(alias_rules, codes, rules, formulas)
+
+    def _closure(self, rules: Dict[Tuple[str, str], Tuple[float, float]]) -> Dict[Tuple[str, str], Conversion]:
+        """Every (source, target) reachable through the rules and their inverses, by the fewest steps"""
+        edges: Dict[str, Dict[str, Conversion]] = {}
+        for (source, target), (factor, offset) in rules.items():
+            conversion = Conversion(source, target, factor, offset)
+            edges.setdefault(source, {})[target] = conversion
+            # a rule stated in the table wins over the inverse of the opposite rule
+            if factor and source not in edges.get(target, {}):
+                edges.setdefault(target, {})[source] = conversion.inverse()
+        table = {}
+        for start in edges:
+            reached = {start: Conversion(start, start, 1.0)}
+            queue = deque([start])
+            while queue:
+                unit = queue.popleft()
+                for target, step in edges.get(unit, {}).items():
+                    if target not in reached:
+                        reached[target] = step if unit == start else reached[unit].then(step)
+                        queue.append(target)
+            for target, conversion in reached.items():
+                table[(start, target)] = conversion
+        return table
+
+    def normalize(self, unit: Any) -> Optional[str]:
+        """UCUM code for unit text as found in a spec or data dictionary; None for no unit"""
+        if unit is None or unit != unit:
+            return None
+        text = str(unit)
+        if text in self._normalized:
+            return self._normalized[text]
+        stripped = text.strip().strip("'")
+        if stripped in self.codes:
+            result = stripped
+        else:
+            # units.do: lower case, no spaces, then each alias rule in turn
+            cleaned = stripped.lower().replace(' ', '')
+            result = cleaned
+            for target, aliases in self.alias_rules:
+                if result in aliases:
+                    result = target
+            if result == cleaned:
+                result = self.codes_by_lower.get(cleaned, stripped)
+        if result == NO_UNIT or result == '':
+            result = None
+        self._normalized[text] = result
+        return result
+
+    def normalize_column(self, units) -> np.ndarray:
+        """UCUM codes for a column of unit text, normalizing each distinct value once"""
+        codes, uniques = pd.factorize(pd.Series(units, dtype=object))
+        normalized = np.asarray([self.normalize(unit) for unit in uniques] + [None], dtype=object)
+        # factorize marks missing values -1, which picks the trailing None
+        return normalized[codes]
+
+    def conversion(self, source: Any, target: Any) -> Optional[Conversion]:
+        """Conversion between two units as written (aliases allowed); None if there is none"""
+        key = (source, target)
+        if key not in self._pairs:
+            source_code, target_code = self.normalize(source), self.normalize(target)
+            if source_code is not None and source_code == target_code:
+                self._pairs[key] = Conversion(source_code, target_code, 1.0)
+            else:
+                self._pairs[key] = self.table.get((source_code, target_code))
+        return self._pairs[key]
+
+    def why_not(self, source: Any, target: Any) -> str:
+        """Why there is no conversion between two units, for warnings"""
+        pair = (self.normalize(source), self.normalize(target))
+        if pair in self.formulas:
+            return f"{pair[0]} to {pair[1]} needs a formula ({self.formulas[pair]})"
+        unknown = [str(unit) for unit, code in zip((source, target), pair) if code not in self.codes]
+        if unknown:
+            return f"not a UCUM unit: {', '.join(unknown)}"
+        return f"no conversion from {pair[0]} to {pair[1]}"
+
+    def convert(self, values, source: Any, target: Any):
+        """Convert a column (array or Series) from one unit to another; raises ValueError if impossible"""
+        conversion = self.conversion(source, target)
+        if conversion is None:
+            raise ValueError(self.why_not(source, target))
+        return conversion.apply(values)
+
+    def convert_column(self, values, units, target: Any) -> np.ndarray:
+        """
+        Convert values whose unit varies by row (a value column next to a unit column) to one
+        target unit. Each distinct unit is resolved once; rows with no conversion become NaN.
+        """
+        values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+        codes, uniques = pd.factorize(pd.Series(units, dtype=object))
+        factors = np.full(len(uniques) + 1, np.nan)
+        offsets = np.zeros(len(uniques) + 1)
+        for i, unit in enumerate(uniques):
+            conversion = self.conversion(unit, target)
+            if conversion is not None:
+                factors[i], offsets[i] = conversion.factor, conversion.offset
+        return values * factors[codes] + offsets[codes]
+
+
+@lru_cache(maxsize=None)
+def default_engine() -> UnitEngine:
+    """The engine for the repo's Stata tables, loaded on first use"""
+    return UnitEngine.from_files()
+
+
+def spec_unit_conversions(spec_files: Iterable[Path]) -> Dict[Tuple[str, str], List[str]]:
+    """(source_unit, target_unit) -> spec files, for every unit_conversion in the given specs"""
+    from ingest_executor.planner import plan_specs
+
+    pairs = {}
+
+    def visit(derivation, source):
+        for slot in derivation.slots:
+            if slot.unit_conversion is not None:
+                pairs.setdefault(slot.unit_conversion, set()).add(source)
+            for nested in slot.objects:
+                visit(nested, source)
+
+    for plan in plan_specs(spec_files):
+        for derivation in plan.derivations:
+            visit(derivation, derivation.source)
+    return {pair: sorted(sources) for pair, sources in pairs.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Normalize units to UCUM and look up conversions')
+    parser.add_argument('units', nargs='*', help='A unit to normalize, or SOURCE TARGET to show the conversion')
+    parser.add_argument('--check', nargs='+', type=Path, default=None, metavar='SPECS',
+                        help='Check that every unit_conversion in these spec files or directories resolves')
+    args = parser.parse_args()
+
+    engine = default_engine()
+    if args.check:
+        from ingest_executor.planner import find_specs
+
+        failed = 0
+        for (source, target), sources in sorted(spec_unit_conversions(find_specs(args.check)).items()):
+            conversion = engine.conversion(source, target)
+            if conversion is None:
+                failed += 1
+                print(f"{source} -> {target}: {engine.why_not(source, target)} ({', '.join(sources)})")
+            else:
+                print(f"{source} -> {target}: {conversion}")
+        return 1 if failed else 0
+    if len(args.units) == 1:
+        print(engine.normalize(args.units[0]))
+    elif len(args.units) == 2:
+        conversion = engine.conversion(*args.units)
+        print(conversion if conversion is not None else engine.why_not(*args.units))
+        return 0 if conversion is not None else 1
+    else:
+        parser.error('give one unit to normalize, two units to convert between, or --check')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
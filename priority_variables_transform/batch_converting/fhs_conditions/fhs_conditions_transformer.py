@@ -1,36 +1,83 @@
 import yaml
 import pandas as pd
-import re
-from typing import Dict, List, Any, Optional
+import os
+import sys
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# spec_parser.py, shared with the other spec tools, lives at the repository root
+REPO_ROOT = Path(__file__).resolve().parents[3]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from spec_parser import PhvEntry, PriorityVariable, ValueSet, read_priority_variables  # noqa: E402
+# the empty-field cleanup moved to spec_parser; still importable from here
+from spec_parser import clean_linkml_map_content, clean_linkml_map_for_yaml, clean_linkml_map_lines  # noqa: E402,F401
 
 """
 Got code from https://claude.ai/share/53d2ec25-c243-4d4b-9276-d3ed342eb18f
 """
 
 
+def build_visit_index(lookup_df: pd.DataFrame) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    """
+    Build a pht -> (participant ID phv, associated visit) dict from the contextual variables table.
+    The first row wins for duplicated phts. Duplicates and rows missing a participant phv
+    or visit are reported here, once, instead of surfacing per raw variable.
+    """
+    index = {}
+    for pht, participant_phv, visit in zip(lookup_df['data table pht'],
+                                           lookup_df['participant ID phv'],
+                                           lookup_df['associated visit']):
+        if pd.isna(pht):
+            print("Warning: contextual variables row with no data table pht")
+            continue
+        pht = str(pht).strip()
+        participant_phv = None if pd.isna(participant_phv) else participant_phv
+        visit = None if pd.isna(visit) else visit
+        if pht in index:
+            if index[pht] != (participant_phv, visit):
+                print(f"Warning: conflicting rows for pht {pht}; using {index[pht]}, ignoring {(participant_phv, visit)}")
+            else:
+                print(f"Warning: duplicate rows for pht {pht}")
+            continue
+        if participant_phv is None or visit is None:
+            print(f"Warning: pht {pht} is missing its participant ID phv or associated visit")
+        index[pht] = (participant_phv, visit)
+    return index
+
+
+@lru_cache(maxsize=None)
+def _load_lookup(csv_file_path: str, mtime: float) -> Tuple[pd.DataFrame, Dict[str, Tuple[Optional[str], Optional[str]]]]:
+    lookup_df = pd.read_csv(csv_file_path)
+    # Clean column names
+    lookup_df.columns = lookup_df.columns.str.strip()
+    return lookup_df, build_visit_index(lookup_df)
+
+
+def load_lookup(csv_file_path: str) -> Tuple[pd.DataFrame, Dict[str, Tuple[Optional[str], Optional[str]]]]:
+    """Load the contextual variables CSV and its pht index, reusing them until the file changes"""
+    csv_file_path = os.path.abspath(csv_file_path)
+    return _load_lookup(csv_file_path, os.path.getmtime(csv_file_path))
+
+
 class YAMLTransformer:
     def __init__(self, csv_file_path: str):
         """Initialize with CSV lookup table"""
-        self.lookup_df = pd.read_csv(csv_file_path)
-        # Clean column names
-        self.lookup_df.columns = self.lookup_df.columns.str.strip()
+        self.lookup_df, self.visit_index = load_lookup(csv_file_path)
 
     def get_visit_info(self, pht: str) -> tuple:
         """Get participant ID and visit info from CSV based on pht"""
-        row = self.lookup_df[self.lookup_df['data table pht'] == pht]
-        if not row.empty:
-            participant_phv = row.iloc[0]['participant ID phv']
-            visit = row.iloc[0]['associated visit']
-            return participant_phv, visit
-        return None, None
-
-    def extract_condition_concept(self, value_sets: List) -> tuple:
+        return self.visit_index.get(pht, (None, None))
+
+    def extract_condition_concept(self, value_sets: List[ValueSet]) -> tuple:
         """Extract condition concept and comment from value_sets"""
         # Look for MONDO or HP codes in comments
         for value_set in value_sets:
-            for class_obj in value_set.get('classes', []):
-                if class_obj.get('type') == 'Condition':
-                    concept_line = class_obj.get('properties', {}).get('condition_concept', '')
+            for class_obj in value_set.classes:
+                if class_obj.type == 'Condition':
+                    concept_line = class_obj.properties.get('condition_concept', '')
                     if concept_line and '#' in concept_line:
                         parts = concept_line.split('#', 1)
                         concept = parts[0].strip()
@@ -42,41 +89,41 @@ class YAMLTransformer:
         # Default to asthma if not found
         return "MONDO:0004979", "asthma"
 
-    def extract_condition_provenance(self, value_sets: List) -> str:
+    def extract_condition_provenance(self, value_sets: List[ValueSet]) -> str:
         """Determine condition provenance from patterns"""
         # Look for explicit provenance in the conditions
         for value_set in value_sets:
-            for class_obj in value_set.get('classes', []):
-                if class_obj.get('type') == 'Condition':
-                    prov = class_obj.get('properties', {}).get('condition_provenance', '')
+            for class_obj in value_set.classes:
+                if class_obj.type == 'Condition':
+                    prov = class_obj.properties.get('condition_provenance', '')
                     if prov and prov != '':
                         return prov
 
         # Default based on common patterns
         return "PATIENT_SELF-REPORTED_CONDITION"
 
-    def create_value_mappings(self, value_sets: List) -> Dict[str, str]:
+    def create_value_mappings(self, value_sets: List[ValueSet]) -> Dict[str, str]:
         """Create value mappings for condition_status"""
         mappings = {}
 
         for value_set in value_sets:
-            value = value_set.get('value', '')
+            value = value_set.value
 
             # Handle empty/default values - use dot
             if value == '' or value == 'default':
                 value = '.'
 
             # Look for Condition classes in this value_set
-            for class_obj in value_set.get('classes', []):
-                if class_obj.get('type') == 'Condition':
-                    status = class_obj.get('properties', {}).get('condition_status', '')
+            for class_obj in value_set.classes:
+                if class_obj.type == 'Condition':
+                    status = class_obj.properties.get('condition_status', '')
                     if status:
                         mappings[value] = status
                         break
 
             # Handle special cases with complex conditional logic
             if value not in mappings:
-                function_text = value_set.get('function', '')
+                function_text = value_set.function
 
                 # Extract status from complex conditional statements
                 if 'look at' in function_text.lower():
@@ -93,16 +140,16 @@ class YAMLTransformer:
 
         return mappings
 
-    def transform_raw_variable(self, phv_id: str, phv_entry: Dict) -> Dict:
+    def transform_raw_variable(self, phv_id: str, phv_entry: PhvEntry) -> Dict:
         """Transform a single raw variable to class_derivation format"""
-        pht = phv_entry.get('identifiers', {}).get('pht', '')
+        pht = phv_entry.pht
         participant_phv, visit = self.get_visit_info(pht)
 
         if not participant_phv or not visit:
             print(f"Warning: Could not find visit info for pht {pht}")
             return None
 
-        value_sets = phv_entry.get('value_sets', [])
+        value_sets = phv_entry.value_sets
         concept, comment = self.extract_condition_concept(value_sets)
         provenance = self.extract_condition_provenance(value_sets)
         value_mappings = self.create_value_mappings(value_sets)
@@ -149,10 +196,10 @@ class YAMLTransformer:
 
         return class_derivation
 
-    def _check_for_special_visit_logic(self, value_sets: List) -> Optional[str]:
+    def _check_for_special_visit_logic(self, value_sets: List[ValueSet]) -> Optional[str]:
         """Check if the value_sets contain special visit timing logic"""
         for value_set in value_sets:
-            function_text = value_set.get('function', '')
+            function_text = value_set.function
             if '12 months before' in function_text:
                 return "Contains 12 months before visit calculation"
             elif 'age at previous visit' in function_text:
@@ -161,83 +208,59 @@ class YAMLTransformer:
 
     def transform_yaml_file(self, input_file: str, output_file: str):
         """Transform the entire YAML file"""
-        # Load original YAML using the custom parser
-        with open(input_file, 'r') as f:
-            content = f.read()
-
-        # Clean the content first to make it parseable
-        cleaned_content = clean_linkml_map_for_yaml(input_file)
-
-        # Parse using the custom parser from linkml_transform_script
-        original_data = parse_source_yaml(cleaned_content)
+        # Parse the original YAML as it is read, with empty fields cleaned out first
+        original_data = read_priority_variables(input_file, clean=True)
 
         transformed_derivations = []
 
         # Process the parsed structure
         self._process_parsed_variables(original_data, transformed_derivations)
 
-        # Write output file
+        # Write output file, collecting the summary counts as each derivation is emitted
+        chunks, summary = emit_derivations(transformed_derivations)
         with open(output_file, 'w') as f:
-            for i, derivation in enumerate(transformed_derivations):
-                if i > 0:
-                    f.write('\n')
-                yaml.dump(derivation, f, default_flow_style=False, sort_keys=False)
+            f.write('\n'.join(chunks))
 
         print(f"Transformed {len(transformed_derivations)} raw variables")
         print(f"Output written to {output_file}")
 
         # Generate summary report
-        self._generate_summary_report(transformed_derivations, f"{output_file}_summary.txt")
+        self._generate_summary_report(transformed_derivations, f"{output_file}_summary.txt", summary)
 
         return transformed_derivations
 
-    def _process_parsed_variables(self, parsed_data: Dict, transformed_derivations: List):
-        """Process the parsed data structure from parse_source_yaml"""
-        for variable in parsed_data.get('variables', []):
-            for phv_entry in variable.get('phv_entries', []):
-                phv_id = phv_entry.get('phv', '')
+    def _process_parsed_variables(self, parsed_data: List[PriorityVariable], transformed_derivations: List):
+        """Process the variables parsed by spec_parser.read_priority_variables"""
+        for variable in parsed_data:
+            for phv_entry in variable.phv_entries:
+                phv_id = phv_entry.phv
 
                 # Only process if this entry has Condition classes
-                has_condition = False
-                for value_set in phv_entry.get('value_sets', []):
-                    for class_obj in value_set.get('classes', []):
-                        if class_obj.get('type') == 'Condition':
-                            has_condition = True
-                            break
-                    if has_condition:
-                        break
-
-                if has_condition and phv_id:
+                if phv_entry.has_class('Condition') and phv_id:
                     transformed = self.transform_raw_variable(phv_id, phv_entry)
                     if transformed:
                         transformed_derivations.append(transformed)
 
-    def _generate_summary_report(self, transformed_derivations: List, report_file: str):
-        """Generate a summary report of the transformation"""
+    def _generate_summary_report(self, transformed_derivations: List, report_file: str,
+                                 summary: Optional[Dict] = None):
+        """
+        Generate a summary report of the transformation.
+        `summary` is the counts collected by emit_derivations; they are recomputed if not given.
+        """
+        if summary is None:
+            summary = new_summary()
+            for derivation in transformed_derivations:
+                count_derivation(derivation, summary)
+        concepts = summary['concepts']
+        provenances = summary['provenances']
+        special_logic_count = summary['special_logic_count']
+
         with open(report_file, 'w') as f:
             f.write("YAML Transformation Summary Report\n")
             f.write("=" * 50 + "\n\n")
 
             f.write(f"Total transformations: {len(transformed_derivations)}\n\n")
 
-            # Count by condition concepts
-            concepts = {}
-            provenances = {}
-            special_logic_count = 0
-
-            for derivation in transformed_derivations:
-                if "class_derivations" in derivation:
-                    slots = derivation["class_derivations"]["Condition"]["slot_derivations"]
-
-                    concept = slots["condition_concept"]["expr"].strip("'")
-                    concepts[concept] = concepts.get(concept, 0) + 1
-
-                    provenance = slots["condition_provenance"]["expr"].strip("'")
-                    provenances[provenance] = provenances.get(provenance, 0) + 1
-
-                    if "# SPECIAL_VISIT_LOGIC" in derivation:
-                        special_logic_count += 1
-
             f.write("Condition Concepts:\n")
             for concept, count in concepts.items():
                 f.write(f"  {concept}: {count}\n")
@@ -255,134 +278,124 @@ class YAMLTransformer:
         print(f"Summary report written to {report_file}")
 
 
-def parse_source_yaml(content: str) -> Dict[str, Any]:
-    """Parse the source YAML structure"""
-    lines = content.split('\n')
-    result = {'variables': []}
+# C-accelerated emitter when PyYAML was built against libyaml
+YAMLDumper = getattr(yaml, 'CDumper', yaml.Dumper)
 
-    current_variable = None
-    current_phv_entry = None
-    current_value_set = None
-    current_class = None
+# Slots, in order, of the Condition derivations built by transform_raw_variable
+CONDITION_SLOTS = {
+    'associated_participant': 'populated_from',
+    'associated_visit': 'expr',
+    'condition_concept': 'expr',
+    'condition_status': 'populated_from',
+    'condition_provenance': 'expr',
+    'relationship_to_participant': 'expr',
+}
+# yaml.dump wraps long scalars at this width; template lines must stay within it
+YAML_WIDTH = 80
 
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
 
-        if stripped.startswith('priority_variable:'):
-            current_variable = {'name': '', 'phv_entries': []}
-            result['variables'].append(current_variable)
+def new_summary() -> Dict:
+    return {'concepts': {}, 'provenances': {}, 'special_logic_count': 0}
 
-        elif stripped.startswith('name:') and current_variable is not None:
-            current_variable['name'] = stripped.split(':', 1)[1].strip()
 
-        elif (stripped.startswith('phv:') or stripped.startswith('raw_variable:')) and current_variable is not None:
-            phv_id = stripped.split(':', 1)[1].strip()
-            current_phv_entry = {
-                'phv': phv_id,
-                'identifiers': {},
-                'input_data_type': '',
-                'value_sets': []
-            }
-            current_variable['phv_entries'].append(current_phv_entry)
+def count_derivation(derivation: Dict, summary: Dict):
+    """Add one derivation to the summary report counts"""
+    if "class_derivations" in derivation:
+        slots = derivation["class_derivations"]["Condition"]["slot_derivations"]
 
-        elif stripped.startswith('phs:') and current_phv_entry is not None:
-            current_phv_entry['identifiers']['phs'] = stripped.split(':', 1)[1].strip()
+        concept = slots["condition_concept"]["expr"].strip("'")
+        summary['concepts'][concept] = summary['concepts'].get(concept, 0) + 1
 
-        elif stripped.startswith('pht:') and current_phv_entry is not None:
-            current_phv_entry['identifiers']['pht'] = stripped.split(':', 1)[1].strip()
+        provenance = slots["condition_provenance"]["expr"].strip("'")
+        summary['provenances'][provenance] = summary['provenances'].get(provenance, 0) + 1
 
-        elif stripped.startswith('input_data_type:') and current_phv_entry is not None:
-            current_phv_entry['input_data_type'] = stripped.split(':', 1)[1].strip()
+        if "# SPECIAL_VISIT_LOGIC" in derivation:
+            summary['special_logic_count'] += 1
 
-        elif stripped.startswith('value:') and current_phv_entry is not None:
-            value_str = stripped[6:].strip() if len(stripped) > 6 else 'default'
-            current_value_set = {
-                'value': value_str,
-                'function': '',
-                'classes': []
-            }
-            current_phv_entry['value_sets'].append(current_value_set)
-
-        elif stripped.startswith('function:') and current_value_set is not None:
-            # Handle multi-line functions
-            func_text = stripped.split(':', 1)[1].strip()
-            j = i + 1
-            while j < len(lines) and not lines[j].strip().endswith(':') and not lines[j].strip().startswith('value:'):
-                if lines[j].strip() and not lines[j].strip().startswith('#'):
-                    func_text += ' ' + lines[j].strip()
-                j += 1
-            current_value_set['function'] = func_text
-            i = j - 1
-
-        elif stripped in ['MeasurementObservation:', 'Condition:', 'DrugExposure:',
-                          'MeasurementObservationSet:'] and current_value_set is not None:
-            current_class = {
-                'type': stripped.rstrip(':'),
-                'properties': {}
-            }
-            current_value_set['classes'].append(current_class)
-
-        elif current_class is not None and ':' in stripped and not stripped.startswith('#'):
-            if not any(stripped.startswith(x) for x in
-                       ['value:', 'function:', 'MeasurementObservation:', 'Condition:', 'DrugExposure:']):
-                key_val = stripped.split(':', 1)
-                if len(key_val) == 2:
-                    key, val = key_val
-                    key = key.strip()
-                    val = val.strip()
-
-                    # Handle nested properties like value_quantity
-                    if key in current_class['properties']:
-                        if isinstance(current_class['properties'][key], dict):
-                            # This is a continuation of a nested property
-                            pass
-                        else:
-                            current_class['properties'][key] = val
-                    else:
-                        current_class['properties'][key] = val
 
-        i += 1
+@lru_cache(maxsize=None)
+def _yaml_scalar(value: str) -> Optional[str]:
+    """YAML text for a short string scalar exactly as yaml.dump writes it, or None if it spans lines"""
+    text = yaml.dump([value], Dumper=YAMLDumper, default_flow_style=False)
+    if not text.startswith('- ') or text.count('\n') != 1:
+        return None
+    return text[2:-1]
+
+
+def render_condition_derivation(derivation: Dict) -> Optional[str]:
+    """
+    Fast path for the fixed Condition shape built by transform_raw_variable: fill a template
+    with cached scalar renderings instead of running the YAML emitter.
+    Returns None if the derivation doesn't have exactly that shape, so the caller can fall back.
+    """
+    keys = list(derivation)
+    if keys not in (["class_derivations"], ["class_derivations", "# SPECIAL_VISIT_LOGIC"]):
+        return None
+    class_derivations = derivation["class_derivations"]
+    if list(class_derivations) != ["Condition"] or list(class_derivations["Condition"]) != [
+            "populated_from", "slot_derivations"]:
+        return None
+    condition = class_derivations["Condition"]
+    slots = condition["slot_derivations"]
+    if list(slots) != list(CONDITION_SLOTS):
+        return None
+
+    scalars = [condition["populated_from"]]
+    for slot, key in CONDITION_SLOTS.items():
+        expected = [key, "value_mappings"] if slot == 'condition_status' else [key]
+        if list(slots[slot]) != expected:
+            return None
+        scalars.append(slots[slot][key])
+    value_mappings = slots["condition_status"]["value_mappings"]
+    if not isinstance(value_mappings, dict):
+        return None
+    scalars.extend(value_mappings)
+    scalars.extend(value_mappings.values())
+    if len(keys) > 1:
+        scalars.append(derivation[keys[1]])
+    if not all(type(value) is str and _yaml_scalar(value) is not None for value in scalars):
+        return None
 
-    return result
+    q = _yaml_scalar
+    lines = [
+        "class_derivations:",
+        "  Condition:",
+        f"    populated_from: {q(condition['populated_from'])}",
+        "    slot_derivations:",
+    ]
+    for slot, key in CONDITION_SLOTS.items():
+        lines.append(f"      {slot}:")
+        lines.append(f"        {key}: {q(slots[slot][key])}")
+        if slot == 'condition_status':
+            if value_mappings:
+                lines.append("        value_mappings:")
+                lines.extend(f"          {q(value)}: {q(status)}" for value, status in value_mappings.items())
+            else:
+                lines.append("        value_mappings: {}")
+    if len(keys) > 1:
+        lines.append(f"{q(keys[1])}: {q(derivation[keys[1]])}")
+
+    if any(len(line) > YAML_WIDTH for line in lines):
+        return None
+    lines.append("")
+    return "\n".join(lines)
 
 
-def clean_linkml_map_for_yaml(file_path):
+def emit_derivations(transformed_derivations: List[Dict]) -> Tuple[List[str], Dict]:
     """
-    Remove empty field lines (lines ending with just ':') from LinkML-map files
-    to make them compatible with yaml.safe_load.
-    Only removes lines where the next non-empty line is NOT more indented.
+    Render every derivation to YAML text (template fast path, else the C dumper when available)
+    and collect the summary report counts in the same pass.
+    Returns (one text chunk per derivation, summary counts); join the chunks with '\n'.
     """
-    with open(file_path, 'r') as f:
-        content = f.read()
-
-    lines = content.split('\n')
-    cleaned_lines = []
-
-    for i, line in enumerate(lines):
-        # Check if line is just indentation + word + colon (potential empty field)
-        if re.match(r'^\s+\w+:\s*$', line):
-            current_indent = len(line) - len(line.lstrip())
-
-            # Look at the next non-empty line to check its indentation
-            should_keep = False
-            for j in range(i + 1, len(lines)):
-                next_line = lines[j]
-                if next_line.strip():  # Found next non-empty line
-                    next_indent = len(next_line) - len(next_line.lstrip())
-                    if next_indent > current_indent:
-                        # Next line is more indented, so this is a parent with children
-                        should_keep = True
-                    break
-
-            if should_keep:
-                cleaned_lines.append(line)
-            # If should_keep is False, we skip this line (don't append it)
-        else:
-            cleaned_lines.append(line)
-
-    return '\n'.join(cleaned_lines)
+    chunks = []
+    summary = new_summary()
+    for derivation in transformed_derivations:
+        text = render_condition_derivation(derivation)
+        if text is None:
+            text = yaml.dump(derivation, Dumper=YAMLDumper, default_flow_style=False, sort_keys=False)
+        chunks.append(text)
+        count_derivation(derivation, summary)
+    return chunks, summary
 
 
 def main():
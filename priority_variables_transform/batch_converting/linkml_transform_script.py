@@ -4,17 +4,29 @@ Transforms priority_variable format to class_derivations format
 
 Usage:
     python linkml_transform.py input_file.yaml [output_file.yaml]
-    python linkml_transform.py --batch input_directory/ output_directory/
+    python linkml_transform.py --batch [--jobs N] [--incremental] input_directory/ output_directory/
 """
 
 import argparse
+import hashlib
+import json
 # import re
+import os
 import sys
-# import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 # import yaml
 
+# spec_parser.py, shared with the other spec tools, lives at the repository root
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+import spec_parser  # noqa: E402
+from spec_parser import ClassEntry, PhvEntry, PriorityVariable, ValueSet, parse_priority_variables  # noqa: E402
+
 class LinkMLTransformer:
     """Transforms LinkML-Map files from priority_variable to class_derivations format"""
     
@@ -24,96 +36,13 @@ class LinkMLTransformer:
             'multiply_by_10': 10,
         }
     
-    def parse_source_yaml(self, content: str) -> Dict[str, Any]:
-        """Parse the source YAML structure"""
-        lines = content.split('\n')
-        result = {'variables': []}
-        
-        current_variable = None
-        current_phv_entry = None
-        current_value_set = None
-        current_class = None
-        
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            stripped = line.strip()
-            
-            if stripped.startswith('priority_variable:'):
-                current_variable = {'name': '', 'phv_entries': []}
-                result['variables'].append(current_variable)
-                
-            elif stripped.startswith('name:') and current_variable is not None:
-                current_variable['name'] = stripped.split(':', 1)[1].strip()
-                
-            elif (stripped.startswith('phv:') or stripped.startswith('raw_variable:')) and current_variable is not None:
-                phv_id = stripped.split(':', 1)[1].strip()
-                current_phv_entry = {
-                    'phv': phv_id,
-                    'identifiers': {},
-                    'input_data_type': '',
-                    'value_sets': []
-                }
-                current_variable['phv_entries'].append(current_phv_entry)
-                
-            elif stripped.startswith('phs:') and current_phv_entry is not None:
-                current_phv_entry['identifiers']['phs'] = stripped.split(':', 1)[1].strip()
-                
-            elif stripped.startswith('pht:') and current_phv_entry is not None:
-                current_phv_entry['identifiers']['pht'] = stripped.split(':', 1)[1].strip()
-                
-            elif stripped.startswith('input_data_type:') and current_phv_entry is not None:
-                current_phv_entry['input_data_type'] = stripped.split(':', 1)[1].strip()
-                
-            elif stripped.startswith('value:') and current_phv_entry is not None:
-                value_str = stripped[6:].strip() if len(stripped) > 6 else 'default'
-                current_value_set = {
-                    'value': value_str,
-                    'function': '',
-                    'classes': []
-                }
-                current_phv_entry['value_sets'].append(current_value_set)
-                
-            elif stripped.startswith('function:') and current_value_set is not None:
-                # Handle multi-line functions
-                func_text = stripped.split(':', 1)[1].strip()
-                j = i + 1
-                while j < len(lines) and not lines[j].strip().endswith(':') and not lines[j].strip().startswith('value:'):
-                    if lines[j].strip() and not lines[j].strip().startswith('#'):
-                        func_text += ' ' + lines[j].strip()
-                    j += 1
-                current_value_set['function'] = func_text
-                i = j - 1
-                
-            elif stripped in ['MeasurementObservation:', 'Condition:', 'DrugExposure:', 'MeasurementObservationSet:'] and current_value_set is not None:
-                current_class = {
-                    'type': stripped.rstrip(':'),
-                    'properties': {}
-                }
-                current_value_set['classes'].append(current_class)
-                
-            elif current_class is not None and ':' in stripped and not stripped.startswith('#'):
-                if not any(stripped.startswith(x) for x in ['value:', 'function:', 'MeasurementObservation:', 'Condition:', 'DrugExposure:']):
-                    key_val = stripped.split(':', 1)
-                    if len(key_val) == 2:
-                        key, val = key_val
-                        key = key.strip()
-                        val = val.strip()
-                        
-                        # Handle nested properties like value_quantity
-                        if key in current_class['properties']:
-                            if isinstance(current_class['properties'][key], dict):
-                                # This is a continuation of a nested property
-                                pass
-                            else:
-                                current_class['properties'][key] = val
-                        else:
-                            current_class['properties'][key] = val
-            
-            i += 1
-            
-        return result
-    
+    def parse_source_yaml(self, content: Union[str, Iterable[str]]) -> List[PriorityVariable]:
+        """
+        Parse the source YAML structure (file text or any iterable of lines, e.g. an open file).
+        See spec_parser.parse_priority_variables.
+        """
+        return parse_priority_variables(content)
+
     def extract_concept_id(self, concept_str: str) -> str:
         """Extract concept ID from string, handling comments"""
         if not concept_str:
@@ -158,9 +87,10 @@ class LinkMLTransformer:
         skip_phrases = ['do nothing', 'skip', 'omit']
         return any(phrase in function_text.lower() for phrase in skip_phrases)
     
-    def generate_measurement_observation(self, variable: Dict, phv_entry: Dict, value_set: Dict, class_obj: Dict) -> List[str]:
+    def generate_measurement_observation(self, variable: PriorityVariable, phv_entry: PhvEntry, value_set: ValueSet,
+                                         class_obj: ClassEntry) -> List[str]:
         """Generate MeasurementObservation class derivation"""
-        if self.should_skip_function(value_set.get('function', '')):
+        if self.should_skip_function(value_set.function):
             return []
             
         lines = [
@@ -171,21 +101,21 @@ class LinkMLTransformer:
         ]
         
         # Handle value_decimal
-        if 'value_decimal' in class_obj['properties'] or phv_entry['input_data_type'] in ['decimal', 'integer']:
+        if 'value_decimal' in class_obj.properties or phv_entry.input_data_type in ['decimal', 'integer']:
             lines.append('      value_decimal:')
             
             # Check for unit conversion
-            conversion = self.detect_unit_conversion(value_set.get('function', ''), phv_entry['phv'])
-            if conversion and conversion != f"{{{phv_entry['phv']}}}":
+            conversion = self.detect_unit_conversion(value_set.function, phv_entry.phv)
+            if conversion and conversion != f"{{{phv_entry.phv}}}":
                 lines.extend([
                     '        populated_from:',
                     f'          expr: {conversion}'
                 ])
             else:
-                lines.append(f'        populated_from: {phv_entry["phv"]}')
+                lines.append(f'        populated_from: {phv_entry.phv}')
         
         # Handle observation_type
-        obs_type = class_obj['properties'].get('observation_type', '')
+        obs_type = class_obj.properties.get('observation_type', '')
         if obs_type:
             concept = self.extract_concept_id(obs_type)
             lines.extend([
@@ -194,7 +124,7 @@ class LinkMLTransformer:
             ])
         
         # Handle value_quantity.unit
-        unit = class_obj['properties'].get('unit', '')
+        unit = class_obj.properties.get('unit', '')
         if unit:
             lines.extend([
                 '      value_quantity.unit:',
@@ -202,8 +132,8 @@ class LinkMLTransformer:
             ])
         
         # Handle range constraints
-        if 'range_low' in class_obj['properties']:
-            range_val = class_obj['properties']['range_low']
+        if 'range_low' in class_obj.properties:
+            range_val = class_obj.properties['range_low']
             lines.extend([
                 '      range_low:',
                 f'        value_decimal: {range_val}',
@@ -211,22 +141,23 @@ class LinkMLTransformer:
             ])
         
         # Handle value_concept for enum types
-        if (phv_entry['input_data_type'] == 'enum' and 
-            value_set.get('value') not in ['', 'default'] and
-            'value_enum' in class_obj['properties']):
+        if (phv_entry.input_data_type == 'enum' and 
+            value_set.value not in ['', 'default'] and
+            'value_enum' in class_obj.properties):
             
-            enum_val = class_obj['properties']['value_enum']
+            enum_val = class_obj.properties['value_enum']
             lines.extend([
                 '      value_concept:',
                 '        populated_from:',
-                f'          expr: case(({{{phv_entry["phv"]}}} == {value_set["value"]}, "\'{enum_val}\'"))'
+                f'          expr: case(({{{phv_entry.phv}}} == {value_set.value}, "\'{enum_val}\'"))'
             ])
         
         return lines
     
-    def generate_condition(self, variable: Dict, phv_entry: Dict, value_set: Dict, class_obj: Dict) -> List[str]:
+    def generate_condition(self, variable: PriorityVariable, phv_entry: PhvEntry, value_set: ValueSet,
+                           class_obj: ClassEntry) -> List[str]:
         """Generate Condition class derivation"""
-        if self.should_skip_function(value_set.get('function', '')):
+        if self.should_skip_function(value_set.function):
             return []
             
         lines = [
@@ -237,7 +168,7 @@ class LinkMLTransformer:
         ]
         
         # Handle condition_concept
-        concept = class_obj['properties'].get('condition_concept', '')
+        concept = class_obj.properties.get('condition_concept', '')
         if concept:
             concept_id = self.extract_concept_id(concept)
             lines.extend([
@@ -246,7 +177,7 @@ class LinkMLTransformer:
             ])
         
         # Handle condition_status
-        status = class_obj['properties'].get('condition_status', '')
+        status = class_obj.properties.get('condition_status', '')
         if status:
             lines.extend([
                 '      condition_status:',
@@ -254,7 +185,7 @@ class LinkMLTransformer:
             ])
         
         # Handle condition_provenance
-        provenance = class_obj['properties'].get('condition_provenance', '')
+        provenance = class_obj.properties.get('condition_provenance', '')
         if provenance:
             lines.extend([
                 '      condition_provenance:',
@@ -263,9 +194,10 @@ class LinkMLTransformer:
         
         return lines
     
-    def generate_drug_exposure(self, variable: Dict, phv_entry: Dict, value_set: Dict, class_obj: Dict) -> List[str]:
+    def generate_drug_exposure(self, variable: PriorityVariable, phv_entry: PhvEntry, value_set: ValueSet,
+                               class_obj: ClassEntry) -> List[str]:
         """Generate DrugExposure class derivation"""
-        if self.should_skip_function(value_set.get('function', '')):
+        if self.should_skip_function(value_set.function):
             return []
             
         lines = [
@@ -276,7 +208,7 @@ class LinkMLTransformer:
         ]
         
         # Handle drug_concept
-        concept = class_obj['properties'].get('drug_concept', '')
+        concept = class_obj.properties.get('drug_concept', '')
         if concept:
             concept_id = self.extract_concept_id(concept)
             lines.extend([
@@ -285,8 +217,8 @@ class LinkMLTransformer:
             ])
         
         # Handle exposure_provenance (note: source sometimes has typo "expsoure_provenance")
-        provenance = (class_obj['properties'].get('exposure_provenance') or 
-                     class_obj['properties'].get('expsoure_provenance', ''))
+        provenance = (class_obj.properties.get('exposure_provenance') or 
+                     class_obj.properties.get('expsoure_provenance', ''))
         if provenance:
             # Clean up provenance string
             clean_prov = provenance.replace(' ', '_').replace('-', '_').upper()
@@ -297,16 +229,16 @@ class LinkMLTransformer:
         
         return lines
     
-    def transform_file(self, content: str) -> str:
-        """Transform a single file's content"""
+    def transform_file(self, content: Union[str, Iterable[str]]) -> str:
+        """Transform a single file's content (its text or any iterable of its lines, e.g. an open file)"""
         parsed = self.parse_source_yaml(content)
         output_lines = []
         
-        for variable in parsed['variables']:
-            for phv_entry in variable['phv_entries']:
-                for value_set in phv_entry['value_sets']:
-                    for class_obj in value_set['classes']:
-                        class_type = class_obj['type']
+        for variable in parsed:
+            for phv_entry in variable.phv_entries:
+                for value_set in phv_entry.value_sets:
+                    for class_obj in value_set.classes:
+                        class_type = class_obj.type
                         
                         if class_type == 'MeasurementObservation':
                             lines = self.generate_measurement_observation(variable, phv_entry, value_set, class_obj)
@@ -333,6 +265,190 @@ class LinkMLTransformer:
         return '\n'.join(output_lines)
 
 
+MANIFEST_NAME = '.transform_manifest.json'
+
+
+def content_hash(data: bytes) -> str:
+    """Hash used to detect changed inputs and outputs in incremental mode"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class SourceLines:
+    """
+    The lines of a binary file handle as text, for transform_file. Hashes the bytes as they are read
+    and notes whether the file is in source format (contains priority_variable), so neither needs
+    the whole file in memory.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.is_source = False
+
+    def __iter__(self):
+        for raw in self.f:
+            self.digest.update(raw)
+            line = raw.decode('utf-8')
+            if 'priority_variable:' in line:
+                self.is_source = True
+            yield line
+
+    def hexdigest(self) -> str:
+        """content_hash of the whole file, reading whatever the transform did not"""
+        for raw in self.f:
+            self.digest.update(raw)
+        return self.digest.hexdigest()
+
+
+def transformer_version() -> str:
+    """Version of the transform logic: any edit to this script or to spec_parser.py invalidates incremental outputs"""
+    return content_hash(Path(__file__).read_bytes() + Path(spec_parser.__file__).read_bytes())[:16]
+
+
+def transform_batch_file(input_file: Path, output_dir: Path) -> Tuple[str, str, str, Optional[str], Optional[str]]:
+    """
+    Transform one file of a --batch run. Runs in worker processes when --jobs > 1.
+    Returns (input file name, status, message, input hash, output hash) where status is
+    'transformed', 'skipped' or 'failed'.
+    """
+    input_hash = None
+    try:
+        with open(input_file, 'rb') as f:
+            lines = SourceLines(f)
+            transformed = LinkMLTransformer().transform_file(lines)
+            input_hash = lines.hexdigest()
+
+        # Check if it's a source format file (contains priority_variable)
+        if not lines.is_source:
+            return input_file.name, 'skipped', f"Skipping {input_file.name} (not source format)", input_hash, None
+
+        output_file = output_dir / input_file.name
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(transformed)
+        output_hash = content_hash(output_file.read_bytes())
+
+        return (input_file.name, 'transformed', f"Transformed {input_file.name} -> {output_file.name}",
+                input_hash, output_hash)
+
+    except Exception as e:
+        return input_file.name, 'failed', f"Error processing {input_file}: {e}", input_hash, None
+
+
+def load_manifest(output_dir: Path) -> Dict[str, Dict[str, Optional[str]]]:
+    """Load {input file name: {input_hash, transformer_version, output_hash}} for output_dir"""
+    manifest_file = output_dir / MANIFEST_NAME
+    if not manifest_file.exists():
+        return {}
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            return json.load(f).get('files', {})
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable manifest {manifest_file}: {e}", file=sys.stderr)
+        return {}
+
+
+def save_manifest(output_dir: Path, entries: Dict[str, Dict[str, Optional[str]]]):
+    manifest_file = output_dir / MANIFEST_NAME
+    tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'files': dict(sorted(entries.items()))}, f, indent=1)
+    tmp_file.replace(manifest_file)
+
+
+def is_up_to_date(input_file: Path, output_dir: Path, entry: Optional[Dict[str, Optional[str]]],
+                  version: str) -> bool:
+    """
+    True if the manifest entry matches the current input, transformer and output. A file that
+    can't be read (removed mid-run, no permission) is not up to date, so it is retried.
+    """
+    if not entry or entry.get('transformer_version') != version:
+        return False
+    try:
+        if entry.get('input_hash') != content_hash(input_file.read_bytes()):
+            return False
+        if entry.get('output_hash') is None:
+            # Input was not in source format, so there is no output to check
+            return True
+        output_file = output_dir / input_file.name
+        return output_file.exists() and entry['output_hash'] == content_hash(output_file.read_bytes())
+    except OSError:
+        return False
+
+
+def run_batch(yaml_files: List[Path], output_dir: Path, jobs: int = 1, verbose: bool = False,
+              incremental: bool = False) -> Dict[str, int]:
+    """
+    Transform yaml_files into output_dir, fanning out over a process pool when jobs != 1.
+    Messages are reported in input order regardless of which worker finishes first.
+
+    With incremental=True, a manifest in output_dir records each input's hash, the
+    transformer version and the output's hash; only stale or missing outputs are rebuilt.
+    Outputs whose input no longer exists, is no longer in source format, or fails to transform
+    are deleted, so output_dir never keeps an output its manifest doesn't vouch for.
+    """
+    counts = {'transformed': 0, 'skipped': 0, 'failed': 0, 'up_to_date': 0, 'pruned': 0}
+    manifest = load_manifest(output_dir) if incremental else {}
+    version = transformer_version()
+
+    if incremental:
+        input_names = {input_file.name for input_file in yaml_files}
+        for name in sorted(set(manifest) - input_names):
+            entry = manifest.pop(name)
+            output_file = output_dir / name
+            if entry.get('output_hash') and output_file.exists():
+                output_file.unlink()
+                counts['pruned'] += 1
+                if verbose:
+                    print(f"Pruned {output_file.name} (input deleted)")
+
+        stale_files = []
+        for input_file in yaml_files:
+            if is_up_to_date(input_file, output_dir, manifest.get(input_file.name), version):
+                counts['up_to_date'] += 1
+            else:
+                stale_files.append(input_file)
+        yaml_files = stale_files
+
+    if jobs != 1 and len(yaml_files) > 1:
+        workers = jobs if jobs > 0 else (os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(transform_batch_file, yaml_files, [output_dir] * len(yaml_files)))
+    else:
+        results = [transform_batch_file(input_file, output_dir) for input_file in yaml_files]
+
+    for name, status, message, input_hash, output_hash in results:
+        counts[status] += 1
+        previous = manifest.pop(name, None)
+        if status == 'failed':
+            print(message, file=sys.stderr)
+            output_file = output_dir / name
+            if previous and previous.get('output_hash') and output_file.exists():
+                # the old output is out of date and, with its entry gone, would never be pruned
+                output_file.unlink()
+                counts['pruned'] += 1
+                if verbose:
+                    print(f"Pruned {output_file.name} (input failed to transform)")
+        else:
+            if verbose:
+                print(message)
+            output_file = output_dir / name
+            if status == 'skipped' and previous and previous.get('output_hash') and output_file.exists():
+                # the input was transformed before but is no longer in source format
+                output_file.unlink()
+                counts['pruned'] += 1
+                if verbose:
+                    print(f"Pruned {output_file.name} (input no longer in source format)")
+            manifest[name] = {
+                'input_hash': input_hash,
+                'transformer_version': version,
+                'output_hash': output_hash,
+            }
+
+    if incremental:
+        save_manifest(output_dir, manifest)
+    return counts
+
+
 usage_examples = """Example usage:
     # Transform a single file and output to stdout
     python linkml_transform.py input_file.yaml
@@ -343,6 +459,12 @@ usage_examples = """Example usage:
     # Batch process an entire directory
     python linkml_transform.py --batch input_directory/ output_directory/
 
+    # Batch process using one worker process per CPU
+    python linkml_transform.py --batch --jobs 0 input_directory/ output_directory/
+
+    # Only rebuild outputs whose input or this script changed since the last run
+    python linkml_transform.py --batch --incremental input_directory/ output_directory/
+
     # Verbose output to see what's being processed
     python linkml_transform.py --batch --verbose source_files/ transformed_files/"""
 
@@ -356,12 +478,14 @@ def main():
     parser.add_argument('input', help='Input file or directory')
     parser.add_argument('output', nargs='?', help='Output file or directory')
     parser.add_argument('--batch', action='store_true', help='Process directory of files')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Worker processes for --batch (0 = one per CPU, default: 1)')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'With --batch, only rebuild stale outputs (tracked in output/{MANIFEST_NAME})')
     parser.add_argument('--verbose', '-v', action='store_true', help='Verbose output')
 
     args = parser.parse_args()
     
-    transformer = LinkMLTransformer()
-    
     if args.batch:
         # Batch processing
         input_dir = Path(args.input)
@@ -373,33 +497,23 @@ def main():
         
         output_dir.mkdir(exist_ok=True)
         
-        yaml_files = list(input_dir.glob('*.yaml')) + list(input_dir.glob('*.yml'))
+        yaml_files = sorted(list(input_dir.glob('*.yaml')) + list(input_dir.glob('*.yml')))
         
         if args.verbose:
             print(f"Processing {len(yaml_files)} files from {input_dir} to {output_dir}")
         
-        for input_file in yaml_files:
-            try:
-                with open(input_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Check if it's a source format file (contains priority_variable)
-                if 'priority_variable:' not in content:
-                    if args.verbose:
-                        print(f"Skipping {input_file.name} (not source format)")
-                    continue
-                
-                transformed = transformer.transform_file(content)
-                
-                output_file = output_dir / input_file.name
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    f.write(transformed)
-                
-                if args.verbose:
-                    print(f"Transformed {input_file.name} -> {output_file.name}")
-                    
-            except Exception as e:
-                print(f"Error processing {input_file}: {e}", file=sys.stderr)
+        start = time.perf_counter()
+        counts = run_batch(yaml_files, output_dir, jobs=args.jobs, verbose=args.verbose,
+                           incremental=args.incremental)
+        elapsed = time.perf_counter() - start
+        
+        summary = (f"Summary: {counts['transformed']} transformed, {counts['skipped']} skipped, "
+                   f"{counts['failed']} failed")
+        if args.incremental:
+            summary += f", {counts['up_to_date']} up to date, {counts['pruned']} pruned"
+        print(f"{summary} in {elapsed:.2f}s")
+        if counts['failed']:
+            return 1
     
     else:
         # Single file processing
@@ -409,15 +523,16 @@ def main():
             print(f"Error: {input_file} does not exist", file=sys.stderr)
             return 1
         
+        transformer = LinkMLTransformer()
+        
         try:
-            with open(input_file, 'r', encoding='utf-8') as f:
-                content = f.read()
+            with open(input_file, 'rb') as f:
+                lines = SourceLines(f)
+                transformed = transformer.transform_file(lines)
             
-            if 'priority_variable:' not in content:
+            if not lines.is_source:
                 print(f"Warning: {input_file} does not appear to be in source format", file=sys.stderr)
             
-            transformed = transformer.transform_file(content)
-            
             if args.output:
                 output_file = Path(args.output)
                 with open(output_file, 'w', encoding='utf-8') as f:
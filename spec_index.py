@@ -0,0 +1,290 @@
+"""
+Cross-reference index of the transform specs under priority_variables_transform.
+
+Every YAML file is parsed once and each phv, pht, concept CURIE (OMOP:..., OBA:..., RxCUI:...)
+and visit label it mentions is recorded in a SQLite database with its file, derivation path and
+line. Later runs only re-read files whose mtime or size changed (and whose content hash differs),
+so queries answer in milliseconds instead of grepping the whole tree. Files that are not valid
+YAML (several older specs) are indexed line by line, without derivation paths.
+
+Files are found, and phvs matched, as in spec_parser. The tree is composed with yaml.compose
+rather than read with spec_parser's model, since each reference is stored with its line.
+
+Usage:
+    python spec_index.py build
+    python spec_index.py query phv00007676
+    python spec_index.py query pht004037 --files --under FHS-ingest
+    python spec_index.py query 'OMOP:4041720' 'pht0040%'
+    python spec_index.py stats
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import yaml
+
+from spec_parser import PHV_RE, SafeLoader, find_spec_files
+
+# Bump when what is extracted from each file changes, so the index is rebuilt
+INDEX_VERSION = 2
+
+spec_dir = "./priority_variables_transform"
+default_db = ".spec_index.sqlite"
+
+PHT_RE = re.compile(r'pht\d+')
+# PREFIX:local_id where the id has a digit, e.g. OMOP:4041720, OBA:VT0000184, RxCUI:1191
+CURIE_RE = re.compile(r'\b([A-Z][A-Za-z0-9_]*):([A-Za-z_]*\d[\w.\-]*)')
+# 'text', "text" or '''text''' in an expr, unless it is compared against ({phv} == 'Y')
+STRING_LITERAL_RE = re.compile(r"""(?<![=!]=)(?<![=!]= )('''|"|')(.*?)\1(?!\s*[=!]=)""")
+
+KINDS = ('phv', 'pht', 'curie', 'visit')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha256 TEXT, error TEXT
+);
+CREATE TABLE IF NOT EXISTS refs (
+    kind TEXT, value TEXT, file TEXT, path TEXT, line INTEGER
+);
+CREATE INDEX IF NOT EXISTS refs_value ON refs (value, kind);
+CREATE INDEX IF NOT EXISTS refs_file ON refs (file);
+"""
+
+
+def classify(value: str) -> Optional[str]:
+    """Kind of a query term: phv, pht, curie, or None (search all kinds)"""
+    if PHV_RE.fullmatch(value):
+        return 'phv'
+    if PHT_RE.fullmatch(value):
+        return 'pht'
+    if CURIE_RE.fullmatch(value):
+        return 'curie'
+    return None
+
+
+def visit_labels(text: str, is_expr: bool) -> List[str]:
+    """
+    Visit labels in a scalar under associated_visit: the string literals of an expr
+    ("'CHS PSG 1'", case(...)), otherwise the text itself, unquoted, unless it reads a variable
+    """
+    if is_expr:
+        literals = [match.group(2) for match in STRING_LITERAL_RE.finditer(text)]
+        if literals:
+            return [literal for literal in literals if literal]
+    if PHV_RE.search(text):
+        return []
+    quoted = STRING_LITERAL_RE.fullmatch(text)
+    return [quoted.group(2) if quoted else text]
+
+
+def _scalar_refs(text: str, in_visit: str = '') -> Iterator[Tuple[str, str]]:
+    for match in PHV_RE.finditer(text):
+        yield 'phv', match.group()
+    for match in PHT_RE.finditer(text):
+        yield 'pht', match.group()
+    for match in CURIE_RE.finditer(text):
+        yield 'curie', f"{match.group(1)}:{match.group(2)}"
+    if in_visit:
+        for label in visit_labels(text, in_visit == 'expr'):
+            yield 'visit', label
+
+
+def extract_refs(content: str) -> Iterator[Tuple[str, str, str, int]]:
+    """
+    (kind, value, derivation path, line) for every reference in a YAML document. Visit labels are
+    the text values under an associated_visit slot (its value or value_mappings targets) and the
+    string literals of its expr.
+    """
+    root = yaml.compose(content, Loader=SafeLoader)
+    if root is None:
+        return
+    # iterative walk: (node, path, '' outside an associated_visit slot, else 'label' or 'expr')
+    stack = [(root, '', '')]
+    while stack:
+        node, path, in_visit = stack.pop()
+        if isinstance(node, yaml.MappingNode):
+            for key, value in reversed(node.value):
+                key_text = str(key.value)
+                for kind, ref in _scalar_refs(key_text):
+                    yield kind, ref, path, key.start_mark.line + 1
+                child_visit = in_visit or ('label' if key_text == 'associated_visit' else '')
+                # keys inside associated_visit (populated_from, value_mappings codes...) are not labels
+                if child_visit and key_text in ('populated_from', 'range', 'unit_conversion'):
+                    child_visit = ''
+                elif child_visit and key_text == 'expr':
+                    child_visit = 'expr'
+                stack.append((value, f"{path}.{key_text}" if path else key_text, child_visit))
+        elif isinstance(node, yaml.SequenceNode):
+            for i, item in reversed(list(enumerate(node.value))):
+                stack.append((item, f"{path}[{i}]", in_visit))
+        elif isinstance(node, yaml.ScalarNode) and node.value != '':
+            for kind, ref in _scalar_refs(str(node.value), in_visit if node.tag.endswith(':str') else ''):
+                yield kind, ref, path, node.start_mark.line + 1
+
+
+def scan_lines(content: str) -> Iterator[Tuple[str, str, str, int]]:
+    """Fallback for files that aren't valid YAML: references by line, with no derivation path"""
+    for number, line in enumerate(content.splitlines(), 1):
+        for kind, ref in _scalar_refs(line):
+            yield kind, ref, '', number
+
+
+def connect(db_file: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(db_file))
+    conn.executescript(SCHEMA)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()
+    if row is None or int(row[0]) != INDEX_VERSION:
+        conn.execute('DELETE FROM refs')
+        conn.execute('DELETE FROM files')
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('index_version', ?)", (str(INDEX_VERSION),))
+        conn.commit()
+    return conn
+
+
+def update_index(conn: sqlite3.Connection, base_dir: Path, verbose: bool = False) -> Tuple[int, int, int]:
+    """Bring the index up to date with the files under base_dir; returns (reindexed, unchanged, removed)"""
+    known = {path: (mtime, size, digest) for path, mtime, size, digest
+             in conn.execute('SELECT path, mtime, size, sha256 FROM files')}
+    reindexed = unchanged = 0
+    seen = set()
+    for spec_file in find_spec_files(base_dir):
+        name = spec_file.as_posix()
+        seen.add(name)
+        stat = spec_file.stat()
+        previous = known.get(name)
+        if previous and previous[0] == stat.st_mtime and previous[1] == stat.st_size:
+            unchanged += 1
+            continue
+        content = spec_file.read_bytes()
+        digest = hashlib.sha256(content).hexdigest()
+        if previous and previous[2] == digest:
+            # touched but not changed
+            conn.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?', (stat.st_mtime, stat.st_size, name))
+            unchanged += 1
+            continue
+        error = None
+        text = content.decode('utf-8', errors='replace')
+        try:
+            refs = list(extract_refs(text))
+        except yaml.YAMLError as e:
+            # older specs that don't parse are still searchable, line by line
+            error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            refs = list(scan_lines(text))
+            if verbose:
+                print(f"Warning: cannot parse {name} ({error}); indexed by line only")
+        rows = [(kind, value, name, path, line) for kind, value, path, line in refs]
+        conn.execute('DELETE FROM refs WHERE file = ?', (name,))
+        conn.executemany('INSERT INTO refs VALUES (?, ?, ?, ?, ?)', rows)
+        conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                     (name, stat.st_mtime, stat.st_size, digest, error))
+        reindexed += 1
+        if verbose:
+            print(f"Indexed {name} ({len(rows)} references)")
+    removed = [name for name in known if name not in seen]
+    for name in removed:
+        conn.execute('DELETE FROM refs WHERE file = ?', (name,))
+        conn.execute('DELETE FROM files WHERE path = ?', (name,))
+    conn.commit()
+    return reindexed, unchanged, len(removed)
+
+
+def _like_literal(text: str) -> str:
+    """Escape LIKE's special characters (with ESCAPE '\\') so text matches only itself"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def query(conn: sqlite3.Connection, term: str, kind: Optional[str] = None,
+          under: Optional[str] = None) -> List[Tuple[str, str, str, str, int]]:
+    """References matching a term ('%' wildcards allowed), as (kind, value, file, path, line)"""
+    kind = kind or classify(term)
+    if '%' in term:
+        # only '%' is a wildcard; '_' (dbGaP_Subject_ID...) matches itself
+        sql = "SELECT kind, value, file, path, line FROM refs WHERE value LIKE ? ESCAPE '\\'"
+        params = ['%'.join(_like_literal(part) for part in term.split('%'))]
+    else:
+        sql = 'SELECT kind, value, file, path, line FROM refs WHERE value = ?'
+        params = [term]
+    if kind:
+        sql += ' AND kind = ?'
+        params.append(kind)
+    if under:
+        sql += " AND file LIKE ? ESCAPE '\\'"
+        params.append(f"%{_like_literal(under)}%")
+    sql += ' ORDER BY file, line'
+    return conn.execute(sql, params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index and query phv/pht/CURIE/visit references in the transform specs')
+    parser.add_argument('--dir', default=spec_dir, help=f'Directory to index (default: {spec_dir})')
+    parser.add_argument('--db', type=Path, default=Path(default_db), help=f'SQLite index file (default: {default_db})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Create or update the index')
+    build.add_argument('--rebuild', action='store_true', help='Discard the index and re-read every file')
+    build.add_argument('--verbose', '-v', action='store_true', help='List each file as it is indexed')
+
+    find = subparsers.add_parser('query', help='Find where phvs, phts, CURIEs or visit labels are used')
+    find.add_argument('terms', nargs='+', help="Values to look up; '%%' is a wildcard (e.g. pht0040%%)")
+    find.add_argument('--kind', choices=KINDS, default=None, help='Only this kind of reference')
+    find.add_argument('--under', default=None, help='Only files whose path contains this (e.g. FHS-ingest)')
+    find.add_argument('--files', action='store_true', help='List matching files only')
+    find.add_argument('--no-update', action='store_true', help='Query the index as is, without checking for changes')
+
+    subparsers.add_parser('stats', help='Summarize the index')
+    args = parser.parse_args()
+
+    if args.command == 'build' and args.rebuild and args.db.exists():
+        args.db.unlink()
+    conn = connect(args.db)
+    try:
+        if args.command == 'build':
+            start = time.perf_counter()
+            reindexed, unchanged, removed = update_index(conn, Path(args.dir), args.verbose)
+            print(f"Indexed {reindexed} file(s), {unchanged} unchanged, {removed} removed "
+                  f"in {time.perf_counter() - start:.2f}s ({args.db})")
+        elif args.command == 'query':
+            if not args.no_update:
+                update_index(conn, Path(args.dir))
+            found = False
+            for term in args.terms:
+                rows = query(conn, term, args.kind, args.under)
+                found = found or bool(rows)
+                if args.files:
+                    for name in sorted({row[2] for row in rows}):
+                        print(name)
+                else:
+                    for kind, value, name, path, line in rows:
+                        print(f"{name}:{line}\t{kind}\t{value}\t{path}")
+                if not rows:
+                    print(f"No references to {term}", file=sys.stderr)
+            return 0 if found else 1
+        else:
+            files, errors = conn.execute('SELECT COUNT(*), COUNT(error) FROM files').fetchone()
+            print(f"{files} file(s) indexed, {errors} not valid YAML (indexed by line, without derivation paths)")
+            for kind, distinct, total in conn.execute(
+                    'SELECT kind, COUNT(DISTINCT value), COUNT(*) FROM refs GROUP BY kind ORDER BY kind'):
+                print(f"{kind}: {distinct} distinct, {total} references")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        status = main()
+        # flush here, so a closed pipe is caught below rather than reported at exit
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader (e.g. `| head`) stopped reading; send what is left to /dev/null and exit quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        status = 1
+    sys.exit(status)
@@ -0,0 +1,534 @@
+"""
+Shared parser for the transform specs under priority_variables_transform.
+
+Reads both formats into small typed objects instead of nested dicts:
+
+- priority_variable files (ATTIC/asthma.yaml, future/*.yaml), which are mostly not valid YAML, are
+  read line by line into PriorityVariable > PhvEntry > ValueSet > ClassEntry
+  (parse_priority_variables, used by linkml_transform_script.py and fhs_conditions_transformer.py)
+- class_derivations files (*-ingest, copdgene-linkml-map) become Derivation > SlotDerivation
+  (load_spec, used by ingest_executor; referenced_phvs, used by check_phv_coverage.py)
+
+All the objects use __slots__, and phv/pht IDs, class and slot names and short values are interned,
+so a parsed tree holds one copy of each distinct string. class_derivations files are read by
+load_yaml, yaml.load with PyYAML's libyaml loader where it is built; validate_ingest_yamls.py checks
+the raw tree of each file with the same loader.
+
+Usage:
+    python spec_parser.py [DIR]             # parse every spec file under DIR and summarize
+"""
+
+import argparse
+import io
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+import yaml
+
+# Use the libyaml C loader when PyYAML was built against it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+spec_dir = "./priority_variables_transform"
+
+PHV_REF_RE = re.compile(r'\{(phv\d+)\}')
+PHV_RE = re.compile(r'phv\d+')
+CLASS_DERIVATIONS_RE = re.compile(r'^\s*(?:- )?class_derivations:', re.M)
+PRIORITY_VARIABLE_RE = re.compile(r'^\s*(?:- )?priority_variable:', re.M)
+
+# Slots read from a table's context columns (participant IDs, visit codes), not from the priority
+# variables the valid-phvs lists hold
+CONTEXT_SLOTS = frozenset(['associated_participant', 'associated_visit'])
+
+intern = sys.intern
+
+
+def _intern(value: Any) -> Any:
+    return intern(value) if type(value) is str else value
+
+
+# priority_variable format
+
+# Keys recognised by parse_priority_variables; a line's key is the text before its first ':'
+PHV_KEYS = frozenset(['phv', 'raw_variable'])
+IDENTIFIER_KEYS = frozenset(['phs', 'pht'])
+CLASS_TYPES = frozenset(['MeasurementObservation', 'Condition', 'DrugExposure', 'MeasurementObservationSet'])
+NON_PROPERTY_KEYS = frozenset(['value', 'function', 'MeasurementObservation', 'Condition', 'DrugExposure'])
+
+
+class ClassEntry:
+    """A target class under a value: its type and its `key: value` properties as text"""
+    __slots__ = ('type', 'properties')
+
+    def __init__(self, class_type: str):
+        self.type = class_type
+        self.properties: Dict[str, str] = {}
+
+    def __repr__(self):
+        return f"<ClassEntry {self.type} {self.properties}>"
+
+
+class ValueSet:
+    """One `value:` of a phv (or 'default' for a bare `value:`), its function text and classes"""
+    __slots__ = ('value', 'function', 'classes')
+
+    def __init__(self, value: str):
+        self.value = value
+        self.function = ''
+        self.classes: List[ClassEntry] = []
+
+    def __repr__(self):
+        return f"<ValueSet {self.value!r} ({len(self.classes)} classes)>"
+
+
+class PhvEntry:
+    """One phv (or raw_variable) of a priority variable"""
+    __slots__ = ('phv', 'phs', 'pht', 'input_data_type', 'value_sets')
+
+    def __init__(self, phv: str):
+        self.phv = phv
+        self.phs = ''
+        self.pht = ''
+        self.input_data_type = ''
+        self.value_sets: List[ValueSet] = []
+
+    def has_class(self, class_type: str) -> bool:
+        return any(class_obj.type == class_type for value_set in self.value_sets for class_obj in value_set.classes)
+
+    def __repr__(self):
+        return f"<PhvEntry {self.phv} ({self.pht}, {len(self.value_sets)} values)>"
+
+
+class PriorityVariable:
+    __slots__ = ('name', 'phv_entries')
+
+    def __init__(self):
+        self.name = ''
+        self.phv_entries: List[PhvEntry] = []
+
+    def __repr__(self):
+        return f"<PriorityVariable {self.name} ({len(self.phv_entries)} phvs)>"
+
+
+def parse_priority_variables(content: Union[str, Iterable[str]]) -> List[PriorityVariable]:
+    """
+    Parse priority_variable-format text. `content` may be the file text or any iterable of lines
+    (e.g. an open file handle). Lines are consumed in a single forward pass; multi-line `function:`
+    text is accumulated as continuation lines arrive rather than by scanning ahead.
+    """
+    lines = io.StringIO(content) if isinstance(content, str) else content
+    variables = []
+
+    current_variable = None
+    current_phv_entry = None
+    current_value_set = None
+    current_class = None
+    # value set whose multi-line function text is still being read
+    function_value_set = None
+
+    for line in lines:
+        stripped = line.strip()
+
+        if function_value_set is not None:
+            # Function text continues until a key-only line or the next value
+            if not stripped.endswith(':') and not stripped.startswith('value:'):
+                if stripped and not stripped.startswith('#'):
+                    function_value_set.function += ' ' + stripped
+                continue
+            function_value_set = None
+
+        key, colon, rest = stripped.partition(':')
+        if not colon:
+            continue
+
+        if key == 'priority_variable':
+            current_variable = PriorityVariable()
+            variables.append(current_variable)
+
+        elif key == 'name' and current_variable is not None:
+            current_variable.name = rest.strip()
+
+        elif key in PHV_KEYS and current_variable is not None:
+            current_phv_entry = PhvEntry(intern(rest.strip()))
+            current_variable.phv_entries.append(current_phv_entry)
+
+        elif key in IDENTIFIER_KEYS and current_phv_entry is not None:
+            setattr(current_phv_entry, key, intern(rest.strip()))
+
+        elif key == 'input_data_type' and current_phv_entry is not None:
+            current_phv_entry.input_data_type = intern(rest.strip())
+
+        elif key == 'value' and current_phv_entry is not None:
+            current_value_set = ValueSet(intern(rest.strip()) if rest else 'default')
+            current_phv_entry.value_sets.append(current_value_set)
+
+        elif key == 'function' and current_value_set is not None:
+            current_value_set.function = rest.strip()
+            function_value_set = current_value_set
+
+        elif not rest and key in CLASS_TYPES and current_value_set is not None:
+            current_class = ClassEntry(intern(key))
+            current_value_set.classes.append(current_class)
+
+        elif current_class is not None and not stripped.startswith('#'):
+            if key not in NON_PROPERTY_KEYS:
+                current_class.properties[intern(key.strip())] = intern(rest.strip())
+
+    return variables
+
+
+# Line that is just indentation + word + colon (potential empty field)
+EMPTY_FIELD_RE = re.compile(r'^\s+\w+:\s*$')
+
+
+def clean_linkml_map_lines(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Remove empty field lines (lines ending with just ':') from LinkML-map lines
+    to make them compatible with yaml.safe_load.
+    Only removes lines where the next non-empty line is NOT more indented.
+
+    Works in one pass: a candidate empty field is held, along with any blank lines
+    after it, until the next non-empty line shows whether it has children.
+    Accepts lines with or without trailing newlines (e.g. an open file) and yields
+    lines without them, so '\n'.join() of the result matches the cleaned text.
+    """
+    pending = None      # (line, indent) of an empty field waiting on its next non-empty line
+    blanks = []         # blank lines seen since the pending field
+    ends_with_newline = True
+
+    def clean(line):
+        nonlocal pending
+        if not line.strip():
+            if pending is None:
+                yield line
+            else:
+                blanks.append(line)
+            return
+
+        indent = len(line) - len(line.lstrip())
+        if pending is not None:
+            pending_line, pending_indent = pending
+            if indent > pending_indent:
+                # Next line is more indented, so this is a parent with children
+                yield pending_line
+            yield from blanks
+            blanks.clear()
+            pending = None
+
+        if EMPTY_FIELD_RE.match(line):
+            pending = (line, indent)
+        else:
+            yield line
+
+    for raw in lines:
+        ends_with_newline = raw.endswith('\n')
+        yield from clean(raw[:-1] if ends_with_newline else raw)
+    if ends_with_newline:
+        # Text ending in a newline has a final empty line, as with str.split('\n')
+        yield from clean('')
+
+    # An empty field with nothing after it has no children; keep the trailing blank lines
+    yield from blanks
+
+
+def clean_linkml_map_content(content: str) -> str:
+    """Clean LinkML-map text that has already been read into memory"""
+    return '\n'.join(clean_linkml_map_lines(content.split('\n')))
+
+
+def clean_linkml_map_for_yaml(file_path) -> str:
+    """
+    Remove empty field lines (lines ending with just ':') from a LinkML-map file
+    to make it compatible with yaml.safe_load. See clean_linkml_map_lines.
+    """
+    with open(file_path, 'r') as f:
+        return '\n'.join(clean_linkml_map_lines(f))
+
+
+def read_priority_variables(file_path, clean: bool = False) -> List[PriorityVariable]:
+    """Parse a priority_variable file as it is read, optionally cleaned first (see clean_linkml_map_lines)"""
+    with open(file_path, 'r') as f:
+        return parse_priority_variables(clean_linkml_map_lines(f) if clean else f)
+
+
+# YAML
+
+def load_yaml(text: str, name: Optional[str] = None) -> Any:
+    """
+    yaml.load with the libyaml loader (raises yaml.YAMLError for invalid YAML; its messages give
+    `name` as the file the text came from)
+    """
+    if name is None:
+        return yaml.load(text, Loader=SafeLoader)
+    stream = io.StringIO(text)
+    stream.name = name
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+# class_derivations format
+
+# Quoted literals in expr (e.g. "'{beats}/min'") are text such as UCUM units, not variable references
+EXPR_LITERAL_RE = re.compile(r"'[^']*'|\"[^\"]*\"")
+
+
+class SlotDerivation:
+    """One slot derivation: where its values come from and how they are mapped"""
+    __slots__ = ('name', 'populated_from', 'expr', 'value', 'has_value', 'range', 'value_mappings', 'mapping_key',
+                 'unit_conversion', 'objects')
+
+    def __init__(self, name: str, spec: Any):
+        if not isinstance(spec, dict):
+            # `slot: constant` is shorthand for `slot: {value: constant}`
+            spec = {'value': spec}
+        self.name = intern(str(name))
+        self.populated_from = _intern(spec.get('populated_from'))
+        self.expr = spec.get('expr')
+        self.value = _intern(spec.get('value'))
+        self.has_value = 'value' in spec
+        self.range = _intern(spec.get('range'))
+        self.value_mappings = None
+        self.mapping_key = None
+        if isinstance(spec.get('value_mappings'), dict):
+            # Codes are compared as text, the way they are read from the tables
+            self.value_mappings = {intern(str(code)): _intern(target)
+                                   for code, target in spec['value_mappings'].items()}
+            # the same mapping in another derivation gives the same key (ingest_executor shares its categories)
+            self.mapping_key = tuple(sorted(self.value_mappings.items(), key=lambda item: item[0]))
+        self.unit_conversion = None
+        conversion = spec.get('unit_conversion')
+        if conversion and isinstance(conversion, dict):
+            self.unit_conversion = (_intern(conversion.get('source_unit')), _intern(conversion.get('target_unit')))
+        self.objects: List[Derivation] = []
+        for item in spec.get('object_derivations') or []:
+            if isinstance(item, dict) and isinstance(item.get('class_derivations'), dict):
+                self.objects.extend(_derivations(item['class_derivations'], None, None))
+
+    def phvs(self) -> Set[str]:
+        """Columns this slot reads: its populated_from, {phv} references in expr, and nested objects"""
+        phvs = set()
+        if isinstance(self.populated_from, str):
+            phvs.add(self.populated_from)
+        if self.expr is not None:
+            phvs.update(map(intern, PHV_REF_RE.findall(EXPR_LITERAL_RE.sub('', str(self.expr)))))
+        for derivation in self.objects:
+            phvs.update(derivation.phvs())
+        return phvs
+
+    def __repr__(self):
+        source = self.populated_from or self.expr or self.value
+        return f"<SlotDerivation {self.name} from {source!r}>"
+
+
+class Derivation:
+    """One class derivation: a target class, its source table (pht) and its slot derivations"""
+    __slots__ = ('class_name', 'table', 'slots', 'source', 'position')
+
+    def __init__(self, class_name: str, table: Optional[str], slots: List[SlotDerivation],
+                 source: Optional[str] = None, position: Optional[int] = None):
+        self.class_name = class_name
+        self.table = table
+        self.slots = slots
+        self.source = source
+        self.position = position
+
+    @classmethod
+    def from_spec(cls, class_name: str, body: Any, source: Optional[str] = None,
+                  position: Optional[int] = None) -> 'Derivation':
+        body = body if isinstance(body, dict) else {}
+        slots = [SlotDerivation(name, spec) for name, spec in (body.get('slot_derivations') or {}).items()]
+        return cls(intern(str(class_name)), _intern(body.get('populated_from')), slots, source, position)
+
+    def phvs(self) -> Set[str]:
+        """Every column the derivation reads, including from nested object derivations"""
+        phvs = set()
+        for slot in self.slots:
+            phvs.update(slot.phvs())
+        return phvs
+
+    def phts(self) -> Set[str]:
+        """Tables the derivation and its nested object derivations read from"""
+        phts = {self.table} if isinstance(self.table, str) else set()
+        for slot in self.slots:
+            for derivation in slot.objects:
+                phts.update(derivation.phts())
+        return phts
+
+    def __repr__(self):
+        return f"<Derivation {self.class_name} from {self.table} ({self.source}[{self.position}])>"
+
+
+def _derivations(class_derivations: Dict[str, Any], source: Optional[str], position: Optional[int]) -> List[Derivation]:
+    return [Derivation.from_spec(class_name, body, source, position) for class_name, body in class_derivations.items()]
+
+
+def parse_class_derivations(data: Any, source: Optional[str] = None) -> List[Derivation]:
+    """
+    Derivations of a loaded class_derivations document: a list of `class_derivations` items
+    (*-ingest specs) or a single top-level `class_derivations` mapping (LinkML-Map files such
+    as copdgene-linkml-map/person.yaml). Items without class_derivations are skipped.
+    """
+    items = [data] if isinstance(data, dict) else data or []
+    derivations = []
+    for position, item in enumerate(items):
+        if isinstance(item, dict) and isinstance(item.get('class_derivations'), dict):
+            derivations.extend(_derivations(item['class_derivations'], source, position))
+    return derivations
+
+
+def referenced_phvs(data: Any) -> Set[str]:
+    """
+    Every `populated_from: phv...` and `{phv...}` in an expr anywhere in a loaded document,
+    including in blocks the Derivation model does not read (check_phv_coverage.py). The context
+    columns read by CONTEXT_SLOTS are left out.
+    """
+    phvs = set()
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'populated_from' and isinstance(value, str) and PHV_RE.fullmatch(value):
+                    phvs.add(value)
+                elif key == 'expr' and value is not None:
+                    phvs.update(PHV_REF_RE.findall(EXPR_LITERAL_RE.sub('', str(value))))
+                elif key in CONTEXT_SLOTS and isinstance(value, dict):
+                    continue
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(node, list):
+            stack.extend(node)
+    return phvs
+
+
+def load_spec(spec_file: Path) -> List[Derivation]:
+    """
+    The derivations of a class_derivations spec file. Raises yaml.YAMLError if it is not valid
+    YAML, and ValueError if an item has no class_derivations mapping.
+    """
+    with open(spec_file, 'r', encoding='utf-8') as f:
+        data = load_yaml(f.read(), str(spec_file))
+    items = [data] if isinstance(data, dict) else data or []
+    for position, item in enumerate(items):
+        _check_item(item, f"item {position}")
+    return parse_class_derivations(data, str(spec_file))
+
+
+def _check_item(item: Any, where: str):
+    """ValueError naming `where` unless item and its nested object_derivations are class_derivations mappings"""
+    if not (isinstance(item, dict) and isinstance(item.get('class_derivations'), dict)):
+        raise ValueError(f"{where} has no class_derivations mapping")
+    for class_name, body in item['class_derivations'].items():
+        if not isinstance(body, dict):
+            raise ValueError(f"{where}: {class_name} is not a mapping")
+        for name, spec in (body.get('slot_derivations') or {}).items():
+            if isinstance(spec, dict):
+                for nested in spec.get('object_derivations') or []:
+                    _check_item(nested, f"{where}: {class_name}.{name}")
+
+
+# Spec files
+
+class SpecFile:
+    """A parsed spec file: its format and either priority variables or class derivations"""
+    __slots__ = ('path', 'format', 'variables', 'derivations', 'error')
+
+    def __init__(self, path: Path, spec_format: Optional[str]):
+        self.path = path
+        self.format = spec_format
+        self.variables: List[PriorityVariable] = []
+        self.derivations: List[Derivation] = []
+        self.error: Optional[str] = None
+
+    def phvs(self) -> Set[str]:
+        phvs = set()
+        for derivation in self.derivations:
+            phvs.update(phv for phv in derivation.phvs() if PHV_RE.fullmatch(phv))
+        for variable in self.variables:
+            phvs.update(entry.phv for entry in variable.phv_entries if entry.phv)
+        return phvs
+
+    def phts(self) -> Set[str]:
+        phts = set()
+        for derivation in self.derivations:
+            phts.update(derivation.phts())
+        for variable in self.variables:
+            phts.update(entry.pht for entry in variable.phv_entries if entry.pht)
+        return phts
+
+    def __repr__(self):
+        return f"<SpecFile {self.path} {self.format}>"
+
+
+def spec_format(text: str) -> Optional[str]:
+    """'class_derivations', 'priority_variable', or None for YAML that is neither"""
+    if CLASS_DERIVATIONS_RE.search(text):
+        return 'class_derivations'
+    if PRIORITY_VARIABLE_RE.search(text):
+        return 'priority_variable'
+    return None
+
+
+def parse_spec_text(text: str, path: Path = Path('<text>')) -> SpecFile:
+    spec = SpecFile(path, spec_format(text))
+    if spec.format == 'class_derivations':
+        try:
+            spec.derivations = parse_class_derivations(load_yaml(text), str(path))
+        except yaml.YAMLError as e:
+            spec.error = str(e).splitlines()[0] if str(e) else type(e).__name__
+    elif spec.format == 'priority_variable':
+        spec.variables = parse_priority_variables(text)
+    return spec
+
+
+def parse_spec_file(path: Path) -> SpecFile:
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return parse_spec_text(f.read(), Path(path))
+
+
+def find_spec_files(base_dir: Path) -> List[Path]:
+    return sorted(p for p in Path(base_dir).rglob('*') if p.suffix in ('.yaml', '.yml') and p.is_file())
+
+
+def parse_tree(base_dir: Path) -> Iterator[SpecFile]:
+    """Every spec file under base_dir, parsed"""
+    for path in find_spec_files(base_dir):
+        yield parse_spec_file(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse the transform specs and summarize what they contain')
+    parser.add_argument('dir', nargs='?', default=spec_dir, help=f'Directory to parse (default: {spec_dir})')
+    parser.add_argument('--verbose', '-v', action='store_true', help='List files that could not be parsed')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = {'class_derivations': 0, 'priority_variable': 0, None: 0}
+    errors = {}
+    derivations = variables = 0
+    phvs = set()
+    phts = set()
+    for spec in parse_tree(Path(args.dir)):
+        counts[spec.format] += 1
+        if spec.error:
+            errors[spec.path] = spec.error
+        derivations += len(spec.derivations)
+        variables += len(spec.variables)
+        phvs.update(spec.phvs())
+        phts.update(spec.phts())
+    elapsed = time.perf_counter() - start
+
+    print(f"{counts['class_derivations']} class_derivations file(s): {derivations} derivations, "
+          f"{len(errors)} not valid YAML")
+    print(f"{counts['priority_variable']} priority_variable file(s): {variables} variables")
+    print(f"{counts[None]} other YAML file(s)")
+    print(f"{len(phvs)} distinct phvs, {len(phts)} distinct tables; parsed in {elapsed:.2f}s")
+    if args.verbose:
+        for path, error in sorted(errors.items()):
+            print(f"  {path}: {error}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The spec tools are modules at the repository root rather than an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,97 @@
+import pandas as pd
+import pytest
+import yaml
+
+from ingest_executor.assemble import is_list_slot, merge, scatter, split_document
+from ingest_executor.executor import TableStore
+from spec_parser import parse_class_derivations
+
+# A Person with one Participant, whose demography comes from the enrollment table and whose
+# conditions (a list, from one derivation) come from the visit table
+SPEC = """\
+- class_derivations:
+    Person:
+      populated_from: enroll
+      slot_derivations:
+        identity:
+          populated_from: subject
+        participants:
+          object_derivations:
+          - class_derivations:
+              Participant:
+                populated_from: enroll
+                slot_derivations:
+                  identity:
+                    populated_from: subject
+                  demography:
+                    object_derivations:
+                    - class_derivations:
+                        Demography:
+                          populated_from: enroll
+                          slot_derivations:
+                            sex:
+                              populated_from: phv1
+                  conditions:
+                    object_derivations:
+                    - class_derivations:
+                        Condition:
+                          populated_from: visits
+                          slot_derivations:
+                            condition_status:
+                              populated_from: phv2
+"""
+
+
+def root(text=SPEC):
+    derivation, = parse_class_derivations(yaml.safe_load(text))
+    return derivation
+
+
+@pytest.fixture
+def store(tmp_path):
+    pd.DataFrame({'subject': ['1', '2'], 'phv1': ['F', 'M']}).to_csv(tmp_path / 'enroll.tsv', sep='\t', index=False)
+    pd.DataFrame({'subject': ['1', '3', '1'], 'phv2': ['PRESENT', 'ABSENT', 'HISTORICAL']}).to_csv(
+        tmp_path / 'visits.tsv', sep='\t', index=False)
+    return TableStore(tmp_path)
+
+
+def documents(store, spill_dir, partitions, chunk_size=0):
+    pieces = split_document(root())
+    scatter(pieces, store, 'subject', spill_dir, partitions, chunk_size)
+    return dict(merge(spill_dir, pieces))
+
+
+def test_merge(store, tmp_path):
+    found = documents(store, tmp_path, partitions=3)
+    assert sorted(found) == ['1', '2', '3']
+    participant, = found['1']['participants']
+    # a single object without lists below it is part of its parent's piece
+    assert participant['demography'] == {'sex': 'F'}
+    # conditions is multivalued, so its one derivation still gives a list, in table order
+    assert [condition['condition_status'] for condition in participant['conditions']] == ['PRESENT', 'HISTORICAL']
+    assert 'conditions' not in found['2']['participants'][0]
+    # a participant only the visit table knows still gets its parents
+    assert found['3'] == {'type': 'Person', 'participants': [
+        {'type': 'Participant', 'conditions': [{'type': 'Condition', 'condition_status': 'ABSENT'}]}]}
+
+
+def test_merge_does_not_depend_on_partitions_or_chunks(store, tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    assert documents(store, tmp_path / 'a', partitions=1) == documents(store, tmp_path / 'b', partitions=4,
+                                                                        chunk_size=1)
+
+
+def test_list_slots_come_from_bdchm():
+    person = root()
+    participants, = [slot for slot in person.slots if slot.objects]
+    assert is_list_slot(participants)
+    demography, conditions = [slot for slot in participants.objects[0].slots if slot.objects]
+    assert not is_list_slot(demography) and is_list_slot(conditions)
+
+    # a slot BDCHM makes single-valued can't take several objects, and an unknown slot isn't guessed
+    demography.objects.append(demography.objects[0])
+    with pytest.raises(ValueError, match='demography holds one object, but has 2 object_derivations'):
+        is_list_slot(demography)
+    with pytest.raises(ValueError, match='cannot tell whether diagnoses holds a list'):
+        split_document(root(SPEC.replace('conditions:', 'diagnoses:')))
@@ -0,0 +1,53 @@
+import json
+import shutil
+import sys
+
+import pandas as pd
+
+from ingest_executor import driver
+
+REPO_VISITS = 'priority_variables_transform/temporal/FHS/visit.yaml'
+
+# FHS-ingest's body weight at exam 2, which temporal/FHS/bdy_wgt.yaml restates with an empty age slot
+INGEST_WEIGHT = """\
+- class_derivations:
+    MeasurementObservation:
+      populated_from: pht000031
+      slot_derivations:
+        associated_participant:
+          populated_from: phv00008379
+        associated_visit:
+          value: FHS OFFSPRING EXAM 2
+        value_integer:
+          populated_from: phv00007676
+"""
+TEMPORAL_WEIGHT = INGEST_WEIGHT.replace('      slot_derivations:\n',
+                                        '      slot_derivations:\n        age_at_observation:\n')
+
+
+def test_temporal_specs_only_give_ages(tmp_path, monkeypatch):
+    specs = tmp_path / 'specs'
+    (specs / 'FHS-ingest').mkdir(parents=True)
+    (specs / 'temporal' / 'FHS').mkdir(parents=True)
+    (specs / 'FHS-ingest' / 'bdy_wgt.yaml').write_text(INGEST_WEIGHT)
+    (specs / 'temporal' / 'FHS' / 'bdy_wgt.yaml').write_text(TEMPORAL_WEIGHT)
+    shutil.copy(REPO_VISITS, specs / 'temporal' / 'FHS' / 'visit.yaml')
+    tables = tmp_path / 'tables' / 'FHS'
+    tables.mkdir(parents=True)
+    pd.DataFrame({'phv00177926': ['1', '2'], 'phv00177930': ['30', '41'], 'phv00177932': ['34', '45'],
+                  'phv00177934': ['38', '']}).to_csv(tables / 'pht003099.tsv', sep='\t', index=False)
+    pd.DataFrame({'phv00008379': ['1', '2', '3'], 'phv00007676': ['70', '80', '90']}).to_csv(
+        tables / 'pht000031.tsv', sep='\t', index=False)
+
+    output = tmp_path / 'output'
+    monkeypatch.setattr(sys, 'argv', ['driver', '--specs-root', str(specs), '--tables', str(tmp_path / 'tables'),
+                                      '--output', str(output), '--jobs', '1'])
+    assert driver.main() == 0
+
+    lines = [line for path in sorted((output / 'FHS').glob('*.jsonl')) for line in path.read_text().splitlines()]
+    records = [json.loads(line) for line in lines]
+    # each weight once, and no Visit records: temporal/FHS only builds the visit ages
+    assert len(lines) == len(set(lines)) == 3
+    assert {record['type'] for record in records} == {'MeasurementObservation'}
+    ages = {record['associated_participant']: record.get('age_at_observation') for record in records}
+    assert ages == {'1': 34.0, '2': 45.0, '3': None}
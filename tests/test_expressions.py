@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ingest_executor.expressions import ColumnEnv, ExprError, compile_expr
+
+TABLE = pd.DataFrame({'phv1': ['1', '2', None, '4'], 'phv2': ['10', '20', '30', None], 'phv3': ['Y', 'N', None, 'Y']})
+
+
+def evaluate(source):
+    return [None if value is None or value != value else value for value in compile_expr(source).evaluate(TABLE)]
+
+
+@pytest.mark.parametrize('source, expected', [
+    ('{phv1} * 2.54', [2.54, 5.08, None, 10.16]),
+    ('{phv1} + {phv2}', [11.0, 22.0, None, None]),
+    ('-{phv1} / 2', [-0.5, -1.0, None, -2.0]),
+    ('{phv1} / 0', [None, None, None, None]),
+    ("str({phv1}) + 'x'", ['1x', '2x', None, '4x']),
+    ("case(({phv1} == 1, 'one'), ({phv1} > 1, 'more'))", ['one', 'more', None, 'more']),
+    # bare names are the text they spell
+    ("case(({phv3} == Y, 'PRESENT'), ({phv3} == N, 'ABSENT'))", ['PRESENT', 'ABSENT', None, 'PRESENT']),
+    ("case(({phv1} > 2, 'high'))", [None, None, None, 'high']),
+    ('case(({phv1} > 1, {phv1}), (True, 0))', [0.0, 2.0, None, 4.0]),
+    ("'yes' if {phv1} > 1 else 'no'", ['no', 'yes', None, 'yes']),
+    ("{expr: {phv1} * 2}", [2.0, 4.0, None, 8.0]),
+])
+def test_evaluate(source, expected):
+    assert evaluate(source) == pytest.approx(expected)
+
+
+def test_constants_are_folded():
+    for source, value in [('2 * 3 + 1', 7), ('None == None', True), ('1 != None', True),
+                          ("case((1 > 2, 'a'), (True, 'b'))", 'b'), ("'a' + 'b'", 'ab')]:
+        program = compile_expr(source).program
+        assert program.is_constant and program.value == value
+        assert evaluate(source) == [value] * len(TABLE)
+    # a folded subexpression evaluates as if it had been written out
+    assert evaluate('{phv1} * (2 + 3)') == evaluate('{phv1} * 5')
+    # conditions known at compile time drop out of a case
+    assert evaluate("case((1 > 2, 'a'), ({phv1} > 1, 'b'))") == evaluate("case(({phv1} > 1, 'b'))")
+
+
+def test_missing_references_give_none():
+    # a variable the table lacks is empty in every row, and so is the expression
+    assert evaluate('{phv9} + 1') == [None] * len(TABLE)
+    assert evaluate('{phv1} == {phv9}') == [None] * len(TABLE)
+
+
+def test_compare_with_none():
+    expr = compile_expr('{phv1} == None')
+    # the comparison itself finds the empty row ...
+    np.testing.assert_array_equal(expr.program(ColumnEnv(TABLE, expr.refs)), [False, False, True, False])
+    # ... but, as for any expression, a row with an empty referenced variable gives None
+    assert evaluate('{phv1} == None') == [False, False, None, False]
+    assert evaluate('{phv1} != None') == [True, True, None, True]
+
+
+def test_unsupported():
+    with pytest.raises(ExprError, match='unsupported function max'):
+        compile_expr('max({phv1}, 1)')
+    with pytest.raises(ExprError, match='unexpected'):
+        compile_expr('{phv1} % 2')
@@ -0,0 +1,57 @@
+import argparse
+
+import pandas as pd
+import pytest
+
+from variable_documentation import generate_variable_documentation as gsheets
+
+SHEET = ('BDCHM Variable Mapping', 'BDCHM Harmonized Variables V1')
+
+
+@pytest.fixture
+def settings(monkeypatch, tmp_path):
+    monkeypatch.setitem(gsheets.SNAPSHOT_SETTINGS, 'dir', tmp_path)
+    monkeypatch.setitem(gsheets.SNAPSHOT_SETTINGS, 'offline', False)
+    return gsheets.SNAPSHOT_SETTINGS
+
+
+def offline_args(snapshot_dir):
+    parser = argparse.ArgumentParser()
+    gsheets.add_snapshot_arguments(parser)
+    return parser.parse_args(['--offline', '--snapshot-dir', str(snapshot_dir)])
+
+
+def test_offline_reads_snapshot(settings, tmp_path):
+    gsheets.apply_snapshot_arguments(offline_args(tmp_path))
+    pd.DataFrame({'a': ['x', None]}).to_parquet(gsheets.snapshot_path(*SHEET), index=False)
+    assert gsheets.load_gsheet_as_df(*SHEET)['a'].tolist() == ['x', '']
+
+
+def test_offline_without_snapshot(settings, tmp_path):
+    with pytest.raises(ValueError, match='no snapshot directory'):
+        gsheets.apply_snapshot_arguments(offline_args(tmp_path / 'missing'))
+    gsheets.apply_snapshot_arguments(offline_args(tmp_path))
+    with pytest.raises(FileNotFoundError, match='--offline, but there is no snapshot of BDCHM Variable Mapping'):
+        gsheets.load_gsheet_as_df(*SHEET)
+    gsheets.snapshot_path(*SHEET).write_text('not parquet')
+    with pytest.raises(ValueError, match='cannot read the snapshot'):
+        gsheets.load_gsheet_as_df(*SHEET)
+
+
+def test_offline_without_pyarrow(settings, tmp_path, monkeypatch):
+    monkeypatch.setattr(gsheets, 'HAVE_PYARROW', False)
+    with pytest.raises(ValueError, match='needs pyarrow'):
+        gsheets.apply_snapshot_arguments(offline_args(tmp_path))
+
+
+@pytest.mark.parametrize('sidecar', ['{"fetched_at": "2024-01-01T00:00:00+00:00"', '{}',
+                                     '{"fetched_at": "yesterday"}', '{"fetched_at": "2024-01-01T00:00:00"}'])
+def test_malformed_sidecar_is_stale(settings, monkeypatch, sidecar):
+    path = gsheets.snapshot_path(*SHEET)
+    pd.DataFrame({'a': ['old']}).to_parquet(path, index=False)
+    path.with_suffix('.json').write_text(sidecar)
+    monkeypatch.setitem(gsheets.SNAPSHOT_SETTINGS, 'max_age_hours', 1e9)
+    assert gsheets.snapshot_age_hours(*SHEET) is None
+    assert gsheets.needs_refresh(*SHEET)
+    monkeypatch.setattr(gsheets, 'fetch_gsheet_snapshot', lambda *sheet: pd.DataFrame({'a': ['new']}))
+    assert gsheets.load_gsheet_as_df(*SHEET)['a'].tolist() == ['new']
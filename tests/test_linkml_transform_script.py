@@ -0,0 +1,25 @@
+import shutil
+
+from priority_variables_transform.batch_converting import linkml_transform_script as script
+
+SOURCE = 'priority_variables_transform/ATTIC/chloride_bld.yaml'
+
+
+def test_incremental_failure_prunes_old_output(tmp_path, monkeypatch):
+    input_dir, output_dir = tmp_path / 'source', tmp_path / 'output'
+    input_dir.mkdir()
+    output_dir.mkdir()
+    input_file = input_dir / 'chloride_bld.yaml'
+    shutil.copy(SOURCE, input_file)
+    counts = script.run_batch([input_file], output_dir, incremental=True)
+    assert counts['transformed'] == 1 and (output_dir / input_file.name).exists()
+
+    def fail(self, content):
+        raise ValueError('bad source')
+
+    input_file.write_text(input_file.read_text() + '\n')
+    monkeypatch.setattr(script.LinkMLTransformer, 'transform_file', fail)
+    counts = script.run_batch([input_file], output_dir, incremental=True)
+    assert (counts['failed'], counts['pruned']) == (1, 1)
+    assert not (output_dir / input_file.name).exists()
+    assert input_file.name not in script.load_manifest(output_dir)
@@ -0,0 +1,169 @@
+import json
+
+import pandas as pd
+import pytest
+import yaml
+
+from ingest_executor.executor import TableStore, iter_records, json_lines
+from ingest_executor.planner import execute_plan, participant_columns, plan_derivations
+from spec_parser import parse_class_derivations
+
+# Exam table pht1 says who was measured; the value is in lab table pht2, whose participant column
+# is known from its own derivation
+SPECS = """\
+- class_derivations:
+    MeasurementObservation:
+      populated_from: pht1
+      slot_derivations:
+        associated_participant:
+          populated_from: phv1
+        observation_type:
+          value: OBA:1
+        value_quantity:
+          object_derivations:
+          - class_derivations:
+              Quantity:
+                populated_from: pht2
+                slot_derivations:
+                  value_decimal:
+                    populated_from: phv3
+                  unit:
+                    value: mg/L
+- class_derivations:
+    Observation:
+      populated_from: pht2
+      slot_derivations:
+        associated_participant:
+          populated_from: phv2
+        observation_type:
+          value: OBA:2
+"""
+
+
+def write_table(tables_dir, name, columns):
+    pd.DataFrame(columns).to_csv(tables_dir / f"{name}.tsv", sep='\t', index=False)
+
+
+@pytest.fixture
+def store(tmp_path):
+    write_table(tmp_path, 'pht1', {'phv1': ['1', '2', '3']})
+    # participant 3 has no lab row; participant 1 has two, and the first is used
+    write_table(tmp_path, 'pht2', {'phv2': ['2', '1', '1'], 'phv3': ['4.5', '7', '8']})
+    return TableStore(tmp_path)
+
+
+def derivations(text=SPECS):
+    return parse_class_derivations(yaml.safe_load(text), 'spec.yaml')
+
+
+def records(plans, store, **options):
+    found = []
+    for derivation, frame in execute_plan(plans, store, **options):
+        found.extend(iter_records(derivation.class_name, frame))
+    return found
+
+
+def lines(plans, store, **options):
+    found = []
+    for derivation, frame in execute_plan(plans, store, **options):
+        found.extend(json_lines(derivation.class_name, frame))
+    return found
+
+
+def test_nested_derivation_from_another_table_is_joined_by_participant(store):
+    plans = plan_derivations(derivations())
+    exam = plans[0]
+    assert exam.table == 'pht1' and exam.columns == {'phv1'}
+    join, = exam.joins
+    assert (join.table, join.key_column, join.table_keys) == ('pht2', 'phv1', ['phv2'])
+
+    observations = [record for record in records(plans, store) if record['type'] == 'MeasurementObservation']
+    assert [(record['associated_participant'], record.get('value_quantity')) for record in observations] == [
+        ('1', {'value_decimal': 7.0, 'unit': 'mg/L'}),
+        ('2', {'value_decimal': 4.5, 'unit': 'mg/L'}),
+        # participant 3 has no lab row, so no value: as for an empty value column, no record
+    ]
+
+
+def test_json_lines_match_records(store):
+    for derivation, frame in execute_plan(plan_derivations(derivations()), store):
+        lines = json_lines(derivation.class_name, frame)
+        assert lines == [json.dumps(record) for record in iter_records(derivation.class_name, frame)]
+    assert json_lines('Observation', frame.iloc[:0]) == []
+
+
+def test_json_lines_unhashable_values():
+    # a constant slot read from YAML as a mapping, like WHI-ingest/waist_hip.yaml's `value: {ratio}`
+    frame = pd.DataFrame({'associated_participant': ['1', '2', '3'],
+                          'value_quantity.value_decimal': pd.Series([{'ratio': None}, None, [1, 2]], dtype=object)})
+    assert json_lines('MeasurementObservation', frame) == [
+        json.dumps(record) for record in iter_records('MeasurementObservation', frame)]
+
+
+def test_join_in_chunks_matches_whole_table(store, capsys):
+    plans = plan_derivations(derivations())
+    # participant 1's second lab row is in a later chunk than the first
+    assert records(plans, store, chunk_size=1) == records(plans, store)
+    assert capsys.readouterr().out.count('pht2 has 1 repeated participant row(s)') == 2
+
+    stats = []
+    list(execute_plan(plans, store, chunk_size=2, stats=stats))
+    # the exam table's plan streams pht2 for its join, then pht2 is read again for its own plan
+    assert [(table_stats.table, table_stats.rows, table_stats.join_rows) for table_stats in stats] == [
+        ('pht1', 3, 3), ('pht2', 3, 0)]
+
+
+def test_chunks_match_whole_table(store):
+    # the Observation alone reads only pht2, with nothing to join; its value is 4.5 in the first
+    # row and a whole number in the others, so a chunk can hold whole numbers only
+    plan, = plan_derivations(derivations(SPECS.replace('value: OBA:2', 'value: OBA:2\n        value_decimal:\n'
+                                                                       '          populated_from: phv3'))[1:])
+    assert plan.joins == []
+    whole = records([plan], store)
+    assert [(record['associated_participant'], record['value_decimal']) for record in whole] == [
+        ('2', 4.5), ('1', 7.0), ('1', 8.0)]
+    whole_lines = lines([plan], store)
+    for chunk_size, frame_sizes in [(1, [1, 1, 1]), (2, [2, 1]), (5, [3])]:
+        frames = [frame for _, frame in execute_plan([plan], store, chunk_size=chunk_size)]
+        assert [len(frame) for frame in frames] == frame_sizes
+        assert records([plan], store, chunk_size=chunk_size) == whole
+        # the same text too: 7.0 rather than 7 from a chunk of whole numbers
+        assert lines([plan], store, chunk_size=chunk_size) == whole_lines
+
+
+def test_unjoinable_nested_derivation_fails_the_plan_unless_allowed(store, capsys):
+    # without the Observation, nothing says which column of pht2 identifies participants
+    specs = derivations()[:1]
+    with pytest.raises(ValueError, match="value_quantity of .* reads pht2, not pht1"):
+        plan_derivations(specs)
+
+    plan, = plan_derivations(specs, allow_drop=True)
+    assert 'skipping its Quantity' in capsys.readouterr().out
+    assert plan.joins == []
+    assert [record.get('value_quantity') for record in records([plan], store)] == [None, None, None]
+
+
+def test_missing_participant_column_fails_the_run(store, tmp_path):
+    write_table(tmp_path, 'pht2', {'phv3': ['4.5']})
+    plans = plan_derivations(derivations())
+    with pytest.raises(ValueError, match='cannot join value_quantity .* to pht2'):
+        records(plans, store)
+    # with allow_drop the Quantity is left out, rather than read from the exam table's rows
+    observations = [record for record in records(plans, store, allow_drop=True)
+                    if record['type'] == 'MeasurementObservation']
+    assert [record.get('value_quantity') for record in observations] == [None, None, None]
+
+
+def test_contextual_participant_columns_are_per_cohort(tmp_path):
+    contextual = tmp_path / 'contextual.csv'
+    contextual.write_text('data table pht,participant ID phv\npht2,phv9\n')
+    specs = [derivation for cohort in ('FHS', 'ARIC')
+             for derivation in parse_class_derivations(yaml.safe_load(SPECS), f"{cohort}-ingest/spec.yaml")]
+    fhs, aric = specs[:2], specs[2:]
+    assert participant_columns(fhs, {'FHS': contextual}) == {'pht1': ['phv1'], 'pht2': ['phv9', 'phv2']}
+    # FHS's table says nothing about another cohort's tables
+    assert participant_columns(aric, {'FHS': contextual}) == {'pht1': ['phv1'], 'pht2': ['phv2']}
+
+    # without the Observation, an ARIC exam table can't be joined to pht2
+    with pytest.raises(ValueError, match='ARIC has no contextual variables table'):
+        plan_derivations(aric[:1])
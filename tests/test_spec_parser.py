@@ -0,0 +1,192 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from spec_parser import (clean_linkml_map_content, clean_linkml_map_for_yaml, clean_linkml_map_lines, load_spec,
+                         load_yaml, parse_class_derivations, parse_priority_variables, read_priority_variables,
+                         referenced_phvs)
+
+REPO = Path(__file__).resolve().parent.parent
+
+PRIORITY_VARIABLE = """\
+priority_variable:
+  name: bdy_wgt
+    phv: phv00000001
+      identifiers:
+        phs: phs000007
+        pht: pht000031
+      input_data_type: decimal
+      value_set:
+        value:
+          function: add new MeasurementObservation,
+            transform units from lbs to kg
+          MeasurementObservation:
+            observation_type: OBA:VT0001259
+            associated_visit:
+            value_quantity:
+              unit: kg
+    raw_variable: WEIGHT
+      value_set:
+        value: 1
+          function: add new Condition
+          Condition:
+            condition_concept: OMOP:1
+        value: 0
+          Condition:
+            condition_status: absent
+"""
+
+
+# priority_variable format
+
+def test_parse_priority_variables():
+    variable, = parse_priority_variables(PRIORITY_VARIABLE)
+    assert variable.name == 'bdy_wgt'
+    first, second = variable.phv_entries
+    assert (first.phv, first.phs, first.pht) == ('phv00000001', 'phs000007', 'pht000031')
+    assert first.input_data_type == 'decimal'
+    value_set, = first.value_sets
+    assert value_set.value == 'default'
+    assert value_set.function == 'add new MeasurementObservation, transform units from lbs to kg'
+    measurement, = value_set.classes
+    assert measurement.type == 'MeasurementObservation'
+    # nested keys (value_quantity > unit) are flattened
+    expected = {'observation_type': 'OBA:VT0001259', 'associated_visit': '', 'unit': 'kg'}
+    assert expected.items() <= measurement.properties.items()
+    assert first.has_class('MeasurementObservation') and not first.has_class('Condition')
+
+    assert second.phv == 'WEIGHT' and second.pht == ''
+    assert [value_set.value for value_set in second.value_sets] == ['1', '0']
+    assert second.value_sets[0].function == 'add new Condition'
+    assert second.value_sets[1].function == ''
+    assert second.value_sets[1].classes[0].properties == {'condition_status': 'absent'}
+
+
+def test_parse_priority_variables_from_lines(tmp_path):
+    # an open file, read line by line, parses the same as its text
+    spec_file = tmp_path / 'bdy_wgt.yaml'
+    spec_file.write_text(PRIORITY_VARIABLE)
+    from_text = parse_priority_variables(PRIORITY_VARIABLE)
+    from_file = read_priority_variables(spec_file)
+    assert [repr(entry) for entry in from_file[0].phv_entries] == [repr(entry) for entry in from_text[0].phv_entries]
+    assert from_file[0].phv_entries[0].value_sets[0].function == from_text[0].phv_entries[0].value_sets[0].function
+
+
+def test_parse_priority_variables_several():
+    variables = parse_priority_variables(PRIORITY_VARIABLE + PRIORITY_VARIABLE.replace('bdy_wgt', 'bdy_hgt'))
+    assert [variable.name for variable in variables] == ['bdy_wgt', 'bdy_hgt']
+    assert parse_priority_variables('') == []
+    # lines before the first priority_variable have nothing to belong to
+    assert parse_priority_variables('phv: phv1\nvalue: 1\n') == []
+
+
+def test_parse_priority_variables_real_file():
+    variable, = read_priority_variables(REPO / 'priority_variables_transform/ATTIC/chloride_bld.yaml', clean=True)
+    assert variable.name == 'chloride_bld'
+    assert [entry.pht for entry in variable.phv_entries[:2]] == ['pht000031', 'pht001045']
+    assert all(entry.has_class('MeasurementObservation') for entry in variable.phv_entries)
+
+
+# Cleaners
+
+@pytest.mark.parametrize('text, cleaned', [
+    # empty fields without children are dropped
+    ('a:\n  b:\n  c: 1\n', 'a:\n  c: 1\n'),
+    # a field whose next line is more indented is a parent
+    ('a:\n  b:\n    c: 1\n', 'a:\n  b:\n    c: 1\n'),
+    # blank lines between an empty field and its child don't hide the child
+    ('a:\n  b:\n\n    c: 1\n', 'a:\n  b:\n\n    c: 1\n'),
+    # a trailing empty field is dropped, but the blank lines after it are kept
+    ('a:\n  b: 1\n  c:\n\n', 'a:\n  b: 1\n\n'),
+    # top-level keys and fields with values are not candidates
+    ('a:\nb: 1\n', 'a:\nb: 1\n'),
+    ('a:\n  b: 1', 'a:\n  b: 1'),
+    ('', ''),
+])
+def test_clean_linkml_map_content(text, cleaned):
+    assert clean_linkml_map_content(text) == cleaned
+    # lines with their newlines (an open file) clean to the same lines
+    assert '\n'.join(clean_linkml_map_lines(text.splitlines(keepends=True))) == cleaned
+
+
+def test_clean_linkml_map_for_yaml(tmp_path):
+    spec_file = tmp_path / 'spec.yaml'
+    spec_file.write_text('MeasurementObservation:\n  range_low:\n  value_quantity:\n    unit: kg\n  id:\n')
+    cleaned = clean_linkml_map_for_yaml(spec_file)
+    assert cleaned == 'MeasurementObservation:\n  value_quantity:\n    unit: kg\n'
+    assert yaml.safe_load(cleaned) == {'MeasurementObservation': {'value_quantity': {'unit': 'kg'}}}
+
+
+# load_yaml
+
+def test_load_yaml_names_the_file():
+    assert load_yaml('a:\n  b: 1\n') == {'a': {'b': 1}}
+    with pytest.raises(yaml.YAMLError, match='bad.yaml'):
+        load_yaml('a: 1\n b: 2\n', 'bad.yaml')
+
+
+# class_derivations format
+
+SPEC = """\
+- class_derivations:
+    MeasurementObservation:
+      populated_from: pht000031
+      slot_derivations:
+        associated_participant:
+          populated_from: phv00000001
+        associated_visit:
+          populated_from: phv00000002
+          value_mappings:
+            1: FHS EXAM 1
+            '2': FHS EXAM 2
+        observation_type: OBA:VT0001259
+        value_quantity:
+          object_derivations:
+          - class_derivations:
+              Quantity:
+                populated_from: pht000031
+                slot_derivations:
+                  value_decimal:
+                    expr: "{phv00000003} * 0.453592"
+                  unit:
+                    expr: "'{beats}/min'"
+"""
+
+
+def test_parse_class_derivations():
+    derivation, = parse_class_derivations(load_yaml(SPEC), 'bdy_wgt.yaml')
+    assert (derivation.class_name, derivation.table, derivation.source, derivation.position) == (
+        'MeasurementObservation', 'pht000031', 'bdy_wgt.yaml', 0)
+    participant, visit, observation_type, quantity = derivation.slots
+    assert participant.populated_from == 'phv00000001'
+    # mapping codes are text, as they are read from the tables
+    assert visit.value_mappings == {'1': 'FHS EXAM 1', '2': 'FHS EXAM 2'}
+    assert observation_type.has_value and observation_type.value == 'OBA:VT0001259'
+    nested, = quantity.objects
+    assert nested.class_name == 'Quantity'
+    # quoted literals in expr are not references
+    assert derivation.phvs() == {'phv00000001', 'phv00000002', 'phv00000003'}
+    assert derivation.phts() == {'pht000031'}
+
+
+def test_load_spec(tmp_path):
+    spec_file = tmp_path / 'bdy_wgt.yaml'
+    spec_file.write_text(SPEC + SPEC)
+    assert [derivation.position for derivation in load_spec(spec_file)] == [0, 1]
+
+    spec_file.write_text(SPEC.replace('- class_derivations:\n              Quantity',
+                                      '- class derivations:\n              Quantity'))
+    with pytest.raises(ValueError, match='value_quantity has no class_derivations'):
+        load_spec(spec_file)
+    # the lenient reader skips what it can't read
+    derivation, = parse_class_derivations(load_yaml(spec_file.read_text()))
+    assert derivation.slots[-1].objects == []
+
+
+def test_referenced_phvs():
+    data = load_yaml(SPEC + '- observations:\n    slot_derivations:\n      x:\n        populated_from: phv00000009\n')
+    # the participant and visit columns are context columns, not priority variables
+    assert referenced_phvs(data) == {'phv00000003', 'phv00000009'}
+    data = load_yaml(SPEC.replace('populated_from: phv00000001', 'expr: "{phv00000001}"'))
+    assert referenced_phvs(data) == {'phv00000003'}
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from ingest_executor.executor import TableStore, evaluate_derivation
+from ingest_executor.temporal import VisitAgeIndex, visit_index_for
+from spec_parser import parse_class_derivations
+
+REPO_VISITS = 'priority_variables_transform/temporal/FHS/visit.yaml'
+
+OBSERVATION = """\
+- class_derivations:
+    MeasurementObservation:
+      populated_from: pht000031
+      slot_derivations:
+        age_at_observation:
+        associated_participant:
+          populated_from: phv00008379
+        associated_visit:
+          value: FHS OFFSPRING EXAM 2
+        value_integer:
+          populated_from: phv00007676
+"""
+
+
+def test_lookup_by_participant_and_visit():
+    index = VisitAgeIndex(['1', '1', '2', '2'], ['EXAM 1', 'EXAM 2', 'EXAM 1', 'EXAM 1'], ['30', '34', '41', '99'])
+    # the first Visit record for a pair wins
+    assert len(index) == 3
+    ages = index.lookup(pd.Series(['1', '2', '1', '3', '2']), pd.Series(['EXAM 2', 'EXAM 1', 'EXAM 3', 'EXAM 1', None]))
+    np.testing.assert_array_equal(ages, [34.0, 41.0, np.nan, np.nan, np.nan])
+
+
+def test_lookup_categorical_visits():
+    index = VisitAgeIndex(['1', '2'], ['EXAM 1', 'EXAM 2'], ['30', '41'])
+    visits = pd.Series(pd.Categorical(['EXAM 2', 'EXAM 1', 'EXAM 9', None]))
+    np.testing.assert_array_equal(index.lookup(pd.Series(['2', '1', '1', '1']), visits), [41.0, 30.0, np.nan, np.nan])
+
+
+def test_fill_only_empty_ages():
+    index = VisitAgeIndex(['1', '2'], ['EXAM 2', 'EXAM 2'], ['34', '41'])
+    derivation, = parse_class_derivations(yaml.safe_load(OBSERVATION))
+    frame = pd.DataFrame({'age_at_observation': [np.nan, 50.0, np.nan], 'associated_participant': ['1', '2', '3'],
+                          'associated_visit': ['EXAM 2', 'EXAM 2', 'EXAM 2']})
+    filled = index.fill(derivation, frame)
+    np.testing.assert_array_equal(filled['age_at_observation'], [34.0, 50.0, np.nan])
+
+
+@pytest.fixture
+def fhs_tables(tmp_path):
+    # the visit table read by temporal/FHS/visit.yaml, and the exam 2 table of temporal/FHS/bdy_wgt.yaml
+    pd.DataFrame({'phv00177926': ['1', '2'], 'phv00177930': ['30', '41'], 'phv00177932': ['34', '45'],
+                  'phv00177934': ['38', '']}).to_csv(tmp_path / 'pht003099.tsv', sep='\t', index=False)
+    pd.DataFrame({'phv00008379': ['1', '2', '3'], 'phv00007676': ['70', '80', '90']}).to_csv(
+        tmp_path / 'pht000031.tsv', sep='\t', index=False)
+    return TableStore(tmp_path)
+
+
+def test_fhs_visit_spec_ages(fhs_tables):
+    # the FHS Visit derivations carry no visit label; VISIT_LABELS gives them theirs
+    with open(REPO_VISITS, 'r', encoding='utf-8') as f:
+        visits = parse_class_derivations(yaml.safe_load(f))
+    index = visit_index_for(visits, fhs_tables)
+    assert len(index) == 5
+    derivation, = parse_class_derivations(yaml.safe_load(OBSERVATION))
+    frame = evaluate_derivation(derivation, fhs_tables.load('pht000031', derivation.phvs()))
+    filled = index.fill(derivation, frame)
+    np.testing.assert_array_equal(filled['age_at_observation'], [34.0, 45.0, np.nan])
+
+
+def test_visit_without_label_is_reported(fhs_tables, capsys):
+    visits = parse_class_derivations(yaml.safe_load("""\
+- class_derivations:
+    Visit:
+      populated_from: pht003099
+      slot_derivations:
+        associated_participant:
+          populated_from: phv00177926
+        age_at_visit_start:
+          populated_from: phv00177999
+"""))
+    assert len(visit_index_for(visits, fhs_tables)) == 0
+    assert 'no visit label for phv00177999' in capsys.readouterr().out
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ingest_executor.units import UnitEngine, default_engine
+
+
+def test_fahrenheit_to_celsius():
+    engine = default_engine()
+    np.testing.assert_allclose(engine.convert(np.array([32.0, 98.6, 212.0]), '[degF]', 'Cel'), [0.0, 37.0, 100.0])
+    # the inverse carries the offset too, and aliases resolve before the lookup
+    np.testing.assert_allclose(engine.convert(pd.Series([-40.0, 37.0]), 'C', '[degF]'), [-40.0, 98.6])
+    np.testing.assert_allclose(engine.convert_column(['212', '37', ''], ['[degF]', 'Cel', '[degF]'], 'Cel'),
+                               [100.0, 37.0, np.nan])
+
+
+def test_chained_and_missing_conversions():
+    engine = UnitEngine([('[lb_av]', {'pounds', 'lbs'})], ['[lb_av]', 'kg', 'g', 'mmol/L', 'mg/dL'],
+                        {('[lb_av]', 'kg'): (0.453592, 0.0), ('kg', 'g'): (1000.0, 0.0)},
+                        {('mmol/L', 'mg/dL'): 'molar mass'})
+    assert engine.convert(10, 'Pounds', 'g') == pytest.approx(4535.92)
+    assert engine.convert(500, 'g', 'lbs') == pytest.approx(500 / 453.592)
+    with pytest.raises(ValueError, match=r'mmol/L to mg/dL needs a formula \(molar mass\)'):
+        engine.convert(1, 'mmol/L', 'mg/dL')
+    with pytest.raises(ValueError, match='not a UCUM unit: furlongs'):
+        engine.convert(1, 'furlongs', 'kg')
@@ -4,9 +4,17 @@ Generate pre-harmonized data counts by variable and PHV, filtered to Corey's PHV
 Creates a CSV report compatible with the Data Harmonization Supplementary Data template.
 """
 
+import argparse
 import pandas as pd
 from pathlib import Path
-from variable_documentation.generate_variable_documentation import load_gsheet_as_df
+from variable_documentation.generate_variable_documentation import (
+    add_snapshot_arguments, apply_snapshot_arguments, load_gsheet_as_df, prefetch_gsheets)
+
+# (spreadsheet, worksheet) for each source sheet
+BDCHM_SHEET = ("Export_BDCHM_noFHS-noCOPDGene_phv_mappings", "Export_BDCHM_noFHS-noCOPDGene_p")
+FHS_SHEET = ("FHS_VariableProperties", "right_join_full")
+COPDGENE_SHEET = ("COPDGene_FullMatchWithManuals_Join_Dedup_XML_BDC Mapped Variables V1",
+                  "COPDGene_FullMatchWithManuals_J")
 
 
 def load_valid_phvs():
@@ -57,8 +65,7 @@ def parse_stats_column(stats_str):
 def load_from_bdchm_sheet():
     """Load data from the BDCHM Google Sheet and return normalized DataFrame."""
     try:
-        sheet = load_gsheet_as_df("Export_BDCHM_noFHS-noCOPDGene_phv_mappings", 
-                                 "Export_BDCHM_noFHS-noCOPDGene_p")
+        sheet = load_gsheet_as_df(*BDCHM_SHEET)
     except Exception as e:
         print(f"Error loading BDCHM Google Sheet: {e}")
         return None
@@ -77,8 +84,7 @@ def load_from_bdchm_sheet():
 def load_from_fhs_sheet():
     """Load data from the FHS Google Sheet and return normalized DataFrame."""
     try:
-        sheet = load_gsheet_as_df("FHS_VariableProperties",
-                                  "right_join_full")
+        sheet = load_gsheet_as_df(*FHS_SHEET)
     except Exception as e:
         print(f"Error loading FHS Google Sheet: {e}")
         return None
@@ -98,9 +104,7 @@ def load_from_fhs_sheet():
 def load_from_copdgene_sheet():
     """Load data from the COPDGene Google Sheet and return normalized DataFrame."""
     try:
-        sheet = load_gsheet_as_df(
-            "COPDGene_FullMatchWithManuals_Join_Dedup_XML_BDC Mapped Variables V1",
-            "COPDGene_FullMatchWithManuals_J")
+        sheet = load_gsheet_as_df(*COPDGENE_SHEET)
     except Exception as e:
         print(f"Error loading FHS Google Sheet: {e}")
         return None
@@ -120,6 +124,9 @@ def load_source_data():
     """Load and merge data from all source sheets."""
     print("Loading data from Google Sheets...")
     
+    # Download any stale sheets concurrently; the loaders below then read local snapshots
+    prefetch_gsheets([BDCHM_SHEET, FHS_SHEET, COPDGENE_SHEET])
+    
     # Load from BDCHM sheet
     bdchm_df = load_from_bdchm_sheet()
     fhs_df = load_from_fhs_sheet()
@@ -130,13 +137,17 @@ def load_source_data():
     return combined_df
 
 
-def generate_report():
-    """Generate the pre-harmonized data report."""
+def generate_report(sheet=None, output_file=None):
+    """
+    Generate the pre-harmonized data report. The source data is loaded from the sheets unless
+    given as `sheet`; the CSV goes to preharmonized_qaqc_report.csv unless `output_file` is given.
+    """
     print("Loading PHV lists...")
     valid_phvs = load_valid_phvs()
     
     # Load source data
-    sheet = load_source_data()
+    if sheet is None:
+        sheet = load_source_data()
     if sheet is None:
         return None
     
@@ -145,66 +156,41 @@ def generate_report():
     priority_variables = sheet['bdchm_label'].dropna().unique()
     print(f"Found {len(priority_variables)} priority variables")
     
-    # Initialize result structure
-    results = {}
-    cohorts_in_data = set()
     cohorts_with_valid_phvs = set(valid_phvs.keys())
     
-    # Process each row
-    for idx, row in sheet.iterrows():
-        variable = row['bdchm_label']
-        phv = row['phv']
-        cohort = row['cohort']
-        n_value = row['n_stats']
-        
-        if pd.isna(variable) or pd.isna(phv) or pd.isna(cohort):
-            continue
-            
-        cohorts_in_data.add(cohort)
-        
-        # Skip only if cohort has valid PHV list and PHV not in that list
-        if cohort in valid_phvs and phv not in valid_phvs[cohort]:
-            continue
-        
-        # Initialize variable entry
-        if variable not in results:
-            results[variable] = {}
-        
-        # Initialize cohort entry for variable
-        if cohort not in results[variable]:
-            results[variable][cohort] = {'phvs': set(), 'total_n': 0}
-        
-        # Add PHV and accumulate n
-        results[variable][cohort]['phvs'].add(phv)
-        results[variable][cohort]['total_n'] += n_value
-    
-    # Generate CSV data
-    csv_rows = []
+    # Drop incomplete rows
+    rows = sheet[['bdchm_label', 'phv', 'cohort', 'n_stats']].dropna(subset=['bdchm_label', 'phv', 'cohort'])
+    cohorts_in_data = set(rows['cohort'].unique())
+    
+    # Skip only if cohort has valid PHV list and PHV not in that list: a left join against
+    # the (cohort, phv) pairs from valid-phvs marks which rows are on their cohort's list
+    valid_pairs = pd.DataFrame(
+        [(cohort, phv) for cohort, phvs in valid_phvs.items() for phv in phvs],
+        columns=['cohort', 'phv'], dtype=object)
+    valid_pairs['is_valid_phv'] = True
+    rows = rows.merge(valid_pairs, on=['cohort', 'phv'], how='left')
+    keep = rows['is_valid_phv'].notna() | ~rows['cohort'].isin(cohorts_with_valid_phvs)
+    rows = rows[keep]
+    
+    # Count distinct PHVs and accumulate n per variable/cohort
+    counts = rows.groupby(['bdchm_label', 'cohort']).agg(phv=('phv', 'nunique'), n=('n_stats', 'sum'))
+    
+    # Pivot to one row per variable with {cohort}_phv, {cohort}_n column pairs
     all_cohorts = sorted(cohorts_with_valid_phvs.union(cohorts_in_data))
+    columns = pd.MultiIndex.from_tuples([(stat, cohort) for cohort in all_cohorts for stat in ('phv', 'n')])
+    wide = counts.unstack('cohort').reindex(columns=columns)
+    wide.columns = [f'{cohort}_{stat}' for stat, cohort in wide.columns]
+    wide = wide.reindex(sorted(wide.index))
     
-    for variable in sorted(priority_variables):
-        if variable not in results:
-            continue
-            
-        row_data = {'variable': variable}
-        
-        for cohort in all_cohorts:
-            if variable in results and cohort in results[variable]:
-                phv_count = len(results[variable][cohort]['phvs'])
-                total_n = results[variable][cohort]['total_n']
-                row_data[f'{cohort}_phv'] = phv_count
-                row_data[f'{cohort}_n'] = total_n
-            else:
-                row_data[f'{cohort}_phv'] = ''
-                row_data[f'{cohort}_n'] = ''
-        
-        csv_rows.append(row_data)
+    # Empty cells where a variable has no valid data for a cohort
+    wide = wide.astype('Int64').astype(object).where(wide.notna(), '').infer_objects()
     
     # Create DataFrame
-    df = pd.DataFrame(csv_rows)
+    df = wide.rename_axis('variable').reset_index() if len(wide) else pd.DataFrame()
     
     # Save CSV
-    output_file = Path(__file__).parent / "preharmonized_qaqc_report.csv"
+    if output_file is None:
+        output_file = Path(__file__).parent / "preharmonized_qaqc_report.csv"
     df.to_csv(output_file, index=False)
     
     print(f"\nReport saved to: {output_file}")
@@ -225,4 +211,10 @@ def generate_report():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate preharmonized_qaqc_report.csv")
+    add_snapshot_arguments(parser)
+    try:
+        apply_snapshot_arguments(parser.parse_args())
+    except ValueError as e:
+        parser.error(str(e))
     generate_report()
\ No newline at end of file
@@ -1,36 +1,428 @@
+"""
+Validate every file in a `*-ingest` directory under priority_variables_transform.
+
+By default only YAML syntax is checked. With --schema, the parsed class_derivations
+tree is also checked for structural errors (missing associated_participant, slot
+derivations without a source, malformed {phv...} references in expr, etc.), and every
+phv a file references is checked against its cohort's list in transform_assessment/valid-phvs
+(`<cohort>-ingest.tsv`). The lists leave out context columns, so the phvs read by
+associated_participant and associated_visit are not checked, and neither are the files of
+cohorts without a list. A few curated specs are known not to pass --schema; SCHEMA_ALLOWLIST
+names them with the reason, and their errors are counted but don't fail the run. Any other file
+with errors does, so the check can gate a build. With --report-only, the errors found are printed
+but the exit status is always 0.
+
+Usage:
+    python validate_ingest_yamls.py
+    python validate_ingest_yamls.py --schema
+    python validate_ingest_yamls.py --jobs 0 --cache .validate_ingest_cache.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import yaml
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from spec_parser import CONTEXT_SLOTS, EXPR_LITERAL_RE, PHV_RE, SafeLoader, load_yaml
+
+# Bump when the checks performed on each file change, so cached results are invalidated
+VALIDATOR_VERSION = 5
 
 ingest_dir = "./priority_variables_transform"
-base_dir = Path(ingest_dir)
+valid_phvs_dir = "./transform_assessment/valid-phvs"
+
+# Keys a slot derivation may use, and the ones that supply its value (exactly one is required)
+SLOT_KEYS = {'populated_from', 'value', 'expr', 'value_mappings', 'unit_conversion', 'range', 'object_derivations'}
+SLOT_SOURCES = ('populated_from', 'value', 'expr', 'object_derivations')
+
+# A case(...) expr takes precedence over a populated_from (and its value_mappings) on the same slot,
+# which some curated specs keep alongside it
+CASE_EXPR_RE = re.compile(r'^\s*case\s*\(')
+
+# Top-level classes that describe a participant's data and so must say whose data it is
+PARTICIPANT_CLASSES = {
+    'MeasurementObservation', 'MeasurementObservationSet', 'Condition', 'DrugExposure', 'Observation',
+    'Procedure', 'Demography', 'CauseOfDeath', 'SdohObservation',
+}
+
+EXPR_BRACES_RE = re.compile(r'[{}]')
+
+# Curated specs (relative to --dir) known to fail --schema, and why; their errors are reported
+# without failing the run. Remove a file's entry once it is fixed, so it stays fixed.
+_COPDGENE_NO_PARTICIPANT = 'Condition derivations have no associated_participant'
+SCHEMA_ALLOWLIST = {
+    'CHS-ingest/hrtrt.yaml': "value_decimal exprs are nested '{expr: {phv} * 2}' mappings",
+    'COPDGene-ingest/copd.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/diabetes.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/hist_hrt_failure.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/hist_my_inf.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/hyperten.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/pad.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/slp_ap.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/stroke.yaml': _COPDGENE_NO_PARTICIPANT,
+    'COPDGene-ingest/stroke_isch_atk.yaml': _COPDGENE_NO_PARTICIPANT,
+    'FHS-ingest/pr_qrs_qt.yaml': 'MeasurementObservationSet method_type and observations are not slot derivations',
+    'FHS-ingest/ven_thromb.yaml': 'derivations have no associated_participant',
+    'FHS-ingest/waist_circ.yaml': 'derivations have no associated_participant',
+}
+
+
+def cohort_of(spec_file: Path) -> str:
+    """Cohort key of a spec file, from its *-ingest directory (FHS-ingest -> fhs)"""
+    for part in spec_file.parts:
+        if part.endswith('-ingest'):
+            return part[:-len('-ingest')].lower()
+    return ''
+
+
+def load_valid_phvs(valid_dir: Path) -> Dict[str, Set[str]]:
+    """cohort -> set of valid phvs, from valid-phvs/<cohort>-ingest.tsv (one phv per line)"""
+    valid = {}
+    for tsv_file in sorted(Path(valid_dir).glob('*-ingest.tsv')):
+        with open(tsv_file, 'r', encoding='utf-8') as f:
+            valid[tsv_file.stem[:-len('-ingest')].lower()] = set(PHV_RE.findall(f.read()))
+    return valid
+
+
+def check_expr(expr: Any, path: str, errors: List[str], known_phvs: Optional[Set[str]] = None):
+    """
+    Check that every {...} in an expr is a balanced, well-formed {phv...} reference, and with
+    known_phvs, that it references one of them
+    """
+    if not isinstance(expr, (str, int, float)):
+        errors.append(f"{path}: expr must be a string, got {type(expr).__name__}")
+        return
+    text = EXPR_LITERAL_RE.sub('', str(expr))
+    start = None
+    for match in EXPR_BRACES_RE.finditer(text):
+        if match.group() == '{':
+            if start is not None:
+                errors.append(f"{path}: nested '{{' in expr {expr!r}")
+                return
+            start = match.end()
+        else:
+            if start is None:
+                errors.append(f"{path}: unmatched '}}' in expr {expr!r}")
+                return
+            ref = text[start:match.start()]
+            if not PHV_RE.fullmatch(ref):
+                errors.append(f"{path}: expr references {{{ref}}}, which is not a phv")
+            elif known_phvs is not None and ref not in known_phvs:
+                errors.append(f"{path}: expr references {{{ref}}}, which is not on the cohort's valid-phvs list")
+            start = None
+    if start is not None:
+        errors.append(f"{path}: unclosed '{{' in expr {expr!r}")
+
+
+def check_slot_derivation(slot: Dict, path: str, errors: List[str], pending: List,
+                          known_phvs: Optional[Set[str]] = None, name: str = ''):
+    """
+    Check one slot derivation, queueing any nested object_derivations onto pending. With
+    known_phvs, the phvs it reads must be among them (unless it is one of CONTEXT_SLOTS).
+    """
+    if name in CONTEXT_SLOTS:
+        known_phvs = None
+    unknown = [key for key in slot if key not in SLOT_KEYS]
+    if unknown:
+        errors.append(f"{path}: unknown key(s) {', '.join(map(str, unknown))}")
+
+    sources = [key for key in SLOT_SOURCES if key in slot]
+    if sources == ['populated_from', 'expr'] and CASE_EXPR_RE.match(str(slot['expr'])):
+        sources = ['expr']
+    if not sources:
+        errors.append(f"{path}: needs one of {', '.join(SLOT_SOURCES)}")
+    elif len(sources) > 1:
+        errors.append(f"{path}: has more than one source ({', '.join(sources)})")
+
+    if 'populated_from' in slot:
+        populated_from = slot['populated_from']
+        if not isinstance(populated_from, str) or not populated_from.strip() or ' ' in populated_from.strip():
+            errors.append(f"{path}.populated_from: must be a single variable name, got {populated_from!r}")
+        elif known_phvs is not None and PHV_RE.fullmatch(populated_from) and populated_from not in known_phvs:
+            errors.append(f"{path}.populated_from: {populated_from} is not on the cohort's valid-phvs list")
+
+    if 'expr' in slot:
+        check_expr(slot['expr'], f"{path}.expr", errors, known_phvs)
+
+    if 'value_mappings' in slot:
+        if not isinstance(slot['value_mappings'], dict) or not slot['value_mappings']:
+            errors.append(f"{path}.value_mappings: must be a non-empty mapping")
+        if 'populated_from' not in slot:
+            errors.append(f"{path}.value_mappings: requires populated_from")
+
+    if 'unit_conversion' in slot:
+        conversion = slot['unit_conversion']
+        if not isinstance(conversion, dict):
+            errors.append(f"{path}.unit_conversion: must be a mapping")
+        else:
+            for key in ('source_unit', 'target_unit'):
+                if not conversion.get(key):
+                    errors.append(f"{path}.unit_conversion: missing {key}")
+        if 'populated_from' not in slot and 'expr' not in slot:
+            errors.append(f"{path}.unit_conversion: requires populated_from or expr")
+
+    if 'object_derivations' in slot:
+        object_derivations = slot['object_derivations']
+        if not isinstance(object_derivations, list) or not object_derivations:
+            errors.append(f"{path}.object_derivations: must be a non-empty list")
+        else:
+            for i, item in enumerate(object_derivations):
+                pending.append((item, f"{path}.object_derivations[{i}]", True))
+
+
+def check_class_derivations(data: Any, known_phvs: Optional[Set[str]] = None) -> List[str]:
+    """
+    Structurally check a parsed *-ingest file: a list of {class_derivations: {Class: {...}}},
+    reading only known_phvs if given. The tree is walked once, iteratively, and every error
+    found is returned.
+    """
+    errors = []
+    if data is None:
+        # nothing but comments, e.g. a spec whose derivations are all commented out
+        return []
+    if not isinstance(data, list):
+        return [f"top level must be a list of class_derivations, got {type(data).__name__}"]
+
+    pending = [(item, f"[{i}]", False) for i, item in enumerate(data)]
+    while pending:
+        item, path, nested = pending.pop()
+        if not isinstance(item, dict) or not isinstance(item.get('class_derivations'), dict):
+            errors.append(f"{path}: must be a mapping with a class_derivations mapping")
+            continue
+        for class_name, body in item['class_derivations'].items():
+            class_path = f"{path}.class_derivations.{class_name}"
+            if not isinstance(body, dict):
+                errors.append(f"{class_path}: must be a mapping")
+                continue
+            if not body.get('populated_from') or not isinstance(body['populated_from'], str):
+                errors.append(f"{class_path}: missing populated_from table")
+            slots = body.get('slot_derivations')
+            if not isinstance(slots, dict) or not slots:
+                errors.append(f"{class_path}: missing slot_derivations")
+                continue
+            if not nested and class_name in PARTICIPANT_CLASSES and 'associated_participant' not in slots:
+                errors.append(f"{class_path}.slot_derivations: missing associated_participant")
+            for slot_name, slot in slots.items():
+                slot_path = f"{class_path}.slot_derivations.{slot_name}"
+                if not isinstance(slot, dict):
+                    errors.append(f"{slot_path}: must be a mapping, got {slot!r}")
+                    continue
+                check_slot_derivation(slot, slot_path, errors, pending, known_phvs, slot_name)
+
+    # pending is a stack, so restore document order for reporting
+    return sorted(errors, key=_error_sort_key)
+
+
+def _error_sort_key(error: str):
+    return [int(part) if part.isdigit() else part for part in re.split(r'\[(\d+)\]', error.split(':', 1)[0])]
+
 
-yaml_files = list(base_dir.rglob("*.yaml"))
-ingest_files = [f for f in yaml_files if any("-ingest" in part for part in f.parts)]
+def find_ingest_files(base_dir: Path) -> List[Path]:
+    """Find every *.yaml file that lives in a directory with '-ingest' in its path"""
+    yaml_files = sorted(base_dir.rglob("*.yaml"))
+    return [f for f in yaml_files if any("-ingest" in part for part in f.parts)]
 
-if not ingest_files:
-    print(f"No YAML files in directories with '-ingest' found under {base_dir}")
 
-all_valid = True
-invalid_files = []
-for file in ingest_files:
+def file_digest(content: bytes) -> str:
+    """Content hash used as the cache key for a file"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def validate_content(content: bytes, schema: bool = False, known_phvs: Optional[Set[str]] = None) -> List[str]:
+    """Parse YAML content (and optionally check its structure and phvs), returning all errors found"""
     try:
-        with file.open("r", encoding="utf-8") as f:
-            yaml.safe_load(f)
-        # print(f"✅ {file} is valid")
+        data = load_yaml(content.decode('utf-8'))
     except Exception as e:
-        all_valid = False
-        invalid_files.append(file)
-        print(f"❌ {file} is invalid: {e}")
-
-print(f"\n{'='*80}")
-print(f"Summary: {len(ingest_files) - len(invalid_files)}/{len(ingest_files)} files valid")
-if invalid_files:
-    print(f"\n❌ {len(invalid_files)} invalid file(s):")
+        return [str(e)]
+    if schema:
+        return check_class_derivations(data, known_phvs)
+    return []
+
+
+def validate_file(path: str, schema: bool = False, known_phvs: Optional[Set[str]] = None) -> Tuple[str, List[str]]:
+    """Read and validate a single file; returns (path, errors). Runs in worker processes."""
+    try:
+        content = Path(path).read_bytes()
+    except OSError as e:
+        return path, [str(e)]
+    return path, validate_content(content, schema, known_phvs)
+
+
+def valid_phvs_digest(valid_phvs: Optional[Dict[str, Set[str]]]) -> Optional[str]:
+    """Hash of the valid-phvs lists, so cached results are invalidated when a list changes"""
+    if not valid_phvs:
+        return None
+    digest = hashlib.sha256()
+    for cohort, phvs in sorted(valid_phvs.items()):
+        digest.update(f"{cohort}:{','.join(sorted(phvs))}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_cache(cache_file: Optional[Path], schema: bool = False, phvs_digest: Optional[str] = None) -> Dict[str, str]:
+    """Load the path -> content hash map of files that previously validated in the same mode"""
+    if cache_file is None or not cache_file.exists():
+        return {}
+    try:
+        with cache_file.open("r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable cache {cache_file}: {e}")
+        return {}
+    if (cache.get('validator_version') != VALIDATOR_VERSION or cache.get('loader') != SafeLoader.__name__
+            or cache.get('schema') != schema or cache.get('valid_phvs') != phvs_digest):
+        return {}
+    return cache.get('files', {})
+
+
+def save_cache(cache_file: Optional[Path], valid_hashes: Dict[str, str], schema: bool = False,
+               phvs_digest: Optional[str] = None):
+    """Write the hashes of all currently valid files"""
+    if cache_file is None:
+        return
+    cache = {
+        'validator_version': VALIDATOR_VERSION,
+        'loader': SafeLoader.__name__,
+        'schema': schema,
+        'valid_phvs': phvs_digest,
+        'files': dict(sorted(valid_hashes.items())),
+    }
+    tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+    with tmp_file.open("w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=1)
+    tmp_file.replace(cache_file)
+
+
+def validate_files(ingest_files: List[Path], jobs: int = 1, cache_file: Optional[Path] = None,
+                   schema: bool = False, valid_phvs: Optional[Dict[str, Set[str]]] = None
+                   ) -> Tuple[Dict[Path, List[str]], int]:
+    """
+    Validate files, skipping those whose content hash matches the cache. With schema and
+    valid_phvs ({cohort: phvs}), each file's phvs are checked against its cohort's list.
+    Returns ({file: errors} for invalid files, number of files skipped via the cache).
+    """
+    if not schema:
+        valid_phvs = None
+    phvs_digest = valid_phvs_digest(valid_phvs)
+    cache = load_cache(cache_file, schema, phvs_digest)
+    hashes = {}
+    to_check = []
+    for file in ingest_files:
+        key = file.as_posix()
+        try:
+            hashes[key] = file_digest(file.read_bytes())
+        except OSError:
+            to_check.append(key)
+            continue
+        if cache.get(key) != hashes[key]:
+            to_check.append(key)
+    skipped = len(ingest_files) - len(to_check)
+    known = [(valid_phvs or {}).get(cohort_of(Path(path))) for path in to_check]
+
+    if jobs != 1 and len(to_check) > 1:
+        workers = jobs if jobs > 0 else (os.cpu_count() or 1)
+        # Big chunks keep IPC overhead low; map preserves input order
+        chunksize = max(1, len(to_check) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(validate_file, to_check, [schema] * len(to_check), known, chunksize=chunksize))
+    else:
+        results = [validate_file(path, schema, known_phvs) for path, known_phvs in zip(to_check, known)]
+
+    errors = {Path(path): file_errors for path, file_errors in results if file_errors}
+
+    invalid_keys = {file.as_posix() for file in errors}
+    save_cache(cache_file, {key: digest for key, digest in hashes.items() if key not in invalid_keys}, schema,
+               phvs_digest)
+
+    return errors, skipped
+
+
+def allowlisted(errors: Dict[Path, List[str]], base_dir: Path,
+                allowlist: Dict[str, str] = SCHEMA_ALLOWLIST) -> Dict[Path, str]:
+    """{file: reason} for the files with errors that allowlist (paths relative to base_dir) names"""
+    allowed = {}
+    for file in errors:
+        try:
+            key = file.relative_to(base_dir).as_posix()
+        except ValueError:
+            continue
+        if key in allowlist:
+            allowed[file] = allowlist[key]
+    return allowed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate */*-ingest*/*.yaml files")
+    parser.add_argument('--dir', default=ingest_dir, help=f'Directory to search (default: {ingest_dir})')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Worker processes to parse with (0 = one per CPU, default: 1)')
+    parser.add_argument('--cache', type=Path, default=None,
+                        help='Content-hash cache file; unchanged files that validated before are skipped')
+    parser.add_argument('--schema', action='store_true',
+                        help='Also check the class_derivations structure of each file and the phvs it reads, '
+                             'not just YAML syntax')
+    parser.add_argument('--report-only', action='store_true',
+                        help='Print the errors found but exit 0')
+    parser.add_argument('--valid-dir', default=valid_phvs_dir,
+                        help=f'Directory of <cohort>-ingest.tsv lists for --schema (default: {valid_phvs_dir})')
+    args = parser.parse_args()
+
+    base_dir = Path(args.dir)
+    ingest_files = find_ingest_files(base_dir)
+
+    if not ingest_files:
+        print(f"No YAML files in directories with '-ingest' found under {base_dir}")
+
+    valid_phvs = None
+    if args.schema:
+        valid_phvs = load_valid_phvs(Path(args.valid_dir))
+        unlisted = sorted({cohort_of(file) for file in ingest_files} - valid_phvs.keys())
+        if unlisted:
+            print(f"Warning: no valid-phvs list in {args.valid_dir} for {', '.join(unlisted)}; "
+                  f"their phvs are not checked")
+
+    errors, skipped = validate_files(ingest_files, jobs=args.jobs, cache_file=args.cache, schema=args.schema,
+                                     valid_phvs=valid_phvs)
+
+    allowed = allowlisted(errors, base_dir) if args.schema else {}
+    for file in ingest_files:
+        if file in allowed:
+            print(f"⚠️  {file} has {len(errors[file])} known error(s) (see SCHEMA_ALLOWLIST: {allowed[file]})")
+    if args.schema:
+        fixed = sorted(key for key in SCHEMA_ALLOWLIST
+                       if (base_dir / key).is_file() and base_dir / key not in errors)
+        for key in fixed:
+            print(f"Note: {key} is valid now; remove it from SCHEMA_ALLOWLIST")
+
+    invalid_files = [file for file in ingest_files if file in errors and file not in allowed]
     for file in invalid_files:
-        print(f"  - {file}")
-    print(f"{'='*80}")
-    exit(1)
-else:
-    print(f"✅ All files valid!")
-    print(f"{'='*80}")
-    exit(0)
\ No newline at end of file
+        if len(errors[file]) == 1:
+            print(f"❌ {file} is invalid: {errors[file][0]}")
+        else:
+            print(f"❌ {file} is invalid ({len(errors[file])} errors):")
+            for error in errors[file]:
+                print(f"    {error}")
+
+    print(f"\n{'='*80}")
+    print(f"Summary: {len(ingest_files) - len(invalid_files) - len(allowed)}/{len(ingest_files)} files valid"
+          + (f", {len(allowed)} allowlisted" if allowed else ''))
+    if args.cache is not None:
+        print(f"({skipped} unchanged file(s) skipped using {args.cache})")
+    if invalid_files:
+        print(f"\n❌ {len(invalid_files)} invalid file(s):")
+        for file in invalid_files:
+            print(f"  - {file}")
+        print(f"{'='*80}")
+        return 0 if args.report_only else 1
+    else:
+        print(f"✅ All files valid{' but the allowlisted' if allowed else ''}!")
+        print(f"{'='*80}")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,24 @@
+import argparse
+import hashlib
+import json
+import os
 import pandas as pd
 import gspread
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from gspread_dataframe import set_with_dataframe, get_as_dataframe
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import re
 
+try:
+    from pyarrow import ArrowException
+    HAVE_PYARROW = True
+except ImportError:
+    # without pyarrow, to_parquet raises ImportError
+    ArrowException = ImportError
+    HAVE_PYARROW = False
+
 def root_dir():
     # this script is currently in the root directory, so
     return '.'
@@ -77,8 +93,54 @@ def main():
 
     pass
 
-def load_gsheet_as_df(spreadsheet_name: str, worksheet_name: str) -> pd.DataFrame:
+# Local worksheet snapshots, so reports can be regenerated quickly, reproducibly and offline.
+# Each worksheet is stored as <snapshot dir>/<spreadsheet>__<worksheet>.parquet with a .json
+# sidecar recording when it was fetched. Settings can be changed by the scripts' command line
+# flags or the GSHEET_SNAPSHOT_DIR / GSHEET_SNAPSHOT_MAX_AGE_HOURS / GSHEET_OFFLINE env vars.
+# Parquet needs pyarrow, from the `parquet` extra (`poetry install --extras parquet`); without it
+# each sheet is downloaded once per run, and --offline has nothing to read.
+SNAPSHOT_SETTINGS = {
+    'dir': Path(os.environ.get('GSHEET_SNAPSHOT_DIR', Path(__file__).resolve().parent.parent / 'gsheet_snapshots')),
+    # Snapshots younger than this are used instead of downloading; 0 always downloads
+    'max_age_hours': float(os.environ.get('GSHEET_SNAPSHOT_MAX_AGE_HOURS', 24)),
+    # Never download; fail if a snapshot is missing
+    'offline': os.environ.get('GSHEET_OFFLINE', '') not in ('', '0'),
+}
+
+# Worksheets downloaded by prefetch_gsheets and not loaded yet, so load_gsheet_as_df doesn't
+# download them again when no snapshot could be saved
+_prefetched: Dict[Tuple[str, str], pd.DataFrame] = {}
+
+
+def snapshot_path(spreadsheet_name: str, worksheet_name: str) -> Path:
+    """Parquet snapshot file for a worksheet"""
+    def slug(name):
+        return re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('_')
+    key = hashlib.sha1(f"{spreadsheet_name}\0{worksheet_name}".encode('utf-8')).hexdigest()[:8]
+    return Path(SNAPSHOT_SETTINGS['dir']) / f"{slug(spreadsheet_name)}__{slug(worksheet_name)}__{key}.parquet"
+
+
+def snapshot_age_hours(spreadsheet_name: str, worksheet_name: str) -> Optional[float]:
+    """
+    Hours since the worksheet's snapshot was fetched, or None if there is no snapshot or its
+    sidecar can't be read (e.g. truncated by an interrupted run), so it is downloaded again
     """
+    path = snapshot_path(spreadsheet_name, worksheet_name)
+    meta_path = path.with_suffix('.json')
+    if not path.exists() or not meta_path.exists():
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            fetched_at = datetime.fromisoformat(json.load(f)['fetched_at'])
+        return (datetime.now(timezone.utc) - fetched_at).total_seconds() / 3600
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Warning: cannot read {meta_path} ({e!r}); treating the snapshot as stale")
+        return None
+
+
+def fetch_gsheet_snapshot(spreadsheet_name: str, worksheet_name: str) -> pd.DataFrame:
+    """
+    Download a worksheet and save it as a snapshot; returns the downloaded data (before fillna).
     Needs to find credentials in ~/.config/gspread/service_account.json.
     And you have to share the google sheet with the service account email address
     Instructions: https://docs.gspread.org/en/v6.1.3/oauth2.html
@@ -87,8 +149,129 @@ def load_gsheet_as_df(spreadsheet_name: str, worksheet_name: str) -> pd.DataFram
     spreadsheet = gc.open(spreadsheet_name)
     worksheet = spreadsheet.worksheet(worksheet_name)
     df = get_as_dataframe(worksheet).dropna(how='all').dropna(axis=1, how='all')
+
+    path = snapshot_path(spreadsheet_name, worksheet_name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(path, index=False)
+    except (ImportError, ArrowException, ValueError, OSError) as e:
+        # no pyarrow, a column Arrow can't store (e.g. mixed numbers and text) or a snapshot
+        # directory that can't be written: keep the download
+        print(f"Warning: not saving a snapshot of {spreadsheet_name} / {worksheet_name}: {e}")
+        if path.exists():
+            path.unlink()
+        return df
+    with open(path.with_suffix('.json'), 'w') as f:
+        json.dump({
+            'spreadsheet': spreadsheet_name,
+            'worksheet': worksheet_name,
+            'fetched_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'rows': len(df),
+        }, f, indent=2)
+    return df
+
+
+def needs_refresh(spreadsheet_name: str, worksheet_name: str) -> bool:
+    """True if the worksheet should be downloaded under the current freshness policy"""
+    if SNAPSHOT_SETTINGS['offline']:
+        return False
+    age = snapshot_age_hours(spreadsheet_name, worksheet_name)
+    return age is None or age >= SNAPSHOT_SETTINGS['max_age_hours']
+
+
+def prefetch_gsheets(sheets: List[Tuple[str, str]]) -> Dict[Tuple[str, str], pd.DataFrame]:
+    """
+    Download, concurrently, every (spreadsheet, worksheet) whose snapshot is missing or stale.
+    The load_gsheet_as_df calls that follow then reuse the downloaded data instead of fetching
+    again. Returns the downloaded frames. Failures are reported here and surface again when
+    the sheet is loaded.
+    """
+    stale = [sheet for sheet in sheets if needs_refresh(*sheet)]
+    if not stale:
+        return {}
+    print(f"Refreshing {len(stale)} Google Sheet snapshot(s)...")
+    downloaded = {}
+    with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+        futures = {pool.submit(fetch_gsheet_snapshot, *sheet): sheet for sheet in stale}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print(f"Error refreshing snapshot of {futures[future]}: {future.exception()}")
+            else:
+                downloaded[futures[future]] = future.result()
+    _prefetched.update(downloaded)
+    return downloaded
+
+
+def load_gsheet_as_df(spreadsheet_name: str, worksheet_name: str) -> pd.DataFrame:
+    """
+    Load a worksheet, from what prefetch_gsheets downloaded, from its local snapshot when that is
+    fresh enough (see SNAPSHOT_SETTINGS), or from Google Sheets otherwise.
+    """
+    path = snapshot_path(spreadsheet_name, worksheet_name)
+    df = _prefetched.pop((spreadsheet_name, worksheet_name), None)
+    if df is None and needs_refresh(spreadsheet_name, worksheet_name):
+        try:
+            df = fetch_gsheet_snapshot(spreadsheet_name, worksheet_name)
+        except Exception as e:
+            if not path.exists():
+                raise
+            print(f"Warning: could not download {spreadsheet_name} / {worksheet_name} ({e}); using stale snapshot")
+    if df is None:
+        if not path.exists():
+            raise FileNotFoundError(f"--offline, but there is no snapshot of {spreadsheet_name} / {worksheet_name} "
+                                    f"at {path}; run without --offline to download it")
+        try:
+            df = pd.read_parquet(path)
+        except (ImportError, ArrowException, OSError) as e:
+            raise ValueError(f"cannot read the snapshot of {spreadsheet_name} / {worksheet_name} at {path}: {e}")
     df = df.fillna('')
     return df
 
+
+def add_snapshot_arguments(parser: argparse.ArgumentParser):
+    """Command line flags for the Google Sheets snapshot policy"""
+    parser.add_argument('--offline', action='store_true',
+                        help='Only use local Google Sheets snapshots; never download')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Download every Google Sheet even if its snapshot is fresh')
+    parser.add_argument('--max-age', type=float, default=None, metavar='HOURS',
+                        help=f"Reuse snapshots younger than this (default: {SNAPSHOT_SETTINGS['max_age_hours']:g})")
+    parser.add_argument('--snapshot-dir', type=Path, default=None,
+                        help=f"Snapshot directory (default: {SNAPSHOT_SETTINGS['dir']})")
+
+
+def apply_snapshot_arguments(args: argparse.Namespace):
+    """
+    Apply the snapshot flags. Raises ValueError if offline (--offline or GSHEET_OFFLINE) and no
+    snapshot can be read; warns if online and no snapshot can be written.
+    """
+    if args.snapshot_dir is not None:
+        SNAPSHOT_SETTINGS['dir'] = args.snapshot_dir
+    if args.max_age is not None:
+        SNAPSHOT_SETTINGS['max_age_hours'] = args.max_age
+    if args.refresh:
+        SNAPSHOT_SETTINGS['max_age_hours'] = 0
+    if args.offline:
+        SNAPSHOT_SETTINGS['offline'] = True
+
+    snapshot_dir = Path(SNAPSHOT_SETTINGS['dir'])
+    if SNAPSHOT_SETTINGS['offline']:
+        if not HAVE_PYARROW:
+            raise ValueError('--offline reads Parquet snapshots, which needs pyarrow '
+                             '(poetry install --extras parquet)')
+        if not snapshot_dir.is_dir():
+            raise ValueError(f"--offline, but there is no snapshot directory {snapshot_dir}; "
+                             f"run without --offline to download the sheets")
+    elif not HAVE_PYARROW:
+        print('Warning: without pyarrow (poetry install --extras parquet) no Google Sheets snapshots are saved, '
+              'so --offline will not work')
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate VARIABLE_DOCUMENTATION.md from the BDCHM Variable Mapping sheet")
+    add_snapshot_arguments(parser)
+    try:
+        apply_snapshot_arguments(parser.parse_args())
+    except ValueError as e:
+        parser.error(str(e))
+    main()